@@ -21,6 +21,20 @@ class Config(BaseSettings):
     BARISTA_ID: int = Field(8131945136)
     BASE_WEBHOOK_URL: str
 
+    # --- Получение апдейтов Telegram ---
+    # polling — для локальной разработки, webhook — через FastAPI-приложение
+    TELEGRAM_MODE: str = Field("polling", description="polling / webhook")
+    TELEGRAM_WEBHOOK_PATH: str = "/telegram/webhook"
+    TELEGRAM_WEBHOOK_SECRET: str = ""
+    TELEGRAM_WEBHOOK_MAX_CONCURRENCY: int = 100
+
+    # --- Лимиты исходящих сообщений Telegram (на процесс) ---
+    TELEGRAM_GLOBAL_RATE: int = 30
+    TELEGRAM_PRIVATE_CHAT_INTERVAL: float = 1.0
+    TELEGRAM_GROUP_CHAT_INTERVAL: float = 3.0
+    TELEGRAM_CHAT_BURST: int = 3
+    TELEGRAM_MAX_RETRIES: int = 3
+
     # --- Postgres ---
     POSTGRES_DB: str
     POSTGRES_USER: str
@@ -57,6 +71,18 @@ class Config(BaseSettings):
     # --- Celery ---
     CELERY_DB_NUM: int = 1
 
+    # --- Рассылка ---
+    BROADCAST_CONCURRENCY: int = 25
+    BROADCAST_BATCH_SIZE: int = 1000
+    BROADCAST_PROGRESS_INTERVAL: int = 10
+    BROADCAST_TRANSIENT_RETRIES: int = 2
+    # Рассылка делится на столько частей, каждая обрабатывается отдельной задачей Celery
+    BROADCAST_SHARDS: int = 4
+    # Суммарный темп рассылки (сообщений/с) на все части; часть лимита Telegram остается боту
+    BROADCAST_RATE: int = 25
+    # Часть без обновлений дольше этого времени считается брошенной упавшим воркером
+    BROADCAST_SHARD_STALE_SECONDS: int = 120
+
     @property
     def CELERY_BROKER_URL(self) -> str:
         return f"redis://{self.REDIS_HOST}:{self.REDIS_PORT}/{self.CELERY_DB_NUM}"
@@ -65,6 +91,54 @@ class Config(BaseSettings):
     def CELERY_RESULT_BACKEND(self) -> str:
         return f"redis://{self.REDIS_HOST}:{self.REDIS_PORT}/{self.CELERY_DB_NUM}"
 
+    # Часовой пояс кофейни (для аналитики по часам)
+    TIMEZONE: str = "Asia/Almaty"
+
+    # --- Доска заказов ---
+    ORDERS_CACHE_RECONCILE_SECONDS: int = 30
+    WS_MAX_CONNECTIONS: int = 100
+    WS_PING_INTERVAL: int = 20
+    WS_IDLE_TIMEOUT: int = 60
+    WS_SEND_TIMEOUT: int = 5
+    # Точка продаж по умолчанию для топиков доски (location:<...>)
+    CAFE_LOCATION: str = "main"
+
+    # --- Метрики Prometheus (/metrics) ---
+    # Bearer-токен сборщика метрик (и /ws/stats); пока не задан, оба отвечают 401
+    METRICS_TOKEN: str = ""
+
+    # --- Защита от повторных нажатий (оформление заказа и оплата) ---
+    # Сколько держится блокировка, пока первое нажатие обрабатывается
+    IDEMPOTENCY_LOCK_TTL: int = 60
+    # Сколько хранится результат первого нажатия для ответа на повторные
+    IDEMPOTENCY_RESULT_TTL: int = 600
+
+    # --- Outbox уведомлений (бариста, реферер, подтверждение оплаты) ---
+    OUTBOX_BATCH_SIZE: int = 50
+    # Как часто проверять outbox, если диспетчер не разбудили
+    OUTBOX_POLL_INTERVAL: float = 2.0
+    # На сколько строка "арендуется" при выборке (повтор, если процесс упал во время отправки)
+    OUTBOX_LEASE_SECONDS: int = 60
+    OUTBOX_MAX_ATTEMPTS: int = 8
+
+    # --- Очередь обработки вебхуков Epay (payment_jobs) ---
+    PAYMENT_JOB_WORKERS: int = 4
+    PAYMENT_JOB_POLL_INTERVAL: float = 1.0
+    # Через сколько задание вернется в очередь, если процесс упал во время обработки
+    PAYMENT_JOB_LEASE_SECONDS: int = 120
+    # После стольких попыток задание получает статус dead
+    PAYMENT_JOB_MAX_ATTEMPTS: int = 5
+
+    # --- Очистка зависших платежей (pending) ---
+    PAYMENT_SWEEP_INTERVAL: int = 300
+    PAYMENT_SWEEP_BATCH_SIZE: int = 200
+    # Через сколько минут неоплаченный счет снимается с ожидания
+    PAYMENT_PENDING_TTL_MINUTES: int = 30
+    # Если шлюз недоступен для сверки, платеж остается pending, но не дольше этого срока
+    PAYMENT_RECONCILE_GIVE_UP_HOURS: int = 24
+    # Сколько запросов статуса к шлюзу выполняется одновременно
+    PAYMENT_RECONCILE_CONCURRENCY: int = 5
+
     # --- Google Sheets ---
     GOOGLE_CREDS_FILE: str = str(BASE_DIR / "google_sheets_creds.json")
     GOOGLE_SHEETS_SPREADSHEET_NAME: str = "Аналитика заказов"
@@ -77,6 +151,23 @@ class Config(BaseSettings):
     EPAY_OAUTH_URL: str
     EPAY_CREATE_INVOICE_URL: str
     EPAY_PAYMENT_PAGE_URL: str
+    # Проверка статуса счета для сверки, {invoice_id} подставляется; пусто — сверка отключена
+    EPAY_STATUS_URL: str = ""
+    # Пул keep-alive соединений к шлюзу
+    EPAY_POOL_SIZE: int = 20
+    EPAY_KEEPALIVE_TIMEOUT: int = 30
+    # Токен обновляется заранее, за столько секунд до истечения expires_in
+    EPAY_TOKEN_REFRESH_MARGIN: int = 60
+    # Срок жизни токена, если сервер не вернул expires_in
+    EPAY_TOKEN_DEFAULT_TTL: int = 1800
+    # Таймауты запросов к шлюзу (секунды)
+    EPAY_CONNECT_TIMEOUT: float = 3.0
+    EPAY_TOKEN_TIMEOUT: float = 5.0
+    EPAY_INVOICE_TIMEOUT: float = 8.0
+    EPAY_STATUS_TIMEOUT: float = 5.0
+    # Предохранитель: после стольких сбоев подряд онлайн-оплата отключается на EPAY_CB_RECOVERY_TIMEOUT секунд
+    EPAY_CB_FAILURE_THRESHOLD: int = 5
+    EPAY_CB_RECOVERY_TIMEOUT: float = 30.0
 
     # --- Cloudflare ---
     CLOUDFLARE_TUNNEL_TOKEN: str
@@ -1,7 +1,7 @@
 # core/handlers/admin_handlers.py
 
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from pathlib import Path
@@ -10,16 +10,24 @@ import datetime
 # Импорты
 from core.filters.is_admin import IsAdmin
 from core.utils.database import postgres_client
+from core.services.media_registry import media_registry
 from core.utils.states import Broadcast, AdminReport
 from core.keyboards.inline.admin_menu import (
-    admin_main_menu_ikb, analytics_menu_ikb, broadcast_menu_ikb,
-    broadcast_confirm_ikb, get_report_ikb, cancel_ikb
+    admin_main_menu_ikb, analytics_menu_ikb, get_broadcast_menu_ikb, broadcast_segment_ikb,
+    broadcast_recent_days_ikb, get_broadcast_drinks_ikb, broadcast_confirm_ikb, get_report_ikb, cancel_ikb
 )
+from core.services.broadcast import (
+    ACTIVE_RUN_STATUSES, RUN_RUNNING, RUN_PAUSED, RUN_CANCELLED, SEGMENT_ALL, SEGMENT_RECENT, SEGMENT_DRINK,
+    get_run_summary, progress_text, report_progress, count_segment_audience, segment_title
+)
+from core.utils.helpers import PRICES
 
 # ИМПОРТИРУЕМ ЗАДАЧИ CELERY
-from tasks import broadcast_task, export_orders_task
+from tasks import broadcast_task, resume_broadcast_task, export_orders_task
 
 router = Router()
+
+ADMIN_PHOTO_PATH = Path(__file__).resolve().parent.parent.parent / "analitic_admin.png"
 # Применяем фильтр админа ко всем хендлерам в этом файле
 router.message.filter(IsAdmin())
 router.callback_query.filter(IsAdmin())
@@ -33,13 +41,22 @@ async def send_admin_panel(bot: Bot, chat_id: int):
     """
     Отправляет главное меню админ-панели как новое сообщение.
     """
-    path = Path(__file__).resolve().parent.parent.parent / "analitic_admin.png"
-    photo = FSInputFile(path)
-    await bot.send_photo(
-        chat_id=chat_id,
-        photo=photo,
-        caption="Добро пожаловать в админ-панель!",
-        reply_markup=admin_main_menu_ikb
+    await media_registry.send_photo(
+        bot.id, ADMIN_PHOTO_PATH,
+        lambda photo: bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption="Добро пожаловать в админ-панель!",
+            reply_markup=admin_main_menu_ikb
+        )
+    )
+
+
+async def get_active_run():
+    """Последний незавершенный (идет или на паузе) запуск рассылки."""
+    return await postgres_client.fetchrow(
+        "SELECT id, status FROM broadcast_runs WHERE status = ANY($1::text[]) ORDER BY id DESC LIMIT 1",
+        list(ACTIVE_RUN_STATUSES)
     )
 
 
@@ -50,7 +67,17 @@ async def send_broadcast_menu(bot: Bot, chat_id: int):
     record = await postgres_client.fetchrow("SELECT message_text, photo_id FROM broadcast WHERE id = 1")
     current_text = record.get('message_text') if record else None
     current_photo = record.get('photo_id') if record else None
-    caption = "Меню управления рассылкой.\n\n<b>Текущее сообщение:</b>\n\n"
+    caption = "Меню управления рассылкой.\n\n"
+
+    # Незавершенный запуск: показываем прогресс и кнопки паузы/отмены вместо "Начать"
+    active_run = await get_active_run()
+    if active_run:
+        summary = await get_run_summary(postgres_client, active_run['id'])
+        caption += progress_text(summary) + "\n\n"
+        broadcast_menu_ikb = get_broadcast_menu_ikb(active_run['id'], active_run['status'])
+    else:
+        broadcast_menu_ikb = get_broadcast_menu_ikb()
+    caption += "<b>Текущее сообщение:</b>\n\n"
 
     if not current_text and not current_photo:
         caption += "Сообщение для рассылки еще не задано."
@@ -157,6 +184,61 @@ async def show_free_coffees_analytics(callback: CallbackQuery):
     await callback.message.edit_caption(caption=text, reply_markup=analytics_menu_ikb)
 
 
+def format_duration_stats(stats: dict) -> str:
+    """Форматирует перцентили (секунды) в минуты: p50 / p90 / p99 и число заказов."""
+    return (f"p50 <code>{stats['p50'] / 60:.1f}</code> / p90 <code>{stats['p90'] / 60:.1f}</code> / "
+            f"p99 <code>{stats['p99'] / 60:.1f}</code> мин ({stats['count']})")
+
+
+def fit_caption(text: str, limit: int = 1024) -> str:
+    """Обрезает подпись по целым строкам, чтобы не разрезать HTML-теги."""
+    if len(text) <= limit:
+        return text
+    lines = []
+    for line in text.split("\n"):
+        if len("\n".join(lines + [line])) > limit:
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+@router.callback_query(F.data == "analytics_prep_time")
+async def show_prep_time_analytics(callback: CallbackQuery):
+    new_to_ready = await postgres_client.get_status_durations("new", "ready")
+    arrived_to_completed = await postgres_client.get_status_durations("arrived", "completed")
+    by_drink = await postgres_client.get_status_durations("new", "ready", group_by="drink")
+
+    text = "<b>⏱ Время обработки заказов (30 дней):</b>\n"
+    text += "▪️ Приготовление (новый → готов):\n"
+    text += f"   {format_duration_stats(new_to_ready[0])}\n" if new_to_ready else "   нет данных\n"
+    text += "▪️ Выдача (подошел → завершен):\n"
+    text += f"   {format_duration_stats(arrived_to_completed[0])}\n" if arrived_to_completed else "   нет данных\n"
+
+    text += "\n<b>☕️ Приготовление по напиткам:</b>\n"
+    if by_drink:
+        for row in by_drink:
+            text += f"▪️ {row['group']}: {format_duration_stats(row)}\n"
+    else:
+        text += "Нет данных.\n"
+
+    await callback.message.edit_caption(caption=fit_caption(text), reply_markup=analytics_menu_ikb)
+
+
+@router.callback_query(F.data == "analytics_prep_hours")
+async def show_prep_time_by_hour(callback: CallbackQuery):
+    by_hour = await postgres_client.get_status_durations("new", "ready", group_by="hour")
+
+    text = "<b>🕐 Приготовление по часам (30 дней):</b>\n"
+    if by_hour:
+        for row in sorted(by_hour, key=lambda r: int(r['group'])):
+            text += (f"▪️ {int(row['group']):02d}:00 — p50 <code>{row['p50'] / 60:.1f}</code> / "
+                     f"p90 <code>{row['p90'] / 60:.1f}</code> мин ({row['count']})\n")
+    else:
+        text += "Нет данных."
+
+    await callback.message.edit_caption(caption=fit_caption(text), reply_markup=analytics_menu_ikb)
+
+
 # =================================================================
 #                       БЛОК ЭКСПОРТА ЗАКАЗОВ (CELERY)
 # =================================================================
@@ -248,14 +330,56 @@ async def broadcast_start(callback: CallbackQuery):
         await callback.answer("❌ Сначала нужно задать текст или фото для рассылки!", show_alert=True)
         return
 
-    users_count = await postgres_client.fetchval("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
     await callback.message.delete()
-    await callback.message.answer(
-        text=f"Вы уверены, что хотите начать рассылку?\n\nСообщение будет отправлено `{users_count}` пользователям.",
+    await callback.message.answer(text="Кому отправить рассылку?", reply_markup=broadcast_segment_ikb)
+
+
+async def show_segment_preview(callback: CallbackQuery, state: FSMContext, segment: str, param: str = None):
+    """Запоминает выбранный сегмент и показывает размер аудитории перед подтверждением."""
+    users_count = await count_segment_audience(postgres_client, segment, param)
+    await state.update_data(broadcast_segment=segment, broadcast_segment_param=param)
+    await callback.message.edit_text(
+        text=f"Вы уверены, что хотите начать рассылку?\n\n"
+             f"Аудитория: {segment_title(segment, param)}\n"
+             f"Сообщение будет отправлено <code>{users_count}</code> пользователям.",
         reply_markup=broadcast_confirm_ikb
     )
 
 
+@router.callback_query(F.data == "broadcast_segment_recent")
+async def broadcast_segment_recent(callback: CallbackQuery):
+    await callback.message.edit_text("За какой период учитывать заказы?", reply_markup=broadcast_recent_days_ikb)
+
+
+@router.callback_query(F.data.startswith("broadcast_recent_"))
+async def broadcast_recent_days(callback: CallbackQuery, state: FSMContext):
+    days = callback.data.split("_")[-1]
+    await show_segment_preview(callback, state, SEGMENT_RECENT, days)
+
+
+@router.callback_query(F.data == "broadcast_segment_drink")
+async def broadcast_segment_drink(callback: CallbackQuery):
+    await callback.message.edit_text(
+        "Выберите напиток:", reply_markup=get_broadcast_drinks_ikb(list(PRICES["coffee"]))
+    )
+
+
+@router.callback_query(F.data.startswith("broadcast_drink_"))
+async def broadcast_drink_chosen(callback: CallbackQuery, state: FSMContext):
+    drink = callback.data.removeprefix("broadcast_drink_")
+    if drink not in PRICES["coffee"]:
+        await callback.answer("Неизвестный напиток", show_alert=True)
+        return
+    await show_segment_preview(callback, state, SEGMENT_DRINK, drink)
+
+
+@router.callback_query(F.data.in_({"broadcast_segment_all", "broadcast_segment_never",
+                                   "broadcast_segment_free_coffees"}))
+async def broadcast_segment_simple(callback: CallbackQuery, state: FSMContext):
+    segment = callback.data.removeprefix("broadcast_segment_")
+    await show_segment_preview(callback, state, segment)
+
+
 @router.callback_query(F.data == "broadcast_confirm_no")
 async def broadcast_confirm_no(callback: CallbackQuery, state: FSMContext):
     # <-- ИЗМЕНЕНО: Убрали FakeCallback, вызываем сервисную функцию напрямую
@@ -268,9 +392,55 @@ async def broadcast_confirm_yes(callback: CallbackQuery, state: FSMContext):
     """
     Запускает процесс рассылки через Celery.
     """
-    broadcast_task.delay(admin_id=callback.from_user.id)
+    if await get_active_run():
+        await callback.answer("⏳ Предыдущая рассылка еще не завершена.", show_alert=True)
+        return
+    data = await state.get_data()
+    broadcast_task.delay(
+        admin_id=callback.from_user.id,
+        segment=data.get('broadcast_segment', SEGMENT_ALL),
+        segment_param=data.get('broadcast_segment_param')
+    )
+    await state.clear()
     await callback.answer("🚀 Рассылка запущена в фоне!", show_alert=False)
 
     # <-- ИЗМЕНЕНО: Убрали FakeCallback, вызываем сервисную функцию напрямую
     await callback.message.delete()
     await send_admin_panel(callback.bot, callback.message.chat.id)
+
+
+@router.callback_query(F.data.startswith("broadcast_pause_"))
+async def broadcast_pause(callback: CallbackQuery):
+    """Пауза: части рассылки останавливаются после текущей порции, курсор сохраняется."""
+    run_id = int(callback.data.split("_")[-1])
+    updated = await postgres_client.fetchval(
+        "UPDATE broadcast_runs SET status = $2 WHERE id = $1 AND status = $3 RETURNING id",
+        run_id, RUN_PAUSED, RUN_RUNNING
+    )
+    await callback.answer("⏸ Рассылка ставится на паузу" if updated else "Рассылка не идет")
+    await report_progress(callback.bot, postgres_client, run_id)
+
+
+@router.callback_query(F.data.startswith("broadcast_resume_"))
+async def broadcast_resume(callback: CallbackQuery):
+    """Продолжение: незавершенные части снова ставятся в очередь и идут с сохраненного курсора."""
+    run_id = int(callback.data.split("_")[-1])
+    updated = await postgres_client.fetchval(
+        "UPDATE broadcast_runs SET status = $2 WHERE id = $1 AND status = $3 RETURNING id",
+        run_id, RUN_RUNNING, RUN_PAUSED
+    )
+    if updated:
+        resume_broadcast_task.delay(run_id)
+    await callback.answer("▶️ Рассылка продолжена" if updated else "Рассылка не на паузе")
+    await report_progress(callback.bot, postgres_client, run_id)
+
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"))
+async def broadcast_cancel(callback: CallbackQuery):
+    run_id = int(callback.data.split("_")[-1])
+    updated = await postgres_client.fetchval(
+        "UPDATE broadcast_runs SET status = $2 WHERE id = $1 AND status = ANY($3::text[]) RETURNING id",
+        run_id, RUN_CANCELLED, list(ACTIVE_RUN_STATUSES)
+    )
+    await callback.answer("⛔️ Рассылка отменена" if updated else "Рассылка уже завершена")
+    await report_progress(callback.bot, postgres_client, run_id)
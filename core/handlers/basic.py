@@ -2,8 +2,7 @@
 #               ИМПОРТЫ И ИНИЦИАЛИЗАЦИЯ
 # =================================================================
 from aiogram import F, Router, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto, InlineKeyboardMarkup, \
-    InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton, User
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from pathlib import Path
@@ -11,6 +10,7 @@ import datetime
 import time
 from loguru import logger
 import json
+import uuid
 from zoneinfo import ZoneInfo
 
 # --- Импортируем все необходимые состояния и клавиатуры ---
@@ -24,75 +24,116 @@ from core.utils.database import postgres_client
 from config import config
 from core.webapp.ws.orders_ws import manager as ws_manager
 from core.utils.helpers import calculate_order_total
-from core.services.epay_service import epay_service
+from core.services.epay_service import epay_service, EpayUnavailableError
+from core.services.media_registry import media_registry
+from core.services.send_scheduler import send_priority, Priority
+from core.services.idempotency import idempotency_guard
+from core.services.notification_outbox import enqueue_notification, outbox_dispatcher
 
 router = Router()
 
+WELCOME_PHOTO_PATH = Path(__file__).resolve().parent.parent.parent / "coffee-cup-fixed.jpg"
+
 
 # =================================================================
 #               СЕРВИСНЫЙ СЛОЙ (БИЗНЕС-ЛОГИКА)
 # =================================================================
 
+REFERRER_BONUS_TEXT = ("🎉 Вам начислен бонус! За то, что ваш друг сделал первый заказ, "
+                       "вы получили один бесплатный кофе.")
+
+
+async def publish_new_order(order_record) -> None:
+    """Отправляет новый заказ на доску бариста через WebSocket (после коммита транзакции)."""
+    order_payload = {
+        "order_id": order_record['order_id'], "type": order_record['type'],
+        "cup": order_record['cup'], "time": order_record['time'],
+        "status": order_record.get('status', 'new'), "syrup": order_record.get('syrup'),
+        "croissant": order_record.get('croissant'), "is_free": order_record.get('is_free', False),
+        "timestamp": order_record['timestamp'].isoformat(), "total_price": order_record['total_price'],
+        "created_at": order_record['created_at'].isoformat(),
+        "payment_status": order_record.get('payment_status', 'unpaid')
+    }
+    await ws_manager.broadcast({"type": "new_order", "payload": order_payload})
+
+
 # Функция больше не принимает 'bot'. Она только обрабатывает данные и возвращает результат.
 async def process_and_save_order(order_data: dict, user_id: int, username: str, first_name: str,
-                                 payment_id: str = None, status: str = 'new') -> dict | None:
+                                 payment_id: str = None, status: str = 'new',
+                                 idempotency_key: str = None, conn=None) -> dict | None:
     """
-    Выполняет логику создания заказа и возвращает результат для отправки уведомлений.
-    Изолирует бизнес-логику от хэндлера.
+    Выполняет логику создания заказа одной транзакцией: заказ, списание/начисление бонусов
+    и уведомления бариста и реферера в notification_outbox. Уведомления отправит
+    outbox_dispatcher после коммита, хэндлер может сразу отвечать пользователю.
+    Если передан conn, все выполняется в транзакции вызывающего кода (как точка сохранения),
+    и публиковать заказ на доску (publish_new_order) вызывающий код должен сам после коммита.
+    Если заказ с таким idempotency_key уже создан, возвращает его с флагом duplicate
+    и не повторяет побочные эффекты (бонусы, доска, уведомления).
     """
-    try:
-        data = order_data
-        order_is_free = data.get('use_free', False)
-        total_price = calculate_order_total(data)
-        notification_info = {}  # <-- ИЗМЕНЕНО: Словарь для информации об уведомлениях
-
-        # 1. Создаем запись о заказе в БД
-        order_db_data = {
-            'type': data.get('type'), 'cup': data.get('cup'), 'syrup': data.get('syrup', 'Без сиропа'),
-            'croissant': data.get('croissant', 'Без добавок'), 'time': data.get('time'), 'is_free': order_is_free,
-            'username': username, 'user_id': user_id, 'first_name': first_name,
-            'timestamp': datetime.datetime.now(ZoneInfo("Asia/Yekaterinburg")), "total_price": total_price,
-            'payment_id': payment_id, 'status': status,
-            'payment_status': 'bonus' if order_is_free else ('paid' if payment_id else 'unpaid')
-        }
-        new_order_record = await postgres_client.add_order(order_db_data)
+    data = order_data
+    order_is_free = data.get('use_free', False)
+
+    # 1. Данные записи о заказе
+    order_db_data = {
+        'type': data.get('type'), 'cup': data.get('cup'), 'syrup': data.get('syrup', 'Без сиропа'),
+        'croissant': data.get('croissant', 'Без добавок'), 'time': data.get('time'), 'is_free': order_is_free,
+        'username': username, 'user_id': user_id, 'first_name': first_name,
+        'timestamp': datetime.datetime.now(ZoneInfo("Asia/Yekaterinburg")),
+        "total_price": calculate_order_total(data), 'payment_id': payment_id, 'status': status,
+        'payment_status': 'bonus' if order_is_free else ('paid' if payment_id else 'unpaid')
+    }
+    if idempotency_key:
+        order_db_data['idempotency_key'] = idempotency_key
+
+    async def save(tx_conn) -> dict:
+        new_order_record = await postgres_client.add_order(order_db_data, conn=tx_conn)
+        if not new_order_record and idempotency_key:
+            existing_order = await tx_conn.fetchrow(
+                "SELECT * FROM orders WHERE idempotency_key = $1", idempotency_key
+            )
+            if existing_order:
+                logger.warning(f"Повторное оформление с ключом {idempotency_key}: "
+                               f"заказ #{existing_order['order_id']} уже создан")
+                return {"order_record": existing_order, "duplicate": True}
         if not new_order_record:
             raise Exception("postgres_client.add_order returned None or False")
 
         # 2. Если заказ бесплатный, списываем бонус
         if order_is_free:
-            await postgres_client.execute(
+            await tx_conn.execute(
                 "UPDATE referral_program SET free_coffees = free_coffees - 1 WHERE user_id = $1", user_id)
 
-        # 3. Отправляем уведомление на доску бариста через WebSocket
-        order_payload = {
-            "order_id": new_order_record['order_id'], "type": new_order_record['type'],
-            "cup": new_order_record['cup'], "time": new_order_record['time'],
-            "status": new_order_record.get('status', 'new'), "syrup": new_order_record.get('syrup'),
-            "croissant": new_order_record.get('croissant'), "is_free": new_order_record.get('is_free', False),
-            "timestamp": new_order_record['timestamp'].isoformat(), "total_price": total_price,
-            "created_at": new_order_record['created_at'].isoformat(),
-            "payment_status": new_order_record.get('payment_status', 'unpaid')
-        }
-        await ws_manager.broadcast({"type": "new_order", "payload": order_payload})
+        # 3. Уведомление для бариста
+        await enqueue_notification(
+            tx_conn, config.BARISTA_ID,
+            text=format_barista_notification(new_order_record, username, first_name), parse_mode="HTML"
+        )
 
         # 4. Проверяем и награждаем реферера
-        referral = await postgres_client.fetchrow(
-            "SELECT referrer_id, rewarded FROM referral_links WHERE referred_id=$1", user_id)
+        referral = await tx_conn.fetchrow(
+            "SELECT referrer_id, rewarded FROM referral_links WHERE referred_id=$1 FOR UPDATE", user_id)
         if referral and not referral['rewarded']:
             referrer_id = referral['referrer_id']
-            await postgres_client.execute(
+            await tx_conn.execute(
                 "UPDATE referral_program SET free_coffees = free_coffees + 1, referred_count = referred_count + 1 WHERE user_id=$1",
                 referrer_id)
-            await postgres_client.execute("UPDATE referral_links SET rewarded = TRUE WHERE referred_id = $1", user_id)
-            # <-- ИЗМЕНЕНО: Сохраняем ID реферера для уведомления вместо отправки сообщения
-            notification_info['referrer_id'] = referrer_id
+            await tx_conn.execute("UPDATE referral_links SET rewarded = TRUE WHERE referred_id = $1", user_id)
+            await enqueue_notification(tx_conn, referrer_id, text=REFERRER_BONUS_TEXT)
 
-        # <-- ИЗМЕНЕНО: Возвращаем словарь с результатом
-        return {
-            "order_record": new_order_record,
-            "notification_info": notification_info
-        }
+        return {"order_record": new_order_record}
+
+    try:
+        if conn is not None:
+            async with conn.transaction():
+                return await save(conn)
+
+        async with postgres_client.acquire() as own_conn:
+            async with own_conn.transaction():
+                result = await save(own_conn)
+        if not result.get('duplicate'):
+            outbox_dispatcher.wake()
+            await publish_new_order(result['order_record'])
+        return result
 
     except Exception as e:
         logger.error(f"Critical error in process_and_save_order for user {user_id}: {e}", exc_info=True)
@@ -162,9 +203,12 @@ async def proceed_to_confirmation(callback: CallbackQuery, state: FSMContext):
     free_coffees = referral_user['free_coffees'] if referral_user else 0
     await state.update_data(
         free_coffees_count=free_coffees,
-        last_callback=callback.model_dump(mode='json')
+        checkout_token=uuid.uuid4().hex,
+        confirm_chat_id=callback.message.chat.id,
+        confirm_message_id=callback.message.message_id
     )
-    await callback.message.edit_caption(caption=caption_with_price, reply_markup=get_loyalty_ikb(free_coffees))
+    await callback.message.edit_caption(caption=caption_with_price,
+                                        reply_markup=get_loyalty_ikb(free_coffees, epay_service.available))
 
 
 async def start_msg(message: Message | CallbackQuery):
@@ -172,20 +216,26 @@ async def start_msg(message: Message | CallbackQuery):
     Мы варим кофе с собой и выносим его тебе прямо в руки — без очередей, шума и беготни.
     Просто выбери напиток, укажи через сколько подойдешь — и всё будет готово к твоему приходу.
     👇Начнем?""")
-    path = Path(__file__).resolve().parent.parent.parent / "coffee-cup-fixed.jpg"
-    photo = FSInputFile(path)
+    # Картинка загружается в Telegram один раз, дальше отправляется по file_id
     if isinstance(message, Message):
-        await message.answer_photo(photo=photo, caption=text, reply_markup=mainMenu_ikb)
+        await media_registry.send_photo(
+            message.bot.id, WELCOME_PHOTO_PATH,
+            lambda photo: message.answer_photo(photo=photo, caption=text, reply_markup=mainMenu_ikb)
+        )
     elif isinstance(message, CallbackQuery):
-        await message.message.edit_media(media=InputMediaPhoto(media=photo, caption=text), reply_markup=mainMenu_ikb)
+        await media_registry.send_photo(
+            message.bot.id, WELCOME_PHOTO_PATH,
+            lambda photo: message.message.edit_media(media=InputMediaPhoto(media=photo, caption=text),
+                                                     reply_markup=mainMenu_ikb)
+        )
 
 
 # =================================================================
 #                       ОСНОВНЫЕ ХЭНДЛЕРЫ
 # =================================================================
 
-@router.message(CommandStart(deep_link=True))
-@router.message(CommandStart())
+@router.message(CommandStart(deep_link=True), flags={"throttle": "start"})
+@router.message(CommandStart(), flags={"throttle": "start"})
 async def cmd_start(message: Message, state: FSMContext):
     """Обработка команды старт"""
     await state.clear()
@@ -214,8 +264,8 @@ async def handle_text_message(callback: CallbackQuery, state: FSMContext):
                                         reply_markup=type_cofe_ikb)
 
 
-@router.callback_query(F.data == "partners")
-async def show_partners_info(callback: CallbackQuery):
+@router.callback_query(F.data == "partners", flags={"throttle": "partners"})
+async def show_partners_info(callback: CallbackQuery, bot_info: User):
     """Партнерская программа"""
     user_id = callback.from_user.id
     referral_user = await postgres_client.fetchrow("SELECT free_coffees FROM referral_program WHERE user_id=$1",
@@ -223,7 +273,6 @@ async def show_partners_info(callback: CallbackQuery):
     free_coffees = referral_user['free_coffees'] if referral_user else 0
     if not referral_user:
         await postgres_client.insert("referral_program", {"user_id": user_id})
-    bot_info = await callback.bot.get_me()
     referral_link = f"https://t.me/{bot_info.username}?start=ref_{user_id}"
     text = (
         f"<b>Твой бесплатный кофе ждёт!</b> ✨\n\nЗа каждого друга, который придёт по твоей ссылке и сделает заказ, ты получишь бесплатный кофе.\n Сейчас у тебя <b>{free_coffees}</b> бонусов.\n\nПоделись своей ссылкой:\n{referral_link}")
@@ -331,47 +380,68 @@ async def order_addon(callback: CallbackQuery, state: FSMContext):
 #      ШАГ 6: ПОДТВЕРЖДЕНИЕ ЗАКАЗА И ОПЛАТА
 # =================================================================
 
-@router.callback_query(Order.confirm, F.data == "create_order")
+# Оформление с оплатой на месте и создание счета — один ключ защиты на попытку:
+# по одной попытке нельзя получить и неоплаченный заказ, и счет
+CHECKOUT_ACTION = "checkout"
+INVOICE_EXISTS_TEXT = "✅ Счет уже создан — воспользуйтесь кнопкой «Оплатить» выше"
+
+
+async def answer_checkout_taken(callback: CallbackQuery, previous: dict | None) -> None:
+    """Ответ на нажатие, когда попытка оформления уже занята заказом или счетом."""
+    if previous is None:
+        await callback.answer("⏳ Заказ уже оформляется...")
+    elif previous.get('order_id'):
+        await callback.answer(f"✅ Заказ №{previous['order_id']} уже оформлен")
+    else:
+        await callback.answer(INVOICE_EXISTS_TEXT)
+
+
+@router.callback_query(Order.confirm, F.data == "create_order", flags={"throttle": "checkout"})
 async def confirm_create_order(callback: CallbackQuery, state: FSMContext):
     """
-    Обрабатывает подтверждение заказа и отправляет все уведомления.
+    Обрабатывает подтверждение заказа. Уведомления бариста и реферера
+    отправляет outbox_dispatcher, пользователю отвечаем сразу после коммита.
     """
+    user_id = callback.from_user.id
+    order_data = await state.get_data()
+    checkout_token = order_data.get('checkout_token') or f"msg{callback.message.message_id}"
+
+    # Повторное нажатие (или уже созданный счет на эту попытку): отвечаем сразу, ничего не выполняя
+    acquired, previous = await idempotency_guard.acquire(CHECKOUT_ACTION, user_id, checkout_token)
+    if not acquired:
+        await answer_checkout_taken(callback, previous)
+        return
+
+    # Результат в Redis живет IDEMPOTENCY_RESULT_TTL: живой счет по этой попытке проверяем и в БД
+    if await postgres_client.fetchval(
+        "SELECT 1 FROM payments WHERE idempotency_key = $1 AND status IN ('pending', 'processing', 'paid')",
+        checkout_token
+    ):
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
+        await callback.answer(INVOICE_EXISTS_TEXT, show_alert=True)
+        return
+
     await callback.answer("⏳ Минуточку, оформляем ваш заказ...", show_alert=False)
     await callback.message.edit_reply_markup(reply_markup=None)
 
-    order_data = await state.get_data()
     # <-- ИЗМЕНЕНО: Вызываем обновленную функцию без 'bot'
     result = await process_and_save_order(
-        order_data=order_data, user_id=callback.from_user.id, username=callback.from_user.username,
-        first_name=callback.from_user.first_name
+        order_data=order_data, user_id=user_id, username=callback.from_user.username,
+        first_name=callback.from_user.first_name, idempotency_key=checkout_token
     )
 
     if result:
+        await idempotency_guard.complete(CHECKOUT_ACTION, user_id, checkout_token,
+                                         {"order_id": result['order_record']['order_id']})
+    else:
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
+
+    if result:
+        # Уведомления бариста и реферера уже в outbox вместе с заказом — отвечаем сразу
         order_record = result['order_record']
-        notification_info = result['notification_info']
         order_id = order_record['order_id']
         total_price = order_record['total_price']
 
-        # <-- ИЗМЕНЕНО: Логика отправки сообщений теперь здесь, в хендлере
-        try:
-            # 1. Уведомление для бариста
-            barista_text = format_barista_notification(order_record, callback.from_user.username,
-                                                       callback.from_user.first_name)
-            await callback.bot.send_message(chat_id=config.BARISTA_ID, text=barista_text, parse_mode="HTML")
-
-            # 2. Уведомление для реферера, если он есть
-            if 'referrer_id' in notification_info:
-                referrer_id = notification_info['referrer_id']
-                await callback.bot.send_message(
-                    chat_id=referrer_id,
-                    text="🎉 Вам начислен бонус! За то, что ваш друг сделал первый заказ, вы получили один бесплатный кофе."
-                )
-        except Exception as e:
-            logger.error(f"Failed to send notifications for order #{order_id}: {e}")
-            # Отправляем запасное уведомление, если основное не удалось
-            await callback.bot.send_message(chat_id=config.BARISTA_ID,
-                                            text=f"❗️Новый заказ №{order_id}. Не удалось загрузить детали.")
-
         # Обновляем сообщение для пользователя
         await state.set_state(Order.ready)
         await state.update_data(last_order_id=order_id)
@@ -387,18 +457,94 @@ async def confirm_create_order(callback: CallbackQuery, state: FSMContext):
         free_coffees = data.get('free_coffees_count', 0)
         await callback.message.edit_caption(
             caption="❌ Произошла ошибка при создании заказа.\n\nПожалуйста, попробуйте подтвердить его еще раз.",
-            reply_markup=get_loyalty_ikb(free_coffees)
+            reply_markup=get_loyalty_ikb(free_coffees, epay_service.available)
         )
 
 
-@router.callback_query(Order.confirm, F.data == "pay_order")
-async def pay_order_handler(callback: CallbackQuery, state: FSMContext):
+PAY_AT_COUNTER_TEXT = ("💳 Онлайн-оплата сейчас недоступна. Нажмите «✅Подтвердить» — "
+                       "заказ будет оформлен с оплатой на месте.")
+
+
+async def offer_pay_at_counter(callback: CallbackQuery, order_data: dict) -> None:
+    """Убирает кнопку онлайн-оплаты: заказ можно подтвердить с оплатой на месте."""
+    free_coffees = order_data.get('free_coffees_count', 0)
+    if order_data.get('use_free'):
+        free_coffees -= 1
+    try:
+        await callback.message.edit_reply_markup(reply_markup=get_loyalty_ikb(free_coffees, online_payment=False))
+    except Exception as e:
+        logger.warning(f"Не удалось убрать кнопку оплаты для {callback.from_user.id}: {e}")
+
+
+async def send_invoice_message(callback: CallbackQuery, state: FSMContext, payment_id: str,
+                               amount: int, payment_url: str) -> None:
+    """Отправляет пользователю ссылку на оплату и запоминает сообщение в FSM."""
+    payment_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Оплатить {amount} KZT", url=payment_url)]
+    ])
+    text = (
+        "Ваш счет на оплату готов.\n\n"
+        "Вот демоданные карт для проверки оплаты:\n"
+        "Номер карты           | Дата  | CVC\n"
+        "4405639704015096 | 01/27 | 321\n"
+        "5522042705066736 |	01/27 | 775"
+    )
+    sent_message = await callback.message.answer(text=text, reply_markup=payment_keyboard)
+    await state.update_data(payment_message_id=sent_message.message_id, payment_id=payment_id)
+
+
+async def resume_existing_payment(callback: CallbackQuery, state: FSMContext, checkout_token: str) -> None:
+    """
+    Платеж с ключом этой попытки уже есть (повторное нажатие после IDEMPOTENCY_RESULT_TTL):
+    вместо нового счета показываем состояние существующего.
+    """
+    user_id = callback.from_user.id
+    payment = await postgres_client.fetchrow(
+        "SELECT payment_id, amount, status, order_id, invoice_url FROM payments "
+        "WHERE idempotency_key = $1 AND user_id = $2",
+        checkout_token, user_id
+    )
+    if not payment:
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
+        await callback.message.answer("Произошла ошибка при создании счета. Пожалуйста, попробуйте позже.")
+        return
+
+    await idempotency_guard.complete(CHECKOUT_ACTION, user_id, checkout_token, {"payment_id": payment['payment_id']})
+    if payment['status'] in ('paid', 'processing'):
+        order_text = f" Заказ №{payment['order_id']}." if payment['order_id'] else ""
+        await callback.message.answer(f"✅ Этот заказ уже оплачен.{order_text}")
+    elif payment['status'] == 'pending' and payment['invoice_url']:
+        await send_invoice_message(callback, state, payment['payment_id'], payment['amount'], payment['invoice_url'])
+    elif payment['status'] == 'pending':
+        await callback.message.answer("⏳ Счет по этому заказу еще создается. Если ссылка не придет, попробуйте чуть позже.")
+    else:
+        # Счет по этой попытке недействителен — следующее нажатие создаст новый
+        await state.update_data(checkout_token=uuid.uuid4().hex)
+        await callback.message.answer("Предыдущий счет больше недействителен. Нажмите «Оплатить» еще раз.")
+
+
+@router.callback_query(Order.confirm, F.data == "pay_order", flags={"throttle": "checkout"})
+async def pay_order_handler(callback: CallbackQuery, state: FSMContext, bot_info: User):
     """
     Обрабатывает нажатие на кнопку "Оплатить".
     Сохраняет детали заказа в таблицу payments и инициирует оплату.
     """
     user_id = callback.from_user.id
     order_data = await state.get_data()
+    checkout_token = order_data.get('checkout_token') or f"msg{callback.message.message_id}"
+
+    # Шлюз деградировал: не ждем таймаутов, сразу предлагаем оплату на месте
+    if not epay_service.available:
+        await callback.answer(PAY_AT_COUNTER_TEXT, show_alert=True)
+        await offer_pay_at_counter(callback, order_data)
+        return
+
+    # Повторное нажатие: второй счет не создаем
+    acquired, previous = await idempotency_guard.acquire(CHECKOUT_ACTION, user_id, checkout_token)
+    if not acquired:
+        await answer_checkout_taken(callback, previous)
+        return
+
     amount = calculate_order_total(order_data)
 
     summary_parts = [f"Кофе: {order_data.get('type')}"]
@@ -417,38 +563,50 @@ async def pay_order_handler(callback: CallbackQuery, state: FSMContext):
     payment_id = f"{time_part:04d}{user_part:05d}{unique_part:06d}"
 
     try:
-        await postgres_client.insert("payments", {
-            "payment_id": payment_id, "user_id": user_id, "amount": amount,
-            "description": description,
-            "order_data": json.dumps(order_data, ensure_ascii=False)
-        })
+        # Уникальный idempotency_key: второй платеж на ту же попытку не появится даже при гонке процессов
+        inserted = await postgres_client.fetchval(
+            """
+            INSERT INTO payments (payment_id, user_id, amount, description, order_data, idempotency_key)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING payment_id
+            """,
+            payment_id, user_id, amount, description, json.dumps(order_data, ensure_ascii=False), checkout_token
+        )
+        if not inserted:
+            logger.warning(f"Повторное создание счета для {user_id} с ключом {checkout_token} отклонено.")
+            await resume_existing_payment(callback, state, checkout_token)
+            return
         logger.info(f"Создана запись о платеже #{payment_id} для пользователя {user_id} с деталями заказа.")
     except Exception as e:
         logger.error(f"Не удалось создать запись о платеже для {user_id}: {e}", exc_info=True)
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
         await callback.message.answer("Произошла ошибка при создании счета. Пожалуйста, попробуйте позже.")
         return
 
-    payment_url = await epay_service.create_invoice(
-        amount=amount, payment_id=payment_id, description=description, bot=callback.bot
-    )
+    try:
+        payment_url = await epay_service.create_invoice(
+            amount=amount, payment_id=payment_id, description=description, bot_username=bot_info.username
+        )
+    except EpayUnavailableError as e:
+        logger.warning(f"Счет #{payment_id} не создан, шлюз недоступен: {e}")
+        await postgres_client.update("payments", {"status": "error"}, "payment_id = $1", [payment_id])
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
+        await state.update_data(checkout_token=uuid.uuid4().hex)
+        await callback.message.answer(PAY_AT_COUNTER_TEXT)
+        await offer_pay_at_counter(callback, order_data)
+        return
 
     if payment_url:
-        payment_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"Оплатить {amount} KZT", url=payment_url)]
-        ])
-        text = (
-            "Ваш счет на оплату готов.\n\n"
-            "Вот демоданные карт для проверки оплаты:\n"
-            "Номер карты           | Дата  | CVC\n"
-            "4405639704015096 | 01/27 | 321\n"
-            "5522042705066736 |	01/27 | 775"
-        )
-        sent_message = await callback.message.answer(
-            text=text, reply_markup=payment_keyboard
-        )
-        await state.update_data(payment_message_id=sent_message.message_id)
+        # Ссылка сохраняется, чтобы повторное нажатие могло показать тот же счет
+        await postgres_client.update("payments", {"invoice_url": payment_url}, "payment_id = $1", [payment_id])
+        await send_invoice_message(callback, state, payment_id, amount, payment_url)
+        await idempotency_guard.complete(CHECKOUT_ACTION, user_id, checkout_token, {"payment_id": payment_id})
     else:
         await postgres_client.update("payments", {"status": "error"}, "payment_id = $1", [payment_id])
+        # Ключ этой попытки уже занят платежом с ошибкой — для повтора выдаем новый
+        await idempotency_guard.release(CHECKOUT_ACTION, user_id, checkout_token)
+        await state.update_data(checkout_token=uuid.uuid4().hex)
         await callback.message.answer("Не удалось создать ссылку на оплату. Попробуйте позже.")
 
 
@@ -465,7 +623,7 @@ async def confirm_use_free_coffee(callback: CallbackQuery, state: FSMContext):
         summary_text = await build_order_summary(state)
         await callback.message.edit_caption(
             caption=f"✅ Кофе будет бесплатным!\n\n{summary_text}\n\nОсталось подтвердить заказ.",
-            reply_markup=get_loyalty_ikb(free_coffees - 1)
+            reply_markup=get_loyalty_ikb(free_coffees - 1, epay_service.available)
         )
     else:
         await callback.answer("У вас нет бесплатных кофе для списания.", show_alert=True)
@@ -503,10 +661,14 @@ async def cancel_order_handler(callback: CallbackQuery, state: FSMContext):
             ]))
             return
 
-        await callback.answer("Заказ отменяется...")
         order_to_cancel = await postgres_client.fetchrow("SELECT is_free FROM orders WHERE order_id = $1", order_id)
-        await postgres_client.update(table="orders", data={"status": "cancelled"}, where="order_id = $1",
-                                     params=[order_id])
+        cancelled, current_status = await postgres_client.update_order_status(order_id, "cancelled")
+        if not cancelled:
+            # Заказ уже выдан или отменен: бонус не возвращаем второй раз
+            await callback.answer("❌ Этот заказ уже нельзя отменить.", show_alert=True)
+            logger.info(f"Order #{order_id} cancel ignored: status '{current_status}'.")
+            return
+        await callback.answer("Заказ отменяется...")
         logger.info(f"Order #{order_id} was cancelled by user.")
 
         if order_to_cancel and order_to_cancel['is_free']:
@@ -537,20 +699,33 @@ async def order_ready(callback: CallbackQuery, state: FSMContext):
             await start_msg(callback.message)
             return
 
-        await callback.answer("Отлично, бариста уведомлен!", show_alert=False)
         order_record = await postgres_client.fetchrow("SELECT * FROM orders WHERE order_id = $1", order_id)
         if not order_record:
+            await callback.answer("Отлично, бариста уведомлен!", show_alert=False)
             logger.warning(
                 f"Пользователь {callback.from_user.id} нажал 'Я подошел', но заказ #{order_id} не найден в БД.")
             await callback.message.delete()
             await start_msg(callback.message)
             return
 
-        await postgres_client.update(table="orders", data={"status": "arrived"}, where="order_id = $1",
-                                     params=[order_id])
-        logger.info(f"Order #{order_id} status changed to 'arrived'.")
-        await ws_manager.broadcast(
-            {"type": "status_update", "payload": {"order_id": order_id, "new_status": "arrived"}})
+        arrived, current_status = await postgres_client.update_order_status(order_id, "arrived")
+        if arrived:
+            logger.info(f"Order #{order_id} status changed to 'arrived'.")
+            await ws_manager.broadcast(
+                {"type": "status_update", "payload": {"order_id": order_id, "new_status": "arrived"}})
+        elif current_status == "arrived":
+            await callback.answer("Бариста уже знает, что вы подошли 👍", show_alert=False)
+            return
+        elif current_status in ("completed", "cancelled"):
+            await callback.answer("Этот заказ уже закрыт.", show_alert=True)
+            logger.info(f"Order #{order_id}: 'Я подошел' ignored, status '{current_status}'.")
+            await callback.message.delete()
+            await start_msg(callback.message)
+            return
+        else:
+            # Напиток еще готовится: статус не трогаем, но бариста должен знать, что клиент у входа
+            logger.info(f"Order #{order_id}: client arrived while status is '{current_status}'.")
+        await callback.answer("Отлично, бариста уведомлен!", show_alert=False)
 
         order_details_parts = [
             f"☕️ Напиток: {order_record.get('type')}",
@@ -573,7 +748,8 @@ async def order_ready(callback: CallbackQuery, state: FSMContext):
                           f"@{callback.from_user.username}\n\n"
                           f"{order_details}\n\n"
                           f"{payment_info}")
-        await callback.bot.send_message(config.BARISTA_ID, text_for_admin, parse_mode="HTML")
+        with send_priority(Priority.NOTIFICATION):
+            await callback.bot.send_message(config.BARISTA_ID, text_for_admin, parse_mode="HTML")
         await callback.message.delete()
         await start_msg(callback.message)
     except Exception as e:
@@ -591,11 +767,12 @@ async def order_ready(callback: CallbackQuery, state: FSMContext):
 async def buy_bot_handler(callback: CallbackQuery):
     await callback.answer(text="Ваша заявка принята, в ближайшее время наш менеджер с Вами свяжется.", show_alert=True)
     text = f"❗️❗️❗️ Клиент @{callback.from_user.username} хочет купить бота. Свяжись с ним НЕМЕДЛЕННО!!!"
-    await callback.bot.send_message(chat_id=config.ADMIN_CHAT_ID, text=text)
+    with send_priority(Priority.NOTIFICATION):
+        await callback.bot.send_message(chat_id=config.ADMIN_CHAT_ID, text=text)
 
 
-@router.callback_query(F.data == "test_buy")
-async def test_buy_handler(callback: CallbackQuery):
+@router.callback_query(F.data == "test_buy", flags={"throttle": "checkout"})
+async def test_buy_handler(callback: CallbackQuery, bot_info: User):
     user_id = callback.from_user.id
     amount = 150
     description = f"Тестовая покупка от пользователя {user_id}"[:60]
@@ -610,9 +787,13 @@ async def test_buy_handler(callback: CallbackQuery):
         logger.error(f"Не удалось создать запись о тестовом платеже для {user_id}: {e}", exc_info=True)
         await callback.message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
         return
-    payment_url = await epay_service.create_invoice(
-        amount=amount, payment_id=payment_id, description=description, bot=callback.bot
-    )
+    try:
+        payment_url = await epay_service.create_invoice(
+            amount=amount, payment_id=payment_id, description=description, bot_username=bot_info.username
+        )
+    except EpayUnavailableError as e:
+        logger.warning(f"Тестовый счет #{payment_id} не создан, шлюз недоступен: {e}")
+        payment_url = None
     if payment_url:
         payment_keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"Оплатить {amount} KZT", url=payment_url)]
@@ -31,6 +31,10 @@ analytics_menu_ikb = InlineKeyboardMarkup(inline_keyboard=[
     [
         InlineKeyboardButton(text="🎁 Бесплатные заказы", callback_data="analytics_free_coffees"),
     ],
+    [
+        InlineKeyboardButton(text="⏱ Время приготовления", callback_data="analytics_prep_time"),
+        InlineKeyboardButton(text="🕐 По часам", callback_data="analytics_prep_hours")
+    ],
     [
         InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel_back")
     ]
@@ -44,12 +48,63 @@ broadcast_menu_ikb = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel_back")]
 ])
 
+# Выбор аудитории рассылки
+broadcast_segment_ikb = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="👥 Все активные", callback_data="broadcast_segment_all")],
+    [InlineKeyboardButton(text="🛒 Заказывали недавно", callback_data="broadcast_segment_recent")],
+    [InlineKeyboardButton(text="🆕 Еще не заказывали", callback_data="broadcast_segment_never")],
+    [InlineKeyboardButton(text="🎁 Есть бесплатные кофе", callback_data="broadcast_segment_free_coffees")],
+    [InlineKeyboardButton(text="☕ Любимый напиток", callback_data="broadcast_segment_drink")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_confirm_no")]
+])
+
+# Период для сегмента "заказывали недавно"
+broadcast_recent_days_ikb = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="7 дней", callback_data="broadcast_recent_7"),
+        InlineKeyboardButton(text="30 дней", callback_data="broadcast_recent_30"),
+        InlineKeyboardButton(text="90 дней", callback_data="broadcast_recent_90")
+    ],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="broadcast_start")]
+])
+
+
+# Выбор напитка для сегмента "любимый напиток"
+def get_broadcast_drinks_ikb(drinks: list[str]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *[[InlineKeyboardButton(text=drink, callback_data=f"broadcast_drink_{drink}")] for drink in drinks],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="broadcast_start")]
+    ])
+
 # Клавиатура подтверждения рассылки
 broadcast_confirm_ikb = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="✅ ДА, Я УВЕРЕН", callback_data="broadcast_confirm_yes")],
     [InlineKeyboardButton(text="❌ НЕТ, ОТМЕНА", callback_data="broadcast_confirm_no")]
 ])
 
+
+
+# Управление идущей рассылкой (прикрепляется к сообщению с прогрессом)
+def broadcast_controls_ikb(run_id: int, status: str) -> InlineKeyboardMarkup:
+    if status == "paused":
+        first = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_resume_{run_id}")
+    else:
+        first = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_pause_{run_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [first, InlineKeyboardButton(text="⛔️ Отменить", callback_data=f"broadcast_cancel_{run_id}")]
+    ])
+
+
+# Меню рассылки с кнопками управления текущим запуском, если он есть
+def get_broadcast_menu_ikb(run_id: int = None, status: str = None) -> InlineKeyboardMarkup:
+    if run_id is None:
+        return broadcast_menu_ikb
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *broadcast_controls_ikb(run_id, status).inline_keyboard,
+        [InlineKeyboardButton(text="✍️ Изменить текст/фото", callback_data="broadcast_change_text")],
+        [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel_back")]
+    ])
+
 # --- МЕНЮ ЭКСПОРТА ЗАКАЗОВ ---
 # Добавлена правильная кнопка "Назад"
 get_report_ikb = InlineKeyboardMarkup(
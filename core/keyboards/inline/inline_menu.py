@@ -100,12 +100,14 @@ ready_cofe_ikb = InlineKeyboardMarkup(inline_keyboard=[
 # Эта функция создает динамическую клавиатуру. Она позволяет пользователю
 # подтвердить или изменить заказ. Если у пользователя есть бесплатные
 # чашки кофе, добавляется кнопка для их использования.
-def get_loyalty_ikb(free_coffees: int) -> InlineKeyboardMarkup:
+def get_loyalty_ikb(free_coffees: int, online_payment: bool = True) -> InlineKeyboardMarkup:
+    # online_payment=False — шлюз недоступен, кнопку "Оплатить" не показываем (оплата на месте)
     kb = [
         [InlineKeyboardButton(text="✅Подтвердить", callback_data="create_order")],
         [InlineKeyboardButton(text="🖊Изменить", callback_data="loyal_program")],
-        [InlineKeyboardButton(text="💰Оплатить", callback_data="pay_order")]
     ]
+    if online_payment:
+        kb.append([InlineKeyboardButton(text="💰Оплатить", callback_data="pay_order")])
     if free_coffees > 0:
         kb.append(
             [InlineKeyboardButton(text=f"☕ Списать бесплатный кофе ({free_coffees})", callback_data="use_free_coffee")])
@@ -1,15 +1,305 @@
 # middlewares.py
-from aiogram.types import TelegramObject
+import copy
+import re
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject, CallbackQuery, Update
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
-# from core.database.database import Database
-#
-#
-# class DbMiddleware(BaseMiddleware):
-#     def __init__(self, db: Database):
-#         self.db = db
-#         super().__init__()
-#
-#     async def __call__(self, handler, event: TelegramObject, data: dict):
-#         # Добавляем объект db в data
-#         data['db'] = self.db
-#         return await handler(event, data)
+from loguru import logger
+from redis.asyncio.client import Redis
+
+from config import config
+
+from core.utils.metrics import (
+    DEPENDENCIES, UPDATE_LATENCY, UPDATE_ERRORS, DEPENDENCY_LATENCY,
+    start_update_timings, finish_update_timings, set_update_handler, track_dependency, THROTTLED
+)
+
+_NUMBER = re.compile(r"\d+")
+
+
+def callback_pattern(data: str) -> str:
+    """Шаблон callback_data без идентификаторов: broadcast_pause_15 -> broadcast_pause_#."""
+    return _NUMBER.sub("#", data)[:64]
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Outer-middleware апдейтов: замеряет полное время обработки и ошибки
+    и раскладывает его на время в БД, Redis и Telegram API.
+    Имя хэндлера сообщает HandlerLabelMiddleware, который срабатывает уже после роутинга.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        timings, token = start_update_timings()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            UPDATE_ERRORS.labels(timings["handler"], timings["pattern"], type(e).__name__).inc()
+            raise
+        finally:
+            UPDATE_LATENCY.labels(timings["handler"], timings["pattern"]).observe(time.perf_counter() - started)
+            for dependency in DEPENDENCIES:
+                DEPENDENCY_LATENCY.labels(timings["handler"], dependency).observe(timings[dependency])
+            finish_update_timings(token)
+
+
+class HandlerLabelMiddleware(BaseMiddleware):
+    """Inner-middleware: записывает имя выбранного хэндлера и шаблон callback_data."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object: HandlerObject = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        pattern = callback_pattern(event.data) if isinstance(event, CallbackQuery) and event.data else ""
+        set_update_handler(name, pattern)
+        return await handler(event, data)
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Request-middleware сессии бота: время запросов к Telegram API (без ожидания в планировщике)."""
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with track_dependency("telegram"):
+            return await make_request(bot, method)
+
+
+class CachedFSMContext(FSMContext):
+    """
+    FSMContext в пределах одного апдейта: данные читаются из хранилища не более
+    одного раза, изменения состояния и данных копятся в памяти и записываются
+    одним pipeline в конце апдейта (см. FSMCacheMiddleware).
+    После записи контекст работает напрямую с хранилищем — на случай,
+    если его использует задача, пережившая апдейт.
+    """
+
+    def __init__(self, context: FSMContext, raw_state: Optional[str]):
+        super().__init__(storage=context.storage, key=context.key)
+        self._state = raw_state
+        self._data: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._data_dirty = False
+        self._flushed = False
+
+    async def _load_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        if self._flushed:
+            return await super().set_state(state)
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> Optional[str]:
+        if self._flushed:
+            return await super().get_state()
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        if self._flushed:
+            return await super().set_data(data)
+        self._data = dict(data)
+        self._data_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        if self._flushed:
+            return await super().get_data()
+        return copy.copy(await self._load_data())
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        if self._flushed:
+            return await super().get_value(key, default)
+        return copy.copy((await self._load_data()).get(key, default))
+
+    async def update_data(self, data: Optional[Mapping[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if self._flushed:
+            return await super().update_data(data, **kwargs)
+        current = await self._load_data()
+        if data:
+            current.update(data)
+        current.update(kwargs)
+        self._data_dirty = True
+        return current.copy()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения: для Redis — одним pipeline без транзакции."""
+        if self._flushed:
+            return
+        self._flushed = True
+        if not (self._state_dirty or self._data_dirty):
+            return
+
+        storage = self.storage
+        if not isinstance(storage, RedisStorage):
+            if self._state_dirty:
+                await storage.set_state(key=self.key, state=self._state)
+            if self._data_dirty:
+                await storage.set_data(key=self.key, data=self._data)
+            return
+
+        # Те же ключи, TTL и сериализация, что и в RedisStorage.set_state/set_data
+        async with storage.redis.pipeline(transaction=False) as pipe:
+            if self._state_dirty:
+                state_key = storage.key_builder.build(self.key, "state")
+                if self._state is None:
+                    pipe.delete(state_key)
+                else:
+                    pipe.set(state_key, self._state, ex=storage.state_ttl)
+            if self._data_dirty:
+                data_key = storage.key_builder.build(self.key, "data")
+                if not self._data:
+                    pipe.delete(data_key)
+                else:
+                    pipe.set(data_key, storage.json_dumps(self._data), ex=storage.data_ttl)
+            with track_dependency("redis"):
+                await pipe.execute()
+
+
+class FSMCacheMiddleware(BaseMiddleware):
+    """
+    Outer-middleware апдейтов: подменяет FSMContext на CachedFSMContext и
+    сбрасывает изменения в хранилище после хэндлера (в том числе при ошибке,
+    как это происходило бы без кэша).
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        context: Optional[FSMContext] = data.get("state")
+        if context is None:
+            return await handler(event, data)
+        cached = CachedFSMContext(context, data.get("raw_state"))
+        data["state"] = cached
+        try:
+            return await handler(event, data)
+        finally:
+            await cached.flush()
+
+
+# Бюджеты хэндлеров: (запросов, окно в секундах) на пользователя.
+# Хэндлер выбирает бюджет флагом: @router.callback_query(..., flags={"throttle": "partners"});
+# все остальные делят общий бюджет "default".
+THROTTLE_BUDGETS = {
+    "default": (20, 10),
+    "start": (3, 10),       # /start: чтение из БД и отправка картинки
+    "partners": (3, 10),    # партнерская программа: чтение/вставка в БД
+    "checkout": (5, 30),    # оформление и оплата заказа
+}
+
+# Скользящее окно на sorted set: удаляем старые отметки, считаем, добавляем текущую.
+# Отклоненные запросы не записываются, поэтому окно освобождается само.
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+if redis.call('ZCARD', key) >= limit then
+    return 0
+end
+redis.call('ZADD', key, now, ARGV[4])
+redis.call('PEXPIRE', key, window)
+return 1
+"""
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Inner-middleware сообщений и callback: ограничивает частоту запросов пользователя
+    скользящим окном в Redis (одна команда EVALSHA на апдейт). Лишний callback
+    получает короткий callback.answer, лишнее сообщение молча отбрасывается —
+    до хэндлера с его БД и Telegram-вызовами дело не доходит.
+    Админ и бариста не ограничиваются. При недоступности Redis запросы пропускаются.
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.script = redis.register_script(SLIDING_WINDOW_SCRIPT)
+        self.exempt_ids = {config.ADMIN_CHAT_ID, config.BARISTA_ID}
+
+    async def _allowed(self, budget: str, user_id: int) -> bool:
+        limit, window = THROTTLE_BUDGETS.get(budget, THROTTLE_BUDGETS["default"])
+        now_ms = int(time.time() * 1000)
+        try:
+            return bool(await self.script(
+                keys=[f"throttle:{budget}:{user_id}"],
+                args=[now_ms, window * 1000, limit, f"{now_ms}-{uuid.uuid4().hex[:8]}"]
+            ))
+        except Exception as e:
+            logger.warning(f"Throttling: Redis недоступен ({e}), пропускаем запрос {user_id}")
+            return True
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt_ids:
+            return await handler(event, data)
+
+        budget = get_flag(data, "throttle", default="default")
+        if await self._allowed(budget, user.id):
+            return await handler(event, data)
+
+        THROTTLED.labels(budget).inc()
+        logger.info(f"Throttling: пользователь {user.id} превысил бюджет '{budget}'")
+        if isinstance(event, CallbackQuery):
+            await event.answer("⏳ Слишком часто. Подождите пару секунд.")
+        return None
+
+
+def setup_throttling(dp: Dispatcher, redis: Redis) -> None:
+    """Подключает анти-флуд для сообщений и callback (для всех вложенных роутеров)."""
+    dp.message.middleware(ThrottlingMiddleware(redis))
+    dp.callback_query.middleware(ThrottlingMiddleware(redis))
+
+
+def setup_fsm_cache(dp: Dispatcher) -> None:
+    """Подключает кэш данных FSM на время апдейта (после FSMContextMiddleware диспетчера)."""
+    dp.update.outer_middleware(FSMCacheMiddleware())
+
+
+def setup_metrics(dp: Dispatcher, bot: Bot) -> None:
+    """
+    Подключает сбор метрик. Вызывать после setup_send_scheduler: middleware сессии,
+    зарегистрированный позже, оказывается внутри планировщика.
+    """
+    dp.update.outer_middleware(MetricsMiddleware())
+    # Inner-middleware диспетчера применяются и к хэндлерам вложенных роутеров
+    dp.message.middleware(HandlerLabelMiddleware())
+    dp.callback_query.middleware(HandlerLabelMiddleware())
+    bot.session.middleware(TelegramTimingMiddleware())
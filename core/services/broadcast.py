@@ -0,0 +1,420 @@
+import asyncio
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from asyncpg import Record
+from loguru import logger
+
+from config import config
+from core.utils.database import PostgresClient
+from core.services.send_scheduler import send_priority, Priority
+from core.keyboards.inline.admin_menu import broadcast_controls_ikb
+
+# Результаты отправки одному получателю
+SENT = "sent"
+BLOCKED = "blocked"      # бот заблокирован / чат удален — пользователя деактивируем
+TRANSIENT = "transient"  # сеть, 5xx, исчерпанные повторы после 429
+FAILED = "failed"        # прочие постоянные ошибки (не деактивируем)
+# Строка broadcast_deliveries пишется до отправки: если воркер упал, не успев
+# записать результат, получатель остается "sending" и повторно не получает сообщение
+DELIVERY_SENDING = "sending"
+
+OUTCOME_COLUMNS = {
+    SENT: "sent_count", BLOCKED: "blocked_count", TRANSIENT: "transient_count", FAILED: "failed_count",
+}
+
+# Статусы рассылки (broadcast_runs.status)
+RUN_RUNNING = "running"
+RUN_PAUSED = "paused"
+RUN_CANCELLED = "cancelled"
+RUN_COMPLETED = "completed"
+ACTIVE_RUN_STATUSES = (RUN_RUNNING, RUN_PAUSED)
+
+# Результат попытки забрать шард (BroadcastEngine.claim / run)
+SHARD_CLAIMED = "claimed"
+SHARD_BUSY = "busy"          # шард "running" и его heartbeat свежий — возможно, воркер упал недавно
+SHARD_FINISHED = "finished"  # шард уже выполнен
+
+# Сегменты аудитории (broadcast_runs.segment / segment_param)
+SEGMENT_ALL = "all"
+SEGMENT_RECENT = "recent"              # делали заказ за последние N дней (param = N)
+SEGMENT_NEVER_ORDERED = "never"        # ни одного заказа
+SEGMENT_FREE_COFFEES = "free_coffees"  # есть неиспользованные бесплатные кофе
+SEGMENT_DRINK = "drink"                # любимый напиток (чаще всего заказываемый) = param
+
+
+def classify_error(error: Exception) -> str:
+    if isinstance(error, TelegramForbiddenError):
+        return BLOCKED
+    if isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower():
+        return BLOCKED
+    if isinstance(error, (TelegramRetryAfter, TelegramNetworkError, TelegramServerError)):
+        return TRANSIENT
+    return FAILED
+
+
+# =================================================================
+#               СЕГМЕНТЫ АУДИТОРИИ
+# =================================================================
+
+def segment_filter(segment: str, param: Optional[str], first_arg: int) -> tuple[str, list]:
+    """
+    Возвращает условие на пользователя `u` для сегмента и его аргументы.
+    Нумерация плейсхолдеров начинается с first_arg, чтобы условие можно было
+    подставить в запрос с уже занятыми $1..$n.
+    Все условия — полусоединения, которые Postgres выполняет по индексам orders/referral_program.
+    """
+    n = first_arg
+    if segment == SEGMENT_RECENT:
+        return (f"EXISTS (SELECT 1 FROM orders o WHERE o.user_id = u.telegram_id "
+                f"AND o.created_at >= NOW() - make_interval(days => ${n}))"), [int(param)]
+    if segment == SEGMENT_NEVER_ORDERED:
+        return "NOT EXISTS (SELECT 1 FROM orders o WHERE o.user_id = u.telegram_id)", []
+    if segment == SEGMENT_FREE_COFFEES:
+        return ("EXISTS (SELECT 1 FROM referral_program r "
+                "WHERE r.user_id = u.telegram_id AND r.free_coffees > 0)"), []
+    if segment == SEGMENT_DRINK:
+        # Кандидаты — только те, кто хоть раз заказывал напиток; среди них
+        # оставляем тех, у кого он самый частый (при равенстве — заказанный последним)
+        return (f"""u.telegram_id IN (
+                SELECT f.user_id FROM (
+                    SELECT o.user_id, o."type",
+                           ROW_NUMBER() OVER (PARTITION BY o.user_id
+                                              ORDER BY COUNT(*) DESC, MAX(o.created_at) DESC) AS rn
+                    FROM orders o
+                    WHERE o.user_id IN (SELECT user_id FROM orders WHERE "type" = ${n})
+                    GROUP BY o.user_id, o."type"
+                ) f
+                WHERE f.rn = 1 AND f."type" = ${n}
+            )"""), [param]
+    return "TRUE", []
+
+
+def segment_title(segment: str, param: Optional[str]) -> str:
+    titles = {
+        SEGMENT_ALL: "все активные пользователи",
+        SEGMENT_RECENT: f"заказывали за последние {param} дн.",
+        SEGMENT_NEVER_ORDERED: "еще не делали заказов",
+        SEGMENT_FREE_COFFEES: "есть неиспользованные бесплатные кофе",
+        SEGMENT_DRINK: f"любимый напиток — {param}",
+    }
+    return titles.get(segment, segment)
+
+
+async def count_segment_audience(db: PostgresClient, segment: str, param: Optional[str]) -> int:
+    condition, args = segment_filter(segment, param, 1)
+    return await db.fetchval(f"SELECT COUNT(*) FROM users u WHERE u.is_active = TRUE AND {condition}", *args)
+
+
+# =================================================================
+#               СОЗДАНИЕ РАССЫЛКИ И ПРОГРЕСС
+# =================================================================
+
+async def create_broadcast_run(db: PostgresClient, admin_id: int, message_text: Optional[str],
+                               photo_id: Optional[str], segment: str = SEGMENT_ALL,
+                               segment_param: Optional[str] = None) -> int:
+    """
+    Создает запись broadcast_runs и делит пользователей сегмента на BROADCAST_SHARDS
+    диапазонов telegram_id примерно равного размера (ntile).
+    """
+    condition, args = segment_filter(segment, segment_param, 3)
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            run_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_runs (admin_id, message_text, photo_id, segment, segment_param)
+                VALUES ($1, $2, $3, $4, $5) RETURNING id
+                """,
+                admin_id, message_text, photo_id, segment, segment_param
+            )
+            await conn.execute(
+                f"""
+                INSERT INTO broadcast_shards (run_id, shard_no, cursor, range_end)
+                SELECT $1, shard, MIN(telegram_id) - 1, MAX(telegram_id)
+                FROM (
+                    SELECT u.telegram_id, ntile($2) OVER (ORDER BY u.telegram_id) AS shard
+                    FROM users u WHERE u.is_active = TRUE AND {condition}
+                ) s
+                GROUP BY shard
+                """,
+                run_id, config.BROADCAST_SHARDS, *args
+            )
+    logger.info(f"Создана рассылка #{run_id}")
+    return run_id
+
+
+async def get_run_summary(db: PostgresClient, run_id: int) -> Optional[Record]:
+    return await db.fetchrow(
+        """
+        SELECT r.id, r.admin_id, r.status, r.progress_message_id, r.created_at, r.segment, r.segment_param,
+               COALESCE(SUM(s.sent_count), 0) AS sent_count,
+               COALESCE(SUM(s.blocked_count), 0) AS blocked_count,
+               COALESCE(SUM(s.transient_count), 0) AS transient_count,
+               COALESCE(SUM(s.failed_count), 0) AS failed_count,
+               COUNT(s.shard_no) FILTER (WHERE s.status = 'done') AS shards_done,
+               COUNT(s.shard_no) AS shards_total
+        FROM broadcast_runs r
+        LEFT JOIN broadcast_shards s ON s.run_id = r.id
+        WHERE r.id = $1
+        GROUP BY r.id
+        """,
+        run_id
+    )
+
+
+def progress_text(summary: Record) -> str:
+    headers = {
+        RUN_RUNNING: "🚀 Рассылка идет...",
+        RUN_PAUSED: "⏸ Рассылка на паузе",
+        RUN_CANCELLED: "⛔️ Рассылка отменена",
+        RUN_COMPLETED: "🏁 Рассылка завершена!",
+    }
+    processed = (summary['sent_count'] + summary['blocked_count']
+                 + summary['transient_count'] + summary['failed_count'])
+    return (f"{headers.get(summary['status'], summary['status'])} (#{summary['id']})\n"
+            f"Аудитория: {segment_title(summary['segment'], summary['segment_param'])}\n"
+            f"Обработано: <code>{processed}</code>, частей: <code>{summary['shards_done']}/{summary['shards_total']}</code>\n"
+            f"✅ Успешно: <code>{summary['sent_count']}</code>\n"
+            f"🚫 Заблокировали бота: <code>{summary['blocked_count']}</code>\n"
+            f"⚠️ Временные ошибки: <code>{summary['transient_count']}</code>\n"
+            f"❌ Прочие ошибки: <code>{summary['failed_count']}</code>")
+
+
+async def report_progress(bot: Bot, db: PostgresClient, run_id: int) -> None:
+    """Обновляет сообщение с прогрессом рассылки у админа (или отправляет его)."""
+    try:
+        summary = await get_run_summary(db, run_id)
+        if not summary:
+            return
+        text = progress_text(summary)
+        markup = broadcast_controls_ikb(run_id, summary['status']) \
+            if summary['status'] in ACTIVE_RUN_STATUSES else None
+        with send_priority(Priority.NOTIFICATION):
+            if summary['progress_message_id']:
+                await bot.edit_message_text(text, chat_id=summary['admin_id'],
+                                            message_id=summary['progress_message_id'], reply_markup=markup,
+                                            parse_mode="HTML")
+            else:
+                message = await bot.send_message(summary['admin_id'], text, reply_markup=markup, parse_mode="HTML")
+                await db.execute("UPDATE broadcast_runs SET progress_message_id = $1 WHERE id = $2",
+                                 message.message_id, run_id)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.warning(f"Не удалось обновить прогресс рассылки #{run_id}: {e}")
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки #{run_id}: {e}")
+
+
+# =================================================================
+#               ОБРАБОТКА ОДНОЙ ЧАСТИ (ШАРДА) РАССЫЛКИ
+# =================================================================
+
+class BroadcastEngine:
+    """
+    Отправка одной части (шарда) рассылки — диапазона telegram_id.
+
+    Получатели читаются порциями по keyset-курсору шарда, отправка идет
+    параллельно (BROADCAST_CONCURRENCY), темп задает SendScheduler. Перед отправкой
+    получатель записывается в broadcast_deliveries со статусом "sending"; результаты
+    порции, курсор и счетчики шарда фиксируются одной транзакцией после порции.
+    Поэтому после рестарта воркера шард продолжает с того места, где остановился,
+    никому не отправляя сообщение повторно: отправка, прерванная падением, остается
+    "sending" и не повторяется (лучше не доставить одно сообщение, чем прислать два).
+    Между порциями проверяется статус рассылки (пауза/отмена).
+    """
+
+    def __init__(self, bot: Bot, db: PostgresClient, run_id: int, shard_no: int):
+        self.bot = bot
+        self.db = db
+        self.run_id = run_id
+        self.shard_no = shard_no
+        self.run_record: Optional[Record] = None
+        self.shard: Optional[Record] = None
+        self._semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+
+    async def claim(self) -> str:
+        """
+        Забирает шард в работу. Шард, который числится "running", но давно не
+        обновлялся, считается брошенным упавшим воркером и забирается повторно.
+        Возвращает SHARD_CLAIMED, SHARD_BUSY (heartbeat еще свежий) или SHARD_FINISHED.
+        """
+        self.shard = await self.db.fetchrow(
+            """
+            UPDATE broadcast_shards SET status = 'running', heartbeat_at = NOW()
+            WHERE run_id = $1 AND shard_no = $2
+              AND (status = 'pending'
+                   OR (status = 'running' AND heartbeat_at < NOW() - make_interval(secs => $3)))
+            RETURNING *
+            """,
+            self.run_id, self.shard_no, config.BROADCAST_SHARD_STALE_SECONDS
+        )
+        if not self.shard:
+            status = await self.db.fetchval(
+                "SELECT status FROM broadcast_shards WHERE run_id = $1 AND shard_no = $2",
+                self.run_id, self.shard_no
+            )
+            return SHARD_BUSY if status == 'running' else SHARD_FINISHED
+        self.run_record = await self.db.fetchrow("SELECT * FROM broadcast_runs WHERE id = $1", self.run_id)
+        return SHARD_CLAIMED
+
+    async def fetch_batch(self) -> list[int]:
+        condition, args = segment_filter(self.run_record['segment'], self.run_record['segment_param'], 5)
+        records = await self.db.fetch(
+            f"""
+            SELECT u.telegram_id FROM users u
+            WHERE u.is_active = TRUE AND u.telegram_id > $2 AND u.telegram_id <= $3
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_deliveries d WHERE d.run_id = $1 AND d.telegram_id = u.telegram_id
+              )
+              AND {condition}
+            ORDER BY u.telegram_id
+            LIMIT $4
+            """,
+            self.run_id, self.shard['cursor'], self.shard['range_end'], config.BROADCAST_BATCH_SIZE, *args
+        )
+        return [record['telegram_id'] for record in records]
+
+    async def _deliver(self, chat_id: int) -> str:
+        for attempt in range(config.BROADCAST_TRANSIENT_RETRIES + 1):
+            try:
+                if self.run_record['photo_id']:
+                    await self.bot.send_photo(chat_id, self.run_record['photo_id'], caption=self.run_record['message_text'])
+                else:
+                    await self.bot.send_message(chat_id, self.run_record['message_text'])
+                return SENT
+            except Exception as e:
+                outcome = classify_error(e)
+                if outcome != TRANSIENT or attempt == config.BROADCAST_TRANSIENT_RETRIES:
+                    if outcome != BLOCKED:
+                        logger.warning(f"Рассылка #{self.run_id}: не удалось отправить {chat_id} ({outcome}): {e}")
+                    return outcome
+                # 429, пережившая повторы SendScheduler: ждем столько, сколько просит Telegram
+                delay = e.retry_after if isinstance(e, TelegramRetryAfter) else 2 ** attempt
+                await asyncio.sleep(delay)
+        return TRANSIENT
+
+    async def _send_one(self, chat_id: int) -> Optional[str]:
+        """Отправляет сообщение одному получателю. None — получатель уже обработан другим воркером."""
+        async with self._semaphore:
+            reserved = await self.db.fetchval(
+                "INSERT INTO broadcast_deliveries (run_id, telegram_id, status) VALUES ($1, $2, $3) "
+                "ON CONFLICT DO NOTHING RETURNING telegram_id",
+                self.run_id, chat_id, DELIVERY_SENDING
+            )
+            if reserved is None:
+                return None
+            return await self._deliver(chat_id)
+
+    async def _send_batch(self, batch: list[int]) -> None:
+        outcomes = await asyncio.gather(*(self._send_one(chat_id) for chat_id in batch))
+        counts = {outcome: 0 for outcome in OUTCOME_COLUMNS}
+        delivered, statuses, blocked = [], [], []
+        for chat_id, outcome in zip(batch, outcomes):
+            if outcome is None:
+                continue
+            counts[outcome] += 1
+            delivered.append(chat_id)
+            statuses.append(outcome)
+            if outcome == BLOCKED:
+                blocked.append(chat_id)
+
+        # Результаты доставок, курсор и счетчики — одной транзакцией: они не расходятся после падения
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                if delivered:
+                    await conn.execute(
+                        """
+                        UPDATE broadcast_deliveries d SET status = r.status
+                        FROM unnest($2::bigint[], $3::varchar[]) AS r(telegram_id, status)
+                        WHERE d.run_id = $1 AND d.telegram_id = r.telegram_id
+                        """,
+                        self.run_id, delivered, statuses
+                    )
+                if blocked:
+                    await conn.execute(
+                        "UPDATE users SET is_active = FALSE WHERE telegram_id = ANY($1::bigint[])", blocked
+                    )
+                self.shard = await conn.fetchrow(
+                    """
+                    UPDATE broadcast_shards SET
+                        cursor = $3, heartbeat_at = NOW(),
+                        sent_count = sent_count + $4, blocked_count = blocked_count + $5,
+                        transient_count = transient_count + $6, failed_count = failed_count + $7
+                    WHERE run_id = $1 AND shard_no = $2
+                    RETURNING *
+                    """,
+                    self.run_id, self.shard_no, batch[-1],
+                    counts[SENT], counts[BLOCKED], counts[TRANSIENT], counts[FAILED]
+                )
+
+    async def _progress_loop(self) -> None:
+        while True:
+            await asyncio.sleep(config.BROADCAST_PROGRESS_INTERVAL)
+            # Порция может отправляться дольше BROADCAST_SHARD_STALE_SECONDS:
+            # heartbeat обновляется и между порциями, чтобы живой шард не сочли брошенным
+            await self.db.execute(
+                "UPDATE broadcast_shards SET heartbeat_at = NOW() "
+                "WHERE run_id = $1 AND shard_no = $2 AND status = 'running'",
+                self.run_id, self.shard_no
+            )
+            await report_progress(self.bot, self.db, self.run_id)
+
+    async def _finish(self) -> None:
+        """Помечает шард выполненным; последний шард закрывает всю рассылку."""
+        await self.db.execute(
+            "UPDATE broadcast_shards SET status = 'done', heartbeat_at = NOW() WHERE run_id = $1 AND shard_no = $2",
+            self.run_id, self.shard_no
+        )
+        completed = await self.db.fetchval(
+            """
+            UPDATE broadcast_runs SET status = 'completed'
+            WHERE id = $1 AND status = 'running'
+              AND NOT EXISTS (SELECT 1 FROM broadcast_shards WHERE run_id = $1 AND status <> 'done')
+            RETURNING id
+            """,
+            self.run_id
+        )
+        if completed:
+            logger.info(f"Рассылка #{self.run_id} завершена")
+
+    async def run(self) -> str:
+        """
+        Обрабатывает шард. Возвращает результат claim(): при SHARD_BUSY вызывающий
+        должен повторить попытку позже — если прежний воркер упал, шард станет
+        брошенным через BROADCAST_SHARD_STALE_SECONDS и будет забран.
+        """
+        claimed = await self.claim()
+        if claimed != SHARD_CLAIMED:
+            logger.info(f"Рассылка #{self.run_id}, шард {self.shard_no}: "
+                        f"{'уже обрабатывается' if claimed == SHARD_BUSY else 'уже выполнен'}")
+            return claimed
+
+        progress_task = asyncio.create_task(self._progress_loop())
+        try:
+            with send_priority(Priority.BROADCAST):
+                while True:
+                    status = await self.db.fetchval("SELECT status FROM broadcast_runs WHERE id = $1", self.run_id)
+                    if status != RUN_RUNNING:
+                        # Пауза или отмена: освобождаем шард, курсор сохранен
+                        await self.db.execute(
+                            "UPDATE broadcast_shards SET status = 'pending' WHERE run_id = $1 AND shard_no = $2",
+                            self.run_id, self.shard_no
+                        )
+                        logger.info(f"Рассылка #{self.run_id}, шард {self.shard_no} остановлен: {status}")
+                        break
+                    batch = await self.fetch_batch()
+                    if not batch:
+                        await self._finish()
+                        break
+                    await self._send_batch(batch)
+        finally:
+            progress_task.cancel()
+            try:
+                await progress_task
+            except asyncio.CancelledError:
+                pass
+        await report_progress(self.bot, self.db, self.run_id)
+        return SHARD_CLAIMED
@@ -1,17 +1,143 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
 import aiohttp
 from loguru import logger
-from aiogram import Bot
 
 from config import config
+from core.utils.circuit_breaker import CircuitBreaker
+from core.utils.metrics import EPAY_LATENCY, EPAY_REQUESTS, track_dependency
+
+
+# Статусы счета по данным шлюза (check_payment_status)
+STATUS_PAID = "paid"
+STATUS_FAILED = "failed"
+STATUS_PENDING = "pending"
+STATUS_NOT_FOUND = "not_found"
+
+_PAID_STATUSES = {"AUTH", "CHARGE"}
+_FAILED_STATUSES = {"CANCEL", "CANCEL_OLD", "REFUND", "REJECT", "FAILED"}
+
+
+class EpayUnavailableError(Exception):
+    """Шлюз недоступен: таймаут, сетевая ошибка, 5xx или открытый предохранитель."""
 
 
 class EpayService:
+    """
+    Клиент платежного шлюза Epay.
+    Одна долгоживущая aiohttp-сессия с пулом keep-alive соединений (создается в lifespan
+    приложения) и кэш OAuth-токена: срок жизни берется из expires_in, токен обновляется
+    заранее, а одновременные запросы ждут одно общее получение токена.
+    У каждого запроса свой таймаут, а предохранитель (CircuitBreaker) при деградации
+    шлюза сразу отклоняет запросы с EpayUnavailableError, не дожидаясь таймаутов.
+    """
+
     def __init__(self):
         self.token = None
+        self.token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.breaker = CircuitBreaker("epay", config.EPAY_CB_FAILURE_THRESHOLD, config.EPAY_CB_RECOVERY_TIMEOUT)
+
+    async def start(self) -> None:
+        """Создает сессию с пулом соединений (вызывается при старте приложения)."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.EPAY_POOL_SIZE,
+                ttl_dns_cache=300,
+                keepalive_timeout=config.EPAY_KEEPALIVE_TIMEOUT
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            logger.info("✅ Epay HTTP session started")
+
+    async def close(self) -> None:
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Вне lifespan (Celery, скрипты) сессия создается при первом запросе
+        if self.session is None or self.session.closed:
+            await self.start()
+        return self.session
+
+    @property
+    def available(self) -> bool:
+        """False, пока предохранитель открыт: онлайн-оплату не предлагаем, сразу — оплата на месте."""
+        return self.breaker.available
+
+    async def _request(self, method: str, operation: str, url: str, timeout: float, **kwargs) -> tuple[int, str]:
+        """
+        Запрос к шлюзу с собственным таймаутом и учетом в предохранителе.
+        Сбоем считаются таймаут, сетевая ошибка и 5xx; любой другой ответ — признак
+        живого шлюза. Возвращает (статус, тело ответа) или бросает EpayUnavailableError.
+        """
+        if not self.breaker.allow_request():
+            EPAY_REQUESTS.labels(operation, "rejected").inc()
+            raise EpayUnavailableError(f"Epay недоступен, запрос {operation} не выполняется")
+
+        session = await self._get_session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout, connect=config.EPAY_CONNECT_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            with track_dependency("epay"):
+                async with session.request(method, url, timeout=client_timeout, **kwargs) as resp:
+                    status, body = resp.status, await resp.text()
+        except asyncio.TimeoutError as e:
+            self._record_failure(operation, "timeout")
+            raise EpayUnavailableError(f"Epay не ответил за {timeout} с ({operation})") from e
+        except aiohttp.ClientError as e:
+            self._record_failure(operation, "error")
+            raise EpayUnavailableError(f"Ошибка соединения с Epay ({operation}): {e}") from e
+        except (asyncio.CancelledError, Exception):
+            # Отмена или непредвиденная ошибка (например, при чтении тела) — результата нет:
+            # пробный слот нужно освободить, иначе предохранитель останется в half_open навсегда
+            self.breaker.release()
+            raise
+        finally:
+            EPAY_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+        if status >= 500:
+            self._record_failure(operation, "server_error")
+            raise EpayUnavailableError(f"Epay вернул {status} ({operation}): {body[:200]}")
+        self.breaker.record_success()
+        EPAY_REQUESTS.labels(operation, "ok").inc()
+        return status, body
+
+    def _record_failure(self, operation: str, outcome: str) -> None:
+        EPAY_REQUESTS.labels(operation, outcome).inc()
+        self.breaker.record_failure()
+
+    def _token_is_fresh(self) -> bool:
+        # Токен считается устаревшим заранее, за EPAY_TOKEN_REFRESH_MARGIN секунд до истечения
+        return bool(self.token) and time.monotonic() < self.token_expires_at - config.EPAY_TOKEN_REFRESH_MARGIN
+
+    def invalidate_token(self, token: str) -> None:
+        """Сбрасывает токен, отвергнутый шлюзом (если его еще не заменили)."""
+        if self.token == token:
+            self.token = None
+            self.token_expires_at = 0.0
 
     async def get_token(self) -> str | None:
+        """
+        Возвращает действующий токен из кэша или получает новый.
+        Одновременные вызовы дожидаются одного запроса к серверу токенов.
+        """
+        if self._token_is_fresh():
+            return self.token
+        async with self._token_lock:
+            # Пока ждали блокировку, токен мог получить другой запрос
+            if self._token_is_fresh():
+                return self.token
+            return await self._fetch_token()
+
+    async def _fetch_token(self) -> str | None:
         """
         Получает токен авторизации Epay с улучшенной обработкой ошибок и логированием.
+        Если шлюз недоступен, бросает EpayUnavailableError.
         """
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
         data = {
@@ -23,47 +149,51 @@ class EpayService:
 
         logger.debug(f"Запрос токена Epay. URL: {config.EPAY_OAUTH_URL}")
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(config.EPAY_OAUTH_URL, data=data, headers=headers) as resp:
-                    logger.debug(f"Получен ответ от сервера токенов. Статус: {resp.status}")
-
-                    if resp.status != 200:
-                        error_body = await resp.text()
-                        logger.error(f"Не удалось получить токен. Статус: {resp.status}, Тело ответа: {error_body}")
-                        self.token = None
-                        return None
-
-                    result = await resp.json()
-                    logger.debug(f"Тело ответа от сервера токенов: {result}")
-
-                    access_token = result.get("access_token")
-                    if not access_token:
-                        logger.error(f"Токен не найден в успешном ответе от сервера: {result}")
-                        self.token = None
-                        return None
-
-                    self.token = access_token
-                    logger.info("Токен Epay успешно получен.")
-                    return self.token
-
-            except Exception as e:
-                logger.error(f"Критическое исключение при получении токена Epay: {e}", exc_info=True)
-                self.token = None
-                return None
+        status, body = await self._request("POST", "token", config.EPAY_OAUTH_URL, config.EPAY_TOKEN_TIMEOUT,
+                                           data=data, headers=headers)
+        logger.debug(f"Получен ответ от сервера токенов. Статус: {status}")
+
+        if status != 200:
+            logger.error(f"Не удалось получить токен. Статус: {status}, Тело ответа: {body}")
+            self.token = None
+            return None
 
-    async def create_invoice(self, amount: int, payment_id: str, description: str, bot: Bot,
+        try:
+            result = json.loads(body)
+        except ValueError:
+            logger.error(f"Не удалось распарсить ответ сервера токенов: {body}")
+            self.token = None
+            return None
+        logger.debug(f"Тело ответа от сервера токенов: {result}")
+
+        access_token = result.get("access_token")
+        if not access_token:
+            logger.error(f"Токен не найден в успешном ответе от сервера: {result}")
+            self.token = None
+            return None
+
+        try:
+            expires_in = int(result.get("expires_in") or config.EPAY_TOKEN_DEFAULT_TTL)
+        except (TypeError, ValueError):
+            expires_in = config.EPAY_TOKEN_DEFAULT_TTL
+        self.token = access_token
+        self.token_expires_at = time.monotonic() + expires_in
+        logger.info(f"Токен Epay успешно получен (действует {expires_in} с).")
+        return self.token
+
+    async def create_invoice(self, amount: int, payment_id: str, description: str, bot_username: str,
                              is_retry: bool = False) -> str | None:
+        """
+        Создает счет и возвращает ссылку на оплату или None при ошибке в ответе шлюза.
+        Если шлюз недоступен, бросает EpayUnavailableError — хэндлер предлагает оплату на месте.
+        """
         # payment_id теперь str, а не uuid.UUID
-        if not self.token:
-            logger.info("Токен отсутствует, запрашиваем новый.")
-            await self.get_token()
-            if not self.token:
-                logger.error("Не удалось создать счет: первоначальное получение токена не удалось.")
-                return None
+        token = await self.get_token()
+        if not token:
+            logger.error("Не удалось создать счет: получение токена не удалось.")
+            return None
 
-        headers = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'}
-        bot_info = await bot.get_me()
+        headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
         logger.debug(f"Terminal_ID:{config.EPAY_TERMINAL_ID}")
         invoice_data = {
             "shop_id": config.EPAY_TERMINAL_ID,
@@ -79,47 +209,78 @@ class EpayService:
             "currency": "KZT",
             "post_link": f"{config.BASE_WEBHOOK_URL}/webhooks/epay",
             "failure_post_link": f"{config.BASE_WEBHOOK_URL}/webhooks/epay",
-            "back_link": f"https://t.me/{bot_info.username}",
+            "back_link": f"https://t.me/{bot_username}",
             "failure_back_link": f"{config.BASE_WEBHOOK_URL}/webhooks/epay"
         }
 
         logger.debug(f"Отправка запроса на создание счета Epay. URL: {config.EPAY_CREATE_INVOICE_URL}")
         logger.debug(f"Request Body: {invoice_data}")
 
-        async with aiohttp.ClientSession() as session:
+        status, response_text = await self._request("POST", "create_invoice", config.EPAY_CREATE_INVOICE_URL,
+                                                    config.EPAY_INVOICE_TIMEOUT, json=invoice_data, headers=headers)
+
+        if status == 200:
             try:
-                async with session.post(config.EPAY_CREATE_INVOICE_URL, json=invoice_data, headers=headers) as resp:
-                    response_text = await resp.text()
-
-                    if resp.status == 200:
-                        try:
-                            result = await resp.json(content_type=None)
-                            payment_url = result.get("invoice_url")
-
-                            if not payment_url:
-                                logger.error(
-                                    f"Счет #{payment_id} создан, но URL для оплаты не найден в ответе: {result}")
-                                return None
-
-                            logger.info(f"Счет #{payment_id} успешно создан. URL: {payment_url}")
-                            return payment_url
-                        except Exception as json_exc:
-                            logger.error(
-                                f"Не удалось распарсить JSON из успешного ответа: {json_exc}. Тело ответа: {response_text}")
-                            return None
-
-                    if "Token is not valid" in response_text and not is_retry:
-                        logger.warning("Токен невалиден. Запрашиваем новый и повторяем попытку...")
-                        self.token = None
-                        return await self.create_invoice(amount, payment_id, description, bot, is_retry=True)
-
-                    logger.error(f"Ошибка HTTP при создании счета Epay #{payment_id}: {resp.status}")
-                    logger.error(f"Тело ответа сервера: {response_text}")
+                result = json.loads(response_text)
+                payment_url = result.get("invoice_url")
+
+                if not payment_url:
+                    logger.error(
+                        f"Счет #{payment_id} создан, но URL для оплаты не найден в ответе: {result}")
                     return None
 
-            except Exception as e:
-                logger.error(f"Непредвиденная ошибка при создании счета Epay: {e}", exc_info=True)
+                logger.info(f"Счет #{payment_id} успешно создан. URL: {payment_url}")
+                return payment_url
+            except Exception as json_exc:
+                logger.error(
+                    f"Не удалось распарсить JSON из успешного ответа: {json_exc}. Тело ответа: {response_text}")
                 return None
 
+        if "Token is not valid" in response_text and not is_retry:
+            logger.warning("Токен невалиден. Запрашиваем новый и повторяем попытку...")
+            self.invalidate_token(token)
+            return await self.create_invoice(amount, payment_id, description, bot_username, is_retry=True)
+
+        logger.error(f"Ошибка HTTP при создании счета Epay #{payment_id}: {status}")
+        logger.error(f"Тело ответа сервера: {response_text}")
+        return None
+
+    async def check_payment_status(self, payment_id: str) -> str | None:
+        """
+        Запрашивает статус счета в шлюзе (для сверки зависших платежей).
+        Возвращает STATUS_PAID, STATUS_FAILED, STATUS_PENDING, STATUS_NOT_FOUND или None,
+        если сверка не настроена (EPAY_STATUS_URL) или ответ не удалось разобрать.
+        Если шлюз недоступен, бросает EpayUnavailableError.
+        """
+        if not config.EPAY_STATUS_URL:
+            return None
+        token = await self.get_token()
+        if not token:
+            return None
+
+        url = config.EPAY_STATUS_URL.format(invoice_id=payment_id)
+        status, body = await self._request("GET", "check_status", url, config.EPAY_STATUS_TIMEOUT,
+                                           headers={'Authorization': f'Bearer {token}'})
+        if status == 404:
+            return STATUS_NOT_FOUND
+        if status != 200:
+            logger.error(f"Не удалось получить статус счета #{payment_id}: {status}, {body[:200]}")
+            return None
+        try:
+            result = json.loads(body)
+        except ValueError:
+            logger.error(f"Не удалось распарсить статус счета #{payment_id}: {body[:200]}")
+            return None
+
+        transaction = result.get("transaction") or {}
+        if not transaction:
+            return STATUS_NOT_FOUND
+        status_name = str(transaction.get("statusName") or "").upper()
+        if status_name in _PAID_STATUSES:
+            return STATUS_PAID
+        if status_name in _FAILED_STATUSES:
+            return STATUS_FAILED
+        return STATUS_PENDING
+
 
 epay_service = EpayService()
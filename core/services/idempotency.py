@@ -0,0 +1,74 @@
+import json
+from typing import Optional
+
+from loguru import logger
+from redis.asyncio.client import Redis
+
+from config import config
+
+PENDING = b"pending"
+
+
+class IdempotencyGuard:
+    """
+    Защита от повторных нажатий: блокировка SET NX в Redis на пользователя,
+    действие и ключ попытки. Пока первое нажатие обрабатывается, повторные
+    получают отказ; после завершения — результат первого нажатия.
+    Redis здесь — быстрый первый рубеж: окончательно дубликаты исключает
+    уникальный idempotency_key в orders/payments.
+    """
+
+    def __init__(self):
+        self.redis: Optional[Redis] = None
+
+    def initialize(self, redis: Redis) -> None:
+        self.redis = redis
+
+    @staticmethod
+    def _key(action: str, user_id: int, token: str) -> str:
+        return f"idem:{action}:{user_id}:{token}"
+
+    async def acquire(self, action: str, user_id: int, token: str) -> tuple[bool, Optional[dict]]:
+        """
+        Возвращает (True, None), если запрос первый и его можно выполнять.
+        Иначе (False, результат первого запроса) или (False, None), пока он еще выполняется.
+        """
+        if self.redis is None:
+            return True, None
+        key = self._key(action, user_id, token)
+        try:
+            if await self.redis.set(key, PENDING, nx=True, ex=config.IDEMPOTENCY_LOCK_TTL):
+                return True, None
+            value = await self.redis.get(key)
+        except Exception as e:
+            # Без Redis полагаемся на уникальный ключ в БД
+            logger.warning(f"Idempotency: Redis недоступен ({e}), пропускаем {action} для {user_id}")
+            return True, None
+        if value is None:
+            # Блокировка истекла между SET и GET — пробуем еще раз
+            return await self.acquire(action, user_id, token)
+        if value == PENDING:
+            return False, None
+        return False, json.loads(value)
+
+    async def complete(self, action: str, user_id: int, token: str, result: dict) -> None:
+        """Сохраняет результат первого запроса для ответов на повторные нажатия."""
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(self._key(action, user_id, token), json.dumps(result),
+                                 ex=config.IDEMPOTENCY_RESULT_TTL)
+        except Exception as e:
+            logger.warning(f"Idempotency: не удалось сохранить результат {action} для {user_id}: {e}")
+
+    async def release(self, action: str, user_id: int, token: str) -> None:
+        """Снимает блокировку после ошибки, чтобы пользователь мог повторить действие."""
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(self._key(action, user_id, token))
+        except Exception as e:
+            logger.warning(f"Idempotency: не удалось снять блокировку {action} для {user_id}: {e}")
+
+
+idempotency_guard = IdempotencyGuard()
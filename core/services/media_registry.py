@@ -0,0 +1,92 @@
+import hashlib
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+from loguru import logger
+
+from core.utils.database import postgres_client
+
+SendPhoto = Callable[[Union[str, FSInputFile]], Awaitable[Union[Message, bool]]]
+
+
+class MediaRegistry:
+    """
+    Реестр статических картинок бота.
+    Каждый файл загружается в Telegram один раз, полученный file_id
+    сохраняется в таблице media_cache по хэшу содержимого и дальше
+    переиспользуется. Если Telegram отверг file_id — файл загружается заново.
+    """
+
+    def __init__(self):
+        self._hashes: dict[Path, str] = {}
+        self._file_ids: dict[tuple[int, str], str] = {}
+
+    def _file_hash(self, path: Path) -> str:
+        if path not in self._hashes:
+            self._hashes[path] = hashlib.sha256(path.read_bytes()).hexdigest()
+        return self._hashes[path]
+
+    async def get_file_id(self, bot_id: int, path: Path) -> Optional[str]:
+        key = (bot_id, self._file_hash(path))
+        if key not in self._file_ids:
+            file_id = await postgres_client.fetchval(
+                "SELECT file_id FROM media_cache WHERE bot_id = $1 AND file_hash = $2", *key
+            )
+            if not file_id:
+                return None
+            self._file_ids[key] = file_id
+        return self._file_ids[key]
+
+    async def store(self, bot_id: int, path: Path, file_id: str) -> None:
+        key = (bot_id, self._file_hash(path))
+        self._file_ids[key] = file_id
+        await postgres_client.execute(
+            """
+            INSERT INTO media_cache (bot_id, file_hash, file_id) VALUES ($1, $2, $3)
+            ON CONFLICT (bot_id, file_hash) DO UPDATE SET file_id = EXCLUDED.file_id
+            """,
+            *key, file_id
+        )
+        logger.info(f"✅ file_id для {path.name} сохранен в media_cache")
+
+    async def forget(self, bot_id: int, path: Path) -> None:
+        key = (bot_id, self._file_hash(path))
+        self._file_ids.pop(key, None)
+        await postgres_client.execute("DELETE FROM media_cache WHERE bot_id = $1 AND file_hash = $2", *key)
+
+    async def send_photo(self, bot_id: int, path: Path, send: SendPhoto) -> Union[Message, bool]:
+        """
+        Отправляет картинку через переданную функцию send (answer_photo, send_photo,
+        edit_media и т.п.), подставляя сохраненный file_id или сам файл.
+        """
+        try:
+            file_id = await self.get_file_id(bot_id, path)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать media_cache для {path.name}: {e}")
+            file_id = None
+
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                # edit_media с той же картинкой и подписью — это не проблема file_id
+                if "message is not modified" in str(e):
+                    return True
+                logger.warning(f"Telegram отверг file_id для {path.name}: {e}. Загружаем файл заново.")
+                try:
+                    await self.forget(bot_id, path)
+                except Exception as db_error:
+                    logger.warning(f"Не удалось удалить file_id для {path.name}: {db_error}")
+
+        result = await send(FSInputFile(path))
+        if isinstance(result, Message) and result.photo:
+            try:
+                await self.store(bot_id, path, result.photo[-1].file_id)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить file_id для {path.name}: {e}")
+        return result
+
+
+media_registry = MediaRegistry()
@@ -0,0 +1,225 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Optional
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from asyncpg import Record
+from loguru import logger
+
+from config import config
+from core.utils.database import postgres_client
+from core.services.broadcast import classify_error, BLOCKED, TRANSIENT
+from core.services.send_scheduler import send_priority, Priority
+
+# Методы Bot API, которые можно поставить в outbox
+OUTBOX_METHODS = {"send_message", "edit_message_caption", "delete_message"}
+
+
+def _dump_markup(payload: dict) -> dict:
+    markup = payload.get("reply_markup")
+    if isinstance(markup, InlineKeyboardMarkup):
+        payload["reply_markup"] = markup.model_dump(mode="json", exclude_none=True)
+    return payload
+
+
+async def enqueue_notification(conn: asyncpg.Connection, chat_id: int, method: str = "send_message",
+                               fallback: Optional[dict] = None, **payload) -> None:
+    """
+    Записывает уведомление в notification_outbox через соединение вызывающего кода —
+    в той же транзакции, что и заказ. Уведомление уйдет, только если транзакция закоммичена.
+    fallback — {"method": ..., **payload}: что отправить, если Telegram отверг основной вызов
+    (например, нельзя отредактировать сообщение).
+    """
+    if method not in OUTBOX_METHODS:
+        raise ValueError(f"Метод {method} не поддерживается outbox")
+    payload = _dump_markup(payload)
+    if fallback:
+        payload["fallback"] = _dump_markup(dict(fallback))
+    await conn.execute(
+        "INSERT INTO notification_outbox (chat_id, method, payload) VALUES ($1, $2, $3)",
+        chat_id, method, json.dumps(payload, ensure_ascii=False)
+    )
+
+
+class OutboxDispatcher:
+    """
+    Отправляет уведомления из notification_outbox.
+
+    Забирается порция чатов, а не строк: "голова" очереди чата (самая ранняя
+    неотправленная строка) блокируется FOR UPDATE SKIP LOCKED, и вместе с ней
+    арендуются все неотправленные строки этого чата (next_attempt_at сдвигается
+    вперед). Пока аренда или пауза головы не истекла, чат не достанется другому
+    процессу, а после падения процесса снова станет доступным. Разные чаты
+    отправляются параллельно, сообщения одного чата — строго по порядку; темп задает
+    SendScheduler. На первой ошибке отправка чата останавливается: ошибки сети и 5xx
+    повторяются с экспоненциальной паузой (остаток очереди чата ждет вместе с ними),
+    после OUTBOX_MAX_ATTEMPTS или при постоянной ошибке уведомление помечается failed,
+    а остаток очереди возвращается на отправку.
+    """
+
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def wake(self) -> None:
+        """Будит диспетчер сразу после коммита, не дожидаясь следующего опроса."""
+        self._wakeup.set()
+
+    async def _claim_batch(self) -> list[Record]:
+        """Арендует очереди до OUTBOX_BATCH_SIZE чатов целиком (см. описание класса)."""
+        return await postgres_client.fetch(
+            """
+            WITH heads AS (
+                SELECT id, chat_id FROM notification_outbox o
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                  AND NOT EXISTS (
+                      SELECT 1 FROM notification_outbox p
+                      WHERE p.chat_id = o.chat_id AND p.status = 'pending' AND p.id < o.id
+                  )
+                ORDER BY id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE notification_outbox
+            SET attempts = attempts + 1, next_attempt_at = NOW() + make_interval(secs => $2)
+            WHERE status = 'pending' AND chat_id IN (SELECT chat_id FROM heads)
+            RETURNING *
+            """,
+            config.OUTBOX_BATCH_SIZE, config.OUTBOX_LEASE_SECONDS
+        )
+
+    async def _call(self, chat_id: int, method: str, payload: dict) -> None:
+        payload = dict(payload)
+        if payload.get("reply_markup"):
+            payload["reply_markup"] = InlineKeyboardMarkup.model_validate(payload["reply_markup"])
+        await getattr(self.bot, method)(chat_id=chat_id, **payload)
+
+    async def _send(self, row: Record) -> None:
+        """Отправляет одно уведомление; при отказе Telegram — запасной вариант, если он задан."""
+        payload = json.loads(row['payload'])
+        fallback = payload.pop("fallback", None)
+        try:
+            await self._call(row['chat_id'], row['method'], payload)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            if not fallback:
+                raise
+            logger.warning(f"Outbox #{row['id']}: {row['method']} отклонен ({e}), отправляем запасной вариант")
+            fallback_method = fallback.pop("method", "send_message")
+            await self._call(row['chat_id'], fallback_method, fallback)
+
+    async def _send_chat(self, rows: list[Record]) -> tuple[list[Record], Optional[tuple[Record, Exception]],
+                                                            list[Record]]:
+        """
+        Отправляет очередь чата по порядку до первой ошибки.
+        Возвращает (отправленные, (строка, ошибка) или None, неотправленный остаток).
+        """
+        for index, row in enumerate(rows):
+            try:
+                await self._send(row)
+            except Exception as e:
+                return rows[:index], (row, e), rows[index + 1:]
+        return rows, None, []
+
+    async def _deliver(self, rows: list[Record]) -> None:
+        by_chat: dict[int, list[Record]] = defaultdict(list)
+        for row in sorted(rows, key=lambda r: r['id']):
+            by_chat[row['chat_id']].append(row)
+
+        with send_priority(Priority.NOTIFICATION):
+            chats = await asyncio.gather(*(self._send_chat(chat_rows) for chat_rows in by_chat.values()))
+
+        sent, retry, failed, deferred = [], [], [], []
+        for chat_sent, failure, rest in chats:
+            sent.extend(row['id'] for row in chat_sent)
+            if failure is None:
+                continue
+            row, error = failure
+            outcome = classify_error(error)
+            if outcome == TRANSIENT and row['attempts'] < config.OUTBOX_MAX_ATTEMPTS:
+                delay = min(300, 5 * 2 ** row['attempts'])
+                retry.append((row['id'], delay, str(error)))
+            else:
+                level = "info" if outcome == BLOCKED else "error"
+                getattr(logger, level)(f"Outbox #{row['id']} для {row['chat_id']} не отправлено: {error}")
+                failed.append((row['id'], str(error)))
+                delay = 0
+            # Остаток очереди чата не отправлялся: ждет повтора вместе с ошибочной строкой
+            # (или сразу возвращается на отправку), попытка ему не засчитывается
+            deferred.extend((rest_row['id'], delay) for rest_row in rest)
+
+        if sent:
+            await postgres_client.execute(
+                "UPDATE notification_outbox SET status = 'sent', sent_at = NOW() WHERE id = ANY($1::bigint[])", sent
+            )
+        if retry:
+            await postgres_client.execute(
+                """
+                UPDATE notification_outbox o
+                SET next_attempt_at = NOW() + make_interval(secs => r.delay), last_error = r.error
+                FROM unnest($1::bigint[], $2::int[], $3::text[]) AS r(id, delay, error)
+                WHERE o.id = r.id
+                """,
+                [item[0] for item in retry], [item[1] for item in retry], [item[2] for item in retry]
+            )
+        if failed:
+            await postgres_client.execute(
+                """
+                UPDATE notification_outbox o SET status = 'failed', last_error = r.error
+                FROM unnest($1::bigint[], $2::text[]) AS r(id, error)
+                WHERE o.id = r.id
+                """,
+                [item[0] for item in failed], [item[1] for item in failed]
+            )
+        if deferred:
+            await postgres_client.execute(
+                """
+                UPDATE notification_outbox o
+                SET attempts = attempts - 1, next_attempt_at = NOW() + make_interval(secs => r.delay)
+                FROM unnest($1::bigint[], $2::int[]) AS r(id, delay)
+                WHERE o.id = r.id
+                """,
+                [item[0] for item in deferred], [item[1] for item in deferred]
+            )
+
+    async def _run(self) -> None:
+        while True:
+            # Сбрасываем флаг до выборки: пробуждение во время отправки не потеряется
+            self._wakeup.clear()
+            try:
+                rows = await self._claim_batch()
+                if rows:
+                    await self._deliver(rows)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox: ошибка обработки порции: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info("✅ Notification outbox dispatcher started")
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+outbox_dispatcher = OutboxDispatcher()
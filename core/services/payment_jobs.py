@@ -0,0 +1,162 @@
+import asyncio
+import json
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from asyncpg import Record
+from loguru import logger
+
+from config import config
+from core.utils.database import postgres_client
+
+# Типы заданий: успешная и неуспешная оплата
+JOB_SUCCESS = "success"
+JOB_FAILURE = "failure"
+
+# Статусы заданий
+JOB_PENDING = "pending"
+JOB_DONE = "done"
+JOB_DEAD = "dead"
+
+
+async def enqueue_payment_job(payment_id: str, kind: str, payload: dict) -> bool:
+    """
+    Ставит обработку вебхука в очередь payment_jobs. Повторный вебхук того же
+    типа по тому же платежу новое задание не создает. Возвращает True, если задание добавлено.
+    """
+    job_id = await postgres_client.fetchval(
+        """
+        INSERT INTO payment_jobs (payment_id, kind, payload) VALUES ($1, $2, $3)
+        ON CONFLICT (payment_id, kind) DO NOTHING
+        RETURNING id
+        """,
+        payment_id, kind, json.dumps(payload, ensure_ascii=False)
+    )
+    return job_id is not None
+
+
+class PaymentJobWorkers:
+    """
+    Пул асинхронных обработчиков очереди payment_jobs.
+
+    Задание забирается FOR UPDATE SKIP LOCKED с "арендой" (next_attempt_at сдвигается
+    на PAYMENT_JOB_LEASE_SECONDS): если процесс упадет посреди обработки, задание
+    снова станет доступным. Ошибка — повтор с экспоненциальной паузой; после
+    PAYMENT_JOB_MAX_ATTEMPTS задание получает статус dead и обрабатывается как
+    окончательный сбой (платеж помечается error, пользователь получает сообщение).
+    """
+
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self.dp: Optional[Dispatcher] = None
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    def wake(self) -> None:
+        """Будит обработчики сразу после постановки задания в очередь."""
+        self._wakeup.set()
+
+    async def _claim(self) -> Optional[Record]:
+        return await postgres_client.fetchrow(
+            """
+            UPDATE payment_jobs
+            SET attempts = attempts + 1, next_attempt_at = NOW() + make_interval(secs => $1)
+            WHERE id = (
+                SELECT id FROM payment_jobs
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+            """,
+            config.PAYMENT_JOB_LEASE_SECONDS
+        )
+
+    async def _execute(self, job: Record) -> None:
+        # Импортируем здесь, чтобы избежать циклических зависимостей
+        from core.webapp.epay_payment_hooks import process_successful_payment, process_failed_payment
+
+        payload = json.loads(job['payload']) if job['payload'] else {}
+        if job['kind'] == JOB_SUCCESS:
+            await process_successful_payment(job['payment_id'], self.bot, self.dp)
+        elif job['kind'] == JOB_FAILURE:
+            await process_failed_payment(job['payment_id'], payload.get('reason'), self.bot, self.dp)
+        else:
+            raise ValueError(f"Неизвестный тип задания: {job['kind']}")
+
+    async def _dead_letter(self, job: Record, error: Exception) -> None:
+        """Окончательный сбой задания: фиксируем ошибку платежа и сообщаем пользователю."""
+        # Импортируем здесь, чтобы избежать циклических зависимостей
+        from core.webapp.epay_payment_hooks import fail_payment
+
+        logger.error(f"Задание #{job['id']} ({job['kind']}) по платежу #{job['payment_id']} "
+                     f"не выполнено за {job['attempts']} попыток: {error}")
+        await postgres_client.execute(
+            "UPDATE payment_jobs SET status = 'dead', last_error = $2 WHERE id = $1",
+            job['id'], str(error)
+        )
+        if job['kind'] == JOB_SUCCESS:
+            try:
+                await fail_payment(job['payment_id'])
+            except Exception as e:
+                logger.error(f"Не удалось отметить сбой платежа #{job['payment_id']}: {e}")
+
+    async def _process(self, job: Record) -> None:
+        try:
+            await self._execute(job)
+        except Exception as e:
+            if job['attempts'] >= config.PAYMENT_JOB_MAX_ATTEMPTS:
+                await self._dead_letter(job, e)
+                return
+            delay = min(300, 5 * 2 ** job['attempts'])
+            logger.warning(f"Задание #{job['id']} по платежу #{job['payment_id']}: ошибка ({e}), "
+                           f"повтор через {delay} с")
+            await postgres_client.execute(
+                """
+                UPDATE payment_jobs
+                SET next_attempt_at = NOW() + make_interval(secs => $2), last_error = $3
+                WHERE id = $1
+                """,
+                job['id'], delay, str(e)
+            )
+            return
+        await postgres_client.execute(
+            "UPDATE payment_jobs SET status = 'done' WHERE id = $1", job['id']
+        )
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            # Сбрасываем флаг до выборки: пробуждение во время выборки не потеряется
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+                if job:
+                    await self._process(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Обработчик платежей #{number}: ошибка очереди: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.PAYMENT_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot, dp: Dispatcher) -> None:
+        self.bot, self.dp = bot, dp
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(number))
+                       for number in range(1, config.PAYMENT_JOB_WORKERS + 1)]
+        logger.info(f"✅ Payment job workers started: {config.PAYMENT_JOB_WORKERS}")
+
+    async def stop(self) -> None:
+        """Останавливает обработчики; незавершенные задания вернутся в очередь по истечении аренды."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+payment_job_workers = PaymentJobWorkers()
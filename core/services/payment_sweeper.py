@@ -0,0 +1,188 @@
+import asyncio
+import datetime
+from collections import Counter
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from asyncpg import Record
+from loguru import logger
+
+from config import config
+from core.utils.database import postgres_client
+from core.utils.helpers import detach_payment
+from core.utils.metrics import PAYMENTS_SWEPT, PENDING_PAYMENTS
+from core.services.epay_service import (
+    epay_service, EpayUnavailableError, STATUS_PAID, STATUS_FAILED
+)
+from core.services.notification_outbox import enqueue_notification, outbox_dispatcher
+from core.services.payment_jobs import enqueue_payment_job, payment_job_workers, JOB_SUCCESS
+
+# Шлюз не ответил на запрос статуса — платеж остается pending до следующего прохода
+UNAVAILABLE = "unavailable"
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class PaymentSweeper:
+    """
+    Периодическая очистка зависших платежей (status = 'pending').
+
+    Платежи старше PAYMENT_PENDING_TTL_MINUTES обходятся порциями (keyset по created_at)
+    и, если настроен EPAY_STATUS_URL, сверяются со шлюзом:
+    - оплачен — ставится задание в payment_jobs (как будто пришел потерянный вебхук);
+    - отклонен — платеж получает статус failed;
+    - шлюз недоступен — платеж остается pending, но не дольше PAYMENT_RECONCILE_GIVE_UP_HOURS;
+    - иначе — статус expired.
+    У снятых с ожидания платежей удаляется сообщение со ссылкой на оплату и
+    payment_message_id в FSM. Опоздавший успешный вебхук по expired-платежу
+    все равно создаст заказ (см. process_successful_payment).
+    """
+
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self.dp: Optional[Dispatcher] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _fetch_batch(self, after_created_at: datetime.datetime, after_payment_id: str) -> list[Record]:
+        return await postgres_client.fetch(
+            """
+            SELECT payment_id, user_id, created_at FROM payments
+            WHERE status = 'pending'
+              AND created_at < NOW() - make_interval(mins => $1)
+              AND (created_at, payment_id) > ($2, $3)
+            ORDER BY created_at, payment_id
+            LIMIT $4
+            """,
+            config.PAYMENT_PENDING_TTL_MINUTES, after_created_at, after_payment_id, config.PAYMENT_SWEEP_BATCH_SIZE
+        )
+
+    async def _reconcile(self, batch: list[Record]) -> dict[str, Optional[str]]:
+        """Запрашивает статусы порции в шлюзе с ограничением одновременных запросов."""
+        semaphore = asyncio.Semaphore(config.PAYMENT_RECONCILE_CONCURRENCY)
+
+        async def check(payment_id: str) -> tuple[str, Optional[str]]:
+            async with semaphore:
+                try:
+                    return payment_id, await epay_service.check_payment_status(payment_id)
+                except EpayUnavailableError as e:
+                    logger.warning(f"Сверка платежа #{payment_id} отложена: {e}")
+                    return payment_id, UNAVAILABLE
+
+        return dict(await asyncio.gather(*(check(row['payment_id']) for row in batch)))
+
+    @staticmethod
+    async def _close(payment_ids: list[str], status: str) -> list[Record]:
+        """Снимает платежи с ожидания; платеж, который успели обработать, не трогается."""
+        if not payment_ids:
+            return []
+        return await postgres_client.fetch(
+            """
+            UPDATE payments SET status = $2
+            WHERE payment_id = ANY($1::varchar[]) AND status = 'pending'
+            RETURNING payment_id, user_id
+            """,
+            payment_ids, status
+        )
+
+    async def _cleanup_fsm(self, closed: list[Record]) -> None:
+        """Удаляет сообщения со ссылкой на оплату и выдает новый ключ попытки оформления."""
+        deletions = []
+        for row in closed:
+            user_id = row['user_id']
+            state = FSMContext(storage=self.dp.storage,
+                               key=StorageKey(bot_id=self.bot.id, chat_id=user_id, user_id=user_id))
+            data = await state.get_data()
+            detached, message_id = detach_payment(data, row['payment_id'])
+            if not detached:
+                continue
+            await state.set_data(data)
+            if message_id:
+                deletions.append((user_id, message_id))
+
+        if deletions:
+            async with postgres_client.acquire() as conn:
+                async with conn.transaction():
+                    for user_id, message_id in deletions:
+                        await enqueue_notification(conn, user_id, "delete_message", message_id=message_id)
+            outbox_dispatcher.wake()
+
+    async def sweep(self) -> Counter:
+        """Один проход очистки. Возвращает счетчики по результатам."""
+        totals = Counter()
+        give_up_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            hours=config.PAYMENT_RECONCILE_GIVE_UP_HOURS)
+        cursor = (_EPOCH, "")
+        while True:
+            batch = await self._fetch_batch(*cursor)
+            if not batch:
+                break
+            cursor = (batch[-1]['created_at'], batch[-1]['payment_id'])
+
+            statuses = await self._reconcile(batch) if config.EPAY_STATUS_URL else {}
+            paid, failed, expired = [], [], []
+            for row in batch:
+                status = statuses.get(row['payment_id'])
+                if status == STATUS_PAID:
+                    paid.append(row['payment_id'])
+                elif status == STATUS_FAILED:
+                    failed.append(row['payment_id'])
+                elif status == UNAVAILABLE and row['created_at'] > give_up_before:
+                    totals["deferred"] += 1
+                else:
+                    expired.append(row['payment_id'])
+
+            # Задание могло уже стоять в очереди (вебхук пришел, но еще не обработан)
+            enqueued = [payment_id for payment_id in paid
+                        if await enqueue_payment_job(payment_id, JOB_SUCCESS,
+                                                     {"invoiceId": payment_id, "source": "reconcile"})]
+            if enqueued:
+                payment_job_workers.wake()
+                logger.warning(f"Сверка: оплачены, но не обработаны платежи {enqueued} — поставлены в очередь")
+            totals["paid"] += len(enqueued)
+
+            closed_failed = await self._close(failed, "failed")
+            closed_expired = await self._close(expired, "expired")
+            totals["failed"] += len(closed_failed)
+            totals["expired"] += len(closed_expired)
+            await self._cleanup_fsm(closed_failed + closed_expired)
+
+            if len(batch) < config.PAYMENT_SWEEP_BATCH_SIZE:
+                break
+
+        for outcome, count in totals.items():
+            PAYMENTS_SWEPT.labels(outcome).inc(count)
+        pending = await postgres_client.fetchval("SELECT COUNT(*) FROM payments WHERE status = 'pending'")
+        PENDING_PAYMENTS.set(pending)
+        if totals:
+            logger.info(f"Очистка платежей: {dict(totals)}, в ожидании осталось {pending}")
+        return totals
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Очистка платежей: ошибка прохода: {e}", exc_info=True)
+            await asyncio.sleep(config.PAYMENT_SWEEP_INTERVAL)
+
+    def start(self, bot: Bot, dp: Dispatcher) -> None:
+        self.bot, self.dp = bot, dp
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info("✅ Pending payment sweeper started")
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+payment_sweeper = PaymentSweeper()
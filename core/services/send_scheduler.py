@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from loguru import logger
+
+from config import config
+
+
+class Priority(IntEnum):
+    """Классы приоритета исходящих сообщений: меньше — важнее."""
+    CUSTOMER = 0      # ответы клиенту на его действия
+    NOTIFICATION = 1  # уведомления бариста, рефереру, админу
+    BROADCAST = 2     # рассылки
+
+
+_current_priority: ContextVar[Priority] = ContextVar("send_priority", default=Priority.CUSTOMER)
+
+
+@contextmanager
+def send_priority(priority: Priority):
+    """Задает приоритет для всех вызовов Bot API внутри блока."""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+# Методы, которые Telegram считает "сообщениями в чат" (на них действует лимит 1/с на чат)
+CHAT_SEND_METHODS = {
+    "SendMessage", "SendPhoto", "SendDocument", "SendMediaGroup", "SendAnimation", "SendVideo",
+    "SendAudio", "SendVoice", "SendSticker", "CopyMessage", "ForwardMessage",
+}
+
+
+class SendScheduler:
+    """
+    Планировщик исходящих запросов к Telegram в пределах процесса.
+
+    - Глобальный token bucket (TELEGRAM_GLOBAL_RATE запросов/с) для всех запросов в чаты;
+      когда токенов нет, ожидающие обслуживаются по приоритету, затем по очереди.
+    - Лимит на чат (GCRA): 1 сообщение в TELEGRAM_PRIVATE_CHAT_INTERVAL с в личке и
+      TELEGRAM_GROUP_CHAT_INTERVAL с в группах, с небольшим допустимым всплеском.
+    """
+
+    def __init__(self):
+        self.rate = config.TELEGRAM_GLOBAL_RATE
+        self.chat_burst = config.TELEGRAM_CHAT_BURST
+        self._tokens = float(self.rate)
+        self._updated = time.monotonic()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._chat_tat: dict[Union[int, str], float] = {}
+
+    # ===== Глобальный лимит =====
+    def set_rate(self, rate: float) -> None:
+        """Меняет глобальный темп (например, для части рассылки в воркере Celery)."""
+        self.rate = rate
+        self._tokens = min(self._tokens, float(rate))
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(float(self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            self._refill()
+            if self._tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _acquire_global(self, priority: Priority) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый event loop (например, следующая задача Celery) — старые ожидания недействительны
+            self._loop, self._waiters, self._pump_task = loop, [], None
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    # ===== Лимит на чат =====
+    def _reserve_chat(self, chat_id: Union[int, str]) -> float:
+        """Резервирует слот в чате и возвращает, сколько секунд нужно подождать."""
+        is_private = isinstance(chat_id, int) and chat_id > 0
+        interval = config.TELEGRAM_PRIVATE_CHAT_INTERVAL if is_private else config.TELEGRAM_GROUP_CHAT_INTERVAL
+        now = time.monotonic()
+        tat = max(self._chat_tat.get(chat_id, now), now)
+        delay = max(0.0, tat - now - interval * (self.chat_burst - 1))
+        self._chat_tat[chat_id] = tat + interval
+        if len(self._chat_tat) > 10_000:
+            self._chat_tat = {chat: t for chat, t in self._chat_tat.items() if t > now}
+        return delay
+
+    def pause_chat(self, chat_id: Union[int, str], seconds: float) -> None:
+        """Сдвигает ближайший слот чата (после 429 от Telegram)."""
+        self._chat_tat[chat_id] = time.monotonic() + seconds
+
+    async def acquire(self, chat_id: Union[int, str], is_send: bool, priority: Priority) -> None:
+        if is_send:
+            delay = self._reserve_chat(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self._acquire_global(priority)
+
+
+send_scheduler = SendScheduler()
+
+
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    """
+    Request-middleware сессии бота: пропускает запросы в чаты через SendScheduler
+    и повторяет их при 429, выдерживая retry_after.
+    """
+
+    def __init__(self, scheduler: SendScheduler = send_scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        is_send = type(method).__name__ in CHAT_SEND_METHODS
+        priority = _current_priority.get()
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(chat_id, is_send, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > config.TELEGRAM_MAX_RETRIES:
+                    raise
+                logger.warning(f"Telegram 429 для чата {chat_id}: ждем {e.retry_after} с "
+                               f"(попытка {attempt}/{config.TELEGRAM_MAX_RETRIES})")
+                self.scheduler.pause_chat(chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+
+def setup_send_scheduler(bot: Bot) -> None:
+    """Подключает планировщик отправки к сессии бота."""
+    bot.session.middleware(SendSchedulerMiddleware())
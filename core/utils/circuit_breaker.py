@@ -0,0 +1,80 @@
+# core/utils/circuit_breaker.py
+import time
+
+from loguru import logger
+
+from core.utils.metrics import CIRCUIT_STATE, CIRCUIT_TRANSITIONS
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# Значения для gauge: так состояние удобно рисовать на графике
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+
+    closed    — запросы идут; после failure_threshold сбоев подряд переходит в open.
+    open      — запросы сразу отклоняются; через recovery_timeout секунд — half_open.
+    half_open — пропускается один пробный запрос: успех закрывает предохранитель,
+                сбой снова открывает его на recovery_timeout.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        CIRCUIT_STATE.labels(name).set(_STATE_VALUES[CLOSED])
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        level = "warning" if state == OPEN else "info"
+        getattr(logger, level)(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(_STATE_VALUES[state])
+        CIRCUIT_TRANSITIONS.labels(self.name, state).inc()
+
+    @property
+    def available(self) -> bool:
+        """Можно ли ожидать, что запрос будет пропущен (без занятия пробного слота)."""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.recovery_timeout
+        if self.state == HALF_OPEN:
+            return not self._probe_in_flight
+        return True
+
+    def allow_request(self) -> bool:
+        """Решает, пропускать ли запрос. В half_open занимает единственный пробный слот."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self) -> None:
+        """Освобождает пробный слот, если запрос завершился без результата (отмена, непредвиденная ошибка)."""
+        self._probe_in_flight = False
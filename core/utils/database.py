@@ -1,9 +1,12 @@
 import asyncpg
+from contextlib import asynccontextmanager
 from typing import Optional, Any, List, Dict, Union
 from loguru import logger
 import datetime
 
 from config import config
+from core.utils.metrics import track_dependency
+from core.utils.helpers import allowed_source_statuses
 
 
 class PostgresClient:
@@ -42,28 +45,35 @@ class PostgresClient:
             finally:
                 self.pool = None
 
+    @asynccontextmanager
+    async def acquire(self):
+        """Соединение из пула; время работы с ним учитывается в метриках апдейта."""
+        with track_dependency("db"):
+            async with self.pool.acquire() as conn:
+                yield conn
+
     # ===== CRUD методы =====
     async def fetch(self, query: str, *args) -> List[asyncpg.Record]:
         """Выполнить SELECT и вернуть список строк."""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             logger.debug(f"📥 fetch: {query} {args}")
             return await conn.fetch(query, *args)
 
     async def fetchrow(self, query: str, *args) -> Optional[asyncpg.Record]:
         """Выполнить SELECT и вернуть одну строку или None."""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             logger.debug(f"📥 fetchrow: {query} {args}")
             return await conn.fetchrow(query, *args)
 
     async def fetchval(self, query: str, *args) -> Optional[Any]:
         """Выполняет запрос и возвращает одно значение."""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             logger.debug(f"📥 fetchval: {query} {args}")
             return await conn.fetchval(query, *args)
 
     async def execute(self, query: str, *args) -> str:
         """Выполнить INSERT/UPDATE/DELETE и вернуть статус."""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             logger.debug(f"⚡ execute: {query} {args}")
             return await conn.execute(query, *args)
 
@@ -107,9 +117,11 @@ class PostgresClient:
         logger.info(f"✏️ Updated {table}: {data}, WHERE {where} -> {params}")
 
     # <<< --- ИЗМЕНЕННЫЙ МЕТОД ЗДЕСЬ --- >>>
-    async def add_order(self, order_data: Dict[str, Any]) -> Optional[asyncpg.Record]:
+    async def add_order(self, order_data: Dict[str, Any],
+                        conn: Optional[asyncpg.Connection] = None) -> Optional[asyncpg.Record]:
         """
         Добавляет новый заказ в таблицу orders и возвращает всю созданную запись.
+        Если передан conn, запрос выполняется в транзакции вызывающего кода.
         """
         # Добавляем статус 'new' по умолчанию, если его нет в данных
         if 'status' not in order_data:
@@ -119,18 +131,63 @@ class PostgresClient:
         placeholders = ", ".join(f"${i + 1}" for i in range(len(order_data)))
 
         # 1. Изменили 'RETURNING order_id' на 'RETURNING *'
-        query = f"INSERT INTO orders ({keys}) VALUES ({placeholders}) RETURNING *"
+        # Первое событие в журнале статусов пишется тем же запросом
+        # Повтор с тем же idempotency_key ничего не вставляет и возвращает None
+        on_conflict = "ON CONFLICT (idempotency_key) DO NOTHING" if order_data.get('idempotency_key') else ""
+        query = f"""
+        WITH new_order AS (
+            INSERT INTO orders ({keys}) VALUES ({placeholders}) {on_conflict} RETURNING *
+        ), status_event AS (
+            INSERT INTO order_status_events (order_id, from_status, to_status)
+            SELECT order_id, NULL, status FROM new_order
+        )
+        SELECT * FROM new_order
+        """
         values = list(order_data.values())
 
-        async with self.pool.acquire() as conn:
-            # 2. Изменили 'fetchval' на 'fetchrow', чтобы получить всю строку
+        if conn is not None:
             new_order_record = await conn.fetchrow(query, *values)
-            if new_order_record:
-                # В вашей таблице колонка с id может называться 'id' или 'order_id'
-                # asyncpg.Record позволяет обращаться по имени колонки
-                order_id = new_order_record['id'] if 'id' in new_order_record else new_order_record.get('order_id')
-                logger.info(f"✅ New order added with ID: {order_id}")
-            return new_order_record
+        else:
+            async with self.acquire() as own_conn:
+                # 2. Изменили 'fetchval' на 'fetchrow', чтобы получить всю строку
+                new_order_record = await own_conn.fetchrow(query, *values)
+        if new_order_record:
+            # В вашей таблице колонка с id может называться 'id' или 'order_id'
+            # asyncpg.Record позволяет обращаться по имени колонки
+            order_id = new_order_record['id'] if 'id' in new_order_record else new_order_record.get('order_id')
+            logger.info(f"✅ New order added with ID: {order_id}")
+        return new_order_record
+
+    async def update_order_status(self, order_id: int, new_status: str) -> tuple[bool, Optional[str]]:
+        """
+        Меняет статус заказа, только если переход разрешен ORDER_STATUS_TRANSITIONS,
+        и тем же запросом дописывает переход в order_status_events.
+        Возвращает (применен ли переход, статус до попытки); статус None — заказ не найден.
+        """
+        query = """
+        WITH prev AS (
+            SELECT order_id, status FROM orders WHERE order_id = $1 FOR UPDATE
+        ), upd AS (
+            UPDATE orders o SET status = $2
+            FROM prev
+            WHERE o.order_id = prev.order_id AND prev.status = ANY($3::varchar[])
+            RETURNING o.order_id, prev.status AS from_status
+        ), status_event AS (
+            INSERT INTO order_status_events (order_id, from_status, to_status)
+            SELECT order_id, from_status, $2 FROM upd
+        )
+        SELECT prev.status AS from_status, upd.order_id IS NOT NULL AS applied
+        FROM prev LEFT JOIN upd ON upd.order_id = prev.order_id
+        """
+        async with self.acquire() as conn:
+            record = await conn.fetchrow(query, order_id, new_status, allowed_source_statuses(new_status))
+        if record is None:
+            return False, None
+        if not record['applied']:
+            logger.warning(f"⛔ Order #{order_id}: transition {record['from_status']} -> {new_status} rejected")
+            return False, record['from_status']
+        logger.info(f"✏️ Order #{order_id} status: {record['from_status']} -> {new_status}")
+        return True, record['from_status']
 
     # ===== МЕТОДЫ ДЛЯ АНАЛИТИКИ (без изменений) =====
     async def get_total_orders_count(self) -> int:
@@ -207,6 +264,63 @@ class PostgresClient:
         query = "SELECT COUNT(*) FROM orders WHERE is_free = TRUE;"
         return await self.fetchval(query)
 
+    async def get_status_durations(self, from_status: str, to_status: str, group_by: Optional[str] = None,
+                                   days: int = 30) -> List[dict]:
+        """
+        Перцентили времени между статусами заказа по журналу order_status_events.
+
+        Args:
+            from_status (str): Статус начала интервала (например, 'new').
+            to_status (str): Статус конца интервала (например, 'ready').
+            group_by (str | None): None — итог, 'hour' — по часу начала, 'drink' — по напитку.
+            days (int): Глубина выборки в днях.
+
+        Returns:
+            Список словарей: group, count, p50, p90, p99 (в секундах).
+        """
+        group_expressions = {
+            None: "NULL::text",
+            "hour": "EXTRACT(HOUR FROM s.started AT TIME ZONE $4)::int::text",
+            "drink": "o.type",
+        }
+        group_expr = group_expressions[group_by]
+        # Выборка идет по индексу (to_status, created_at) за ограниченный период — без полного скана
+        query = f"""
+        WITH spans AS (
+            SELECT e.order_id,
+                   MIN(e.created_at) FILTER (WHERE e.to_status = $1) AS started,
+                   MIN(e.created_at) FILTER (WHERE e.to_status = $2) AS finished
+            FROM order_status_events e
+            WHERE e.to_status IN ($1, $2)
+              AND e.created_at >= NOW() - make_interval(days => $3)
+            GROUP BY e.order_id
+        )
+        SELECT {group_expr} AS grp,
+               COUNT(*) AS count,
+               percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (
+                   ORDER BY EXTRACT(EPOCH FROM s.finished - s.started)
+               ) AS pct
+        FROM spans s
+        JOIN orders o ON o.order_id = s.order_id
+        WHERE s.started IS NOT NULL AND s.finished >= s.started
+        GROUP BY grp
+        ORDER BY grp
+        """
+        args = [from_status, to_status, days]
+        if group_by == "hour":
+            args.append(config.TIMEZONE)
+        records = await self.fetch(query, *args)
+        return [
+            {
+                "group": record["grp"],
+                "count": record["count"],
+                "p50": record["pct"][0],
+                "p90": record["pct"][1],
+                "p99": record["pct"][2],
+            }
+            for record in records
+        ]
+
     async def get_orders_for_export(self, period: str) -> list:
         """
         Получает список заказов из БД для экспорта в CSV.
@@ -231,7 +345,7 @@ class PostgresClient:
         # Для 'all' query_part остается пустым, чтобы выбрать все заказы
 
         query = f"SELECT * FROM orders {query_part} ORDER BY created_at DESC"
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetch(query)
 
     async def get_orders_by_date(self, report_date: datetime.date) -> list:
@@ -245,7 +359,7 @@ class PostgresClient:
             Список записей о заказах.
         """
         query = "SELECT * FROM orders WHERE created_at::date = $1 ORDER BY created_at DESC"
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetch(query, report_date)
 
 
@@ -4,6 +4,7 @@ from aiogram import Router, Bot
 from aiogram.types import Update
 
 from config import config
+from core.services.send_scheduler import send_priority, Priority
 
 
 async def handle_error(update: Update, exception: Exception, bot: Bot):
@@ -42,7 +43,8 @@ async def handle_error(update: Update, exception: Exception, bot: Bot):
         # Урезаем сообщение, если оно слишком длинное для Telegram
         if len(error_message) > 4096:
             error_message = error_message[:4000] + "...\n\n(сообщение урезано)"
-        await bot.send_message(config.ADMIN_CHAT_ID, error_message)
+        with send_priority(Priority.NOTIFICATION):
+            await bot.send_message(config.ADMIN_CHAT_ID, error_message)
     except Exception as e:
         logger.error(f"Не удалось отправить сообщение об ошибке администратору: {e}")
 
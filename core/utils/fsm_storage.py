@@ -0,0 +1,41 @@
+# core/utils/fsm_storage.py
+import json
+from typing import Any, Dict
+
+import msgpack
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+
+def pack_data(data: Dict[str, Any]) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack_data(value: bytes | str) -> Dict[str, Any]:
+    """
+    Читает данные FSM в msgpack. Старые записи в JSON (начинаются с '{' —
+    такого первого байта у msgpack-словаря не бывает) читаются как раньше,
+    пока их не перепишет очередной set_data или скрипт миграции.
+    """
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if value[:1] == b"{":
+        return json.loads(value)
+    return msgpack.unpackb(value, raw=False)
+
+
+class MsgpackRedisStorage(RedisStorage):
+    """
+    RedisStorage, хранящий данные FSM в msgpack вместо JSON.
+    Запись идет через json_dumps базового класса (его же использует
+    CachedFSMContext), чтение переопределено: базовый класс декодирует байты как UTF-8.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, json_dumps=pack_data, json_loads=unpack_data, **kwargs)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await self.redis.get(self.key_builder.build(key, "data"))
+        if value is None:
+            return {}
+        return unpack_data(value)
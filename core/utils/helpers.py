@@ -1,4 +1,6 @@
 # core/utils/helpers.py
+import uuid
+from typing import Optional
 
 # --- 1. ПРАЙС-ЛИСТ ---
 # Теперь прайс-лист живет здесь, в одном месте
@@ -31,3 +33,45 @@ def calculate_order_total(order_data: dict) -> int:
     if croissant and croissant != "Без добавок":
         total_price += PRICES.get("croissant", 0)
     return total_price
+
+
+# --- 3. ЖИЗНЕННЫЙ ЦИКЛ ЗАКАЗА ---
+# Допустимые переходы статусов заказа. Всё, чего нет в таблице, — запрещено.
+ORDER_STATUS_TRANSITIONS = {
+    "new": {"in_progress", "cancelled"},
+    "in_progress": {"ready", "cancelled"},
+    "ready": {"arrived", "completed", "cancelled"},
+    "arrived": {"completed", "cancelled"},
+    "completed": set(),
+    "cancelled": set(),
+}
+
+
+def is_valid_status_transition(current_status: str, new_status: str) -> bool:
+    """Проверяет, разрешен ли переход заказа из current_status в new_status."""
+    return new_status in ORDER_STATUS_TRANSITIONS.get(current_status, set())
+
+
+def allowed_source_statuses(new_status: str) -> list[str]:
+    """Статусы, из которых разрешен переход в new_status (для условия WHERE status = ANY(...))."""
+    return [status for status, targets in ORDER_STATUS_TRANSITIONS.items() if new_status in targets]
+
+
+# --- 4. ЗАКРЫТАЯ ПОПЫТКА ОПЛАТЫ ---
+def detach_payment(data: dict, payment_id: str) -> tuple[bool, Optional[int]]:
+    """
+    Отвязывает закрытый (failed/expired) платеж от данных FSM.
+
+    Убирает payment_id и payment_message_id и выдает новый checkout_token: ключ
+    прежней попытки занят в payments и в защите от повторных нажатий, а повторное
+    "Оплатить" должно создать новый счет. Возвращает (изменены ли данные,
+    id сообщения со ссылкой на оплату для удаления).
+    """
+    # В FSM может быть уже другой, более новый платеж
+    if data.get('payment_id') != payment_id:
+        return False, None
+    message_id = data.pop('payment_message_id', None)
+    data.pop('payment_id', None)
+    if data.get('checkout_token'):
+        data['checkout_token'] = uuid.uuid4().hex
+    return True, message_id
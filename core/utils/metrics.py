@@ -0,0 +1,96 @@
+# core/utils/metrics.py
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from redis.asyncio.client import Redis
+
+# Внешние зависимости, время которых учитывается отдельно от времени хэндлера
+DEPENDENCIES = ("db", "redis", "telegram", "epay")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+UPDATE_LATENCY = Histogram(
+    "bot_update_duration_seconds", "Полное время обработки апдейта",
+    ["handler", "pattern"], buckets=LATENCY_BUCKETS
+)
+UPDATE_ERRORS = Counter(
+    "bot_update_errors_total", "Необработанные исключения в хэндлерах",
+    ["handler", "pattern", "error"]
+)
+DEPENDENCY_LATENCY = Histogram(
+    "bot_update_dependency_seconds", "Время, потраченное апдейтом на БД, Redis, Telegram API и Epay",
+    ["handler", "dependency"], buckets=LATENCY_BUCKETS
+)
+DEPENDENCY_CALLS = Counter(
+    "bot_dependency_calls_total", "Количество обращений к БД, Redis, Telegram API и Epay",
+    ["dependency"]
+)
+THROTTLED = Counter(
+    "bot_throttled_total", "Запросы, отклоненные анти-флуд ограничением", ["budget"]
+)
+EPAY_LATENCY = Histogram(
+    "epay_request_duration_seconds", "Время запросов к платежному шлюзу Epay",
+    ["operation"], buckets=LATENCY_BUCKETS
+)
+EPAY_REQUESTS = Counter(
+    "epay_requests_total", "Запросы к Epay по результату (ok, timeout, error, server_error, rejected)",
+    ["operation", "outcome"]
+)
+PAYMENTS_SWEPT = Counter(
+    "payments_swept_total", "Результаты очистки зависших платежей (expired, failed, paid, deferred)", ["outcome"]
+)
+PENDING_PAYMENTS = Gauge(
+    "payments_pending", "Платежи в статусе pending после очередного прохода очистки"
+)
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state", "Состояние предохранителя: 0 closed, 1 half_open, 2 open", ["name"]
+)
+CIRCUIT_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total", "Переходы предохранителя по целевому состоянию", ["name", "state"]
+)
+
+# Накопитель текущего апдейта: имя хэндлера, шаблон callback_data и время по зависимостям.
+# Задачи, запущенные из хэндлера, наследуют контекст и пишут в тот же словарь.
+_update_timings: ContextVar[Optional[dict]] = ContextVar("update_timings", default=None)
+
+
+def start_update_timings() -> tuple[dict, Token]:
+    timings = {"handler": "unhandled", "pattern": "", **{name: 0.0 for name in DEPENDENCIES}}
+    return timings, _update_timings.set(timings)
+
+
+def finish_update_timings(token: Token) -> None:
+    _update_timings.reset(token)
+
+
+def set_update_handler(handler: str, pattern: str) -> None:
+    """Запоминает, какой хэндлер обработал текущий апдейт (вызывается из inner-middleware)."""
+    timings = _update_timings.get()
+    if timings is not None:
+        timings["handler"] = handler
+        timings["pattern"] = pattern
+
+
+@contextmanager
+def track_dependency(name: str):
+    """Засекает время обращения к зависимости и добавляет его к текущему апдейту."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        DEPENDENCY_CALLS.labels(name).inc()
+        timings = _update_timings.get()
+        if timings is not None:
+            timings[name] += elapsed
+
+
+class InstrumentedRedis(Redis):
+    """Redis-клиент, учитывающий время каждой команды в метриках."""
+
+    async def execute_command(self, *args, **options):
+        with track_dependency("redis"):
+            return await super().execute_command(*args, **options)
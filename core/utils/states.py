@@ -1,3 +1,5 @@
+from typing import TypedDict
+
 from aiogram.fsm.state import StatesGroup, State
 
 
@@ -11,6 +13,31 @@ class Order(StatesGroup):
     ready = State()
 
 
+class OrderData(TypedDict, total=False):
+    """
+    Данные FSM заказа, которые хранятся в Redis (до 48 ч).
+    Только значения, нужные следующим шагам, — никаких дампов апдейтов.
+    """
+    # Параметры заказа
+    type: str
+    syrup: str
+    cup: str
+    time: str
+    croissant: str
+    use_free: bool
+    free_coffees_count: int
+    # Ключ попытки оформления: выдается при подтверждении, защищает от повторных нажатий
+    checkout_token: str
+    # Сообщение с подтверждением заказа — его редактируем после успешной оплаты
+    confirm_chat_id: int
+    confirm_message_id: int
+    # Сообщение со ссылкой на оплату — удаляем после оплаты или истечения счета
+    payment_message_id: int
+    # Платеж, к которому относится payment_message_id
+    payment_id: str
+    last_order_id: int
+
+
 class Broadcast(StatesGroup):
     waiting_for_message = State()
 
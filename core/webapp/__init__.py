@@ -1,28 +1,46 @@
 # core/webapp/__init__.py
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.staticfiles import StaticFiles
+import hmac
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response, HTTPException, Depends
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from brotli_asgi import BrotliMiddleware
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
 from loguru import logger
 
+from config import config
 from .api.orders import router as api_router, get_all_active_orders_from_db
-from .ws.orders_ws import manager
+from .ws.orders_ws import manager, parse_topics
+from .orders_cache import active_orders_cache
+from .http_cache import FingerprintedStaticFiles, json_response_with_etag, static_url
 
 from .epay_payment_hooks import router as payment_router
+from .telegram_webhook import router as telegram_router
 
 # Создаем приложение FastAPI
 app = FastAPI(title="Coffee Shop WebApp")
 
+# Сжатие JSON и статики: brotli для клиентов, которые его понимают, иначе gzip
+app.add_middleware(BrotliMiddleware, minimum_size=500, gzip_fallback=True)
+
 # Пути к статике и шаблонам
 BASE_DIR = Path(__file__).resolve().parent
-app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
+app.mount("/static", FingerprintedStaticFiles(directory=BASE_DIR / "static"), name="static")
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
+templates.env.globals["static_url"] = static_url
 
 # Подключаем роутеры API
 app.include_router(api_router)
 
 app.include_router(payment_router, prefix="/webhooks", tags=["Webhooks"])
+app.include_router(telegram_router, tags=["Webhooks"])
+
+# Кэш активной доски обновляется теми же событиями, что уходят в WebSocket
+manager.add_listener(active_orders_cache.apply_event)
+# Топики событий (точка, станция, полоса статуса) берутся из того же снимка
+manager.topic_resolver = active_orders_cache.topics_for
 
 
 @app.get("/api/orders", include_in_schema=False)
@@ -30,9 +48,14 @@ app.include_router(payment_router, prefix="/webhooks", tags=["Webhooks"])
 async def get_active_orders_direct(request: Request):
     """
     Прямая регистрация эндпоинта для обхода проблем с APIRouter.
+    Отдает снимок из памяти с ETag (на совпадающий If-None-Match — 304);
+    в БД идем, только если кэш еще не загружен.
     """
-    logger.info(f"✅✅✅ ПОПАДАНИЕ В ПРЯМОЙ ЭНДПОИНТ: {request.url.path}")
-    return await get_all_active_orders_from_db()
+    if not active_orders_cache.loaded:
+        logger.warning("Orders cache is not loaded yet, reading active orders from DB")
+        return await get_all_active_orders_from_db()
+    return json_response_with_etag(request, active_orders_cache.body, active_orders_cache.etag,
+                                   active_orders_cache.version_headers)
 
 
 # Главная страница доски заказов
@@ -44,9 +67,56 @@ async def get_board(request: Request):
 # Эндпоинт для WebSocket
 @app.websocket("/ws/orders")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    # ?topics=location:main,station:pastry — доска получает только свои события
+    subscription = parse_topics(websocket.query_params.get("topics"))
+    if not await manager.connect(websocket, subscription):
+        return
     try:
         while True:
+            # Клиент отвечает "pong" на серверный ping; любое сообщение продлевает жизнь сокета
             await websocket.receive_text()
-    except WebSocketDisconnect:
+            manager.touch(websocket)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
         manager.disconnect(websocket)
+
+
+def require_metrics_token(request: Request) -> None:
+    """
+    Зависимость служебных эндпоинтов (/metrics, /ws/stats): нужен заголовок
+    Authorization: Bearer <METRICS_TOKEN>. Без токена или с неверным — 401.
+    """
+    token = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not config.METRICS_TOKEN or not hmac.compare_digest(token.encode(), config.METRICS_TOKEN.encode()):
+        logger.warning(f"{request.url.path}: неверный токен от {request.client}")
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/ws/stats", include_in_schema=False, dependencies=[Depends(require_metrics_token)])
+async def websocket_stats():
+    """Текущее число WebSocket-подключений и счетчики подключений/отказов/зачисток."""
+    return manager.stats()
+
+
+class WebSocketCollector:
+    """Отдает счетчики ConnectionManager в формате Prometheus в момент запроса /metrics."""
+
+    def collect(self):
+        stats = manager.stats()
+        yield GaugeMetricFamily("ws_active_connections", "Открытые WebSocket-подключения доски",
+                                value=stats.pop("active_connections"))
+        for name, value in stats.items():
+            yield CounterMetricFamily(f"ws_{name.removesuffix('_total')}", f"WebSocket: {name}", value=value)
+
+
+REGISTRY.register(WebSocketCollector())
+
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_metrics_token)])
+async def metrics():
+    """
+    Метрики бота (время хэндлеров, БД/Redis/Telegram, ошибки) и доски в формате Prometheus.
+    Доступны только с заголовком Authorization: Bearer <METRICS_TOKEN>.
+    """
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
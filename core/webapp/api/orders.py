@@ -1,37 +1,75 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response, Query
 from loguru import logger
 from asyncpg import Record
+from pydantic import BaseModel, Field
+from typing import Optional
+import base64
 import datetime
+import json
 
 from core.utils.database import postgres_client
 from core.webapp.ws.orders_ws import manager
+from core.webapp.http_cache import etag_matches, json_response_with_etag, REVALIDATE_CACHE_CONTROL
 
 # <<< --- ИЗМЕНЕНИЕ: ИМПОРТИРУЕМ ИЗ НОВОГО ФАЙЛА --- >>>
-from core.utils.helpers import calculate_order_total
+from core.utils.helpers import calculate_order_total, is_valid_status_transition
 
 router = APIRouter(prefix="/api/orders", tags=["Orders"])
 
 
-async def get_all_active_orders_from_db():
+async def fetch_active_orders() -> list[dict]:
+    """
+    Читает активные заказы из БД. В отличие от get_all_active_orders_from_db
+    пробрасывает ошибки наружу — это нужно кэшу доски, чтобы сбой БД
+    не превратился в "пустую" доску.
+    """
     query = "SELECT * FROM orders WHERE status NOT IN ('completed', 'cancelled') ORDER BY timestamp ASC"
+    records: list[Record] = await postgres_client.fetch(query)
+    orders_with_price = []
+    for record in records:
+        order_dict = dict(record)
+        # ТЕПЕРЬ ЭТО БУДЕТ РАБОТАТЬ
+        order_dict['total_price'] = calculate_order_total(order_dict)
+        orders_with_price.append(order_dict)
+    return orders_with_price
+
+
+async def get_all_active_orders_from_db():
     try:
-        records: list[Record] = await postgres_client.fetch(query)
-        orders_with_price = []
-        for record in records:
-            order_dict = dict(record)
-            # ТЕПЕРЬ ЭТО БУДЕТ РАБОТАТЬ
-            order_dict['total_price'] = calculate_order_total(order_dict)
-            orders_with_price.append(order_dict)
-        return orders_with_price
+        return await fetch_active_orders()
     except Exception as e:
         logger.error(f"Failed to fetch active orders: {e}")
         return []
 
 
+COMPLETED_TODAY = "status = 'completed' AND created_at::date = NOW()::date"
+
+
+async def completed_orders_etag() -> str:
+    """
+    Слабый ETag списка завершенных за сегодня. Статус completed конечный, поэтому
+    список меняется только новым завершенным заказом (растет COUNT) или правкой
+    уже завершенного (триггер двигает updated_at); дата — смена дня.
+    """
+    row = await postgres_client.fetchrow(
+        f"SELECT NOW()::date AS day, COUNT(*) AS total, MAX(updated_at) AS changed FROM orders WHERE {COMPLETED_TODAY}"
+    )
+    changed = int(row['changed'].timestamp() * 1_000_000) if row['changed'] else 0
+    return f'W/"completed-{row["day"].isoformat()}-{row["total"]}-{changed}"'
+
+
 @router.get("/completed")
-async def get_completed_orders_today():
-    query = "SELECT * FROM orders WHERE status = 'completed' AND created_at::date = NOW()::date ORDER BY timestamp DESC"
+async def get_completed_orders_today(request: Request):
+    # Импортируем здесь, чтобы избежать циклических зависимостей
+    from core.webapp.orders_cache import serialize_orders
+
+    query = f"SELECT * FROM orders WHERE {COMPLETED_TODAY} ORDER BY timestamp DESC"
     try:
+        # Отпечаток списка дешевле самого списка: при совпадении заказы не читаем
+        etag = await completed_orders_etag()
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL})
+
         records: list[Record] = await postgres_client.fetch(query)
         orders_with_price = []
         for record in records:
@@ -39,25 +77,99 @@ async def get_completed_orders_today():
             # И ЗДЕСЬ ТОЖЕ
             order_dict['total_price'] = calculate_order_total(order_dict)
             orders_with_price.append(order_dict)
-        return orders_with_price
     except Exception as e:
         logger.error(f"Failed to fetch completed orders: {e}")
         return []
 
+    return json_response_with_etag(request, serialize_orders(orders_with_price), etag)
+
+
+# Компактная проекция заказа для истории: только то, что нужно карточке
+HISTORY_COLUMNS = (
+    "order_id, type, cup, syrup, croissant, status, payment_status, "
+    "total_price, is_free, created_at, updated_at"
+)
+HISTORY_MAX_LIMIT = 200
+
+
+def encode_history_cursor(created_at: datetime.datetime, order_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), order_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.datetime.fromisoformat(created_at), int(order_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/history")
+async def get_orders_history(
+        status: Optional[list[str]] = Query(None),
+        payment_status: Optional[list[str]] = Query(None),
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None,
+        cursor: Optional[str] = None,
+        limit: int = Query(50, ge=1, le=HISTORY_MAX_LIMIT),
+):
+    """
+    История заказов с keyset-пагинацией по (created_at, order_id), от новых к старым.
+    date_from / date_to — включительные границы по дате создания.
+    В ответе next_cursor, который передается в следующий запрос; null — страниц больше нет.
+    """
+    conditions, params = [], []
+
+    def add_param(value) -> str:
+        params.append(value)
+        return f"${len(params)}"
+
+    if status:
+        conditions.append(f"status = ANY({add_param(status)}::varchar[])")
+    if payment_status:
+        conditions.append(f"payment_status = ANY({add_param(payment_status)}::varchar[])")
+    if date_from:
+        conditions.append(f"created_at >= {add_param(date_from)}::date")
+    if date_to:
+        conditions.append(f"created_at < {add_param(date_to)}::date + 1")
+    if cursor:
+        cursor_created_at, cursor_order_id = decode_history_cursor(cursor)
+        conditions.append(f"(created_at, order_id) < ({add_param(cursor_created_at)}, {add_param(cursor_order_id)})")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+    query = (f"SELECT {HISTORY_COLUMNS} FROM orders {where} "
+             f"ORDER BY created_at DESC, order_id DESC LIMIT {add_param(limit + 1)}")
+
+    try:
+        records: list[Record] = await postgres_client.fetch(query, *params)
+    except Exception as e:
+        logger.error(f"Failed to fetch orders history: {e}")
+        raise HTTPException(status_code=500, detail="Database query failed")
+
+    items = [dict(record) for record in records[:limit]]
+    next_cursor = None
+    if len(records) > limit:
+        last = items[-1]
+        next_cursor = encode_history_cursor(last['created_at'], last['order_id'])
+    return {"items": items, "next_cursor": next_cursor}
+
 
 async def update_order_status_in_db(order_id: int, status: str):
     try:
-        await postgres_client.update(
-            table="orders",
-            data={"status": status},
-            where="order_id = $1",
-            params=[order_id]
-        )
-        logger.info(f"Updated order {order_id} to status '{status}' in DB")
-        return {"status": "success", "order_id": order_id, "new_status": status}
+        applied, current_status = await postgres_client.update_order_status(order_id, status)
     except Exception as e:
         logger.error(f"Failed to update order {order_id} status: {e}")
         raise HTTPException(status_code=500, detail="Database update failed")
+    if current_status is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    if not applied:
+        # Переход не разрешен ORDER_STATUS_TRANSITIONS (или заказ уже сменил статус)
+        raise HTTPException(status_code=409, detail={"reason": "invalid_transition",
+                                                     "current_status": current_status, "new_status": status})
+    logger.info(f"Updated order {order_id} to status '{status}' in DB")
+    return {"status": "success", "order_id": order_id, "new_status": status}
 
 
 @router.put("/{order_id}/status")
@@ -75,3 +187,97 @@ async def update_order_status(order_id: int, status: str):
     })
 
     return result
+
+
+class StatusTransition(BaseModel):
+    order_id: int
+    expected_status: str
+    new_status: str
+
+
+class BatchStatusRequest(BaseModel):
+    transitions: list[StatusTransition] = Field(..., min_length=1, max_length=100)
+
+
+# Один запрос: переходы применяются только там, где текущий статус совпал с ожидаемым,
+# и тем же запросом дописываются в журнал order_status_events.
+# cur блокирует строки (в порядке order_id — без взаимоблокировок между пакетами) и читает
+# их последнюю версию, а не снимок начала запроса: статус конфликта — фактический.
+# Для примененных переходов current_status — статус строки после UPDATE.
+BATCH_STATUS_QUERY = """
+WITH t AS (
+    SELECT * FROM unnest($1::int[], $2::varchar[], $3::varchar[]) AS t(order_id, expected_status, new_status)
+),
+cur AS (
+    SELECT o.order_id, o.status FROM orders o
+    WHERE o.order_id IN (SELECT order_id FROM t)
+    ORDER BY o.order_id
+    FOR UPDATE
+),
+upd AS (
+    UPDATE orders o SET status = t.new_status
+    FROM t JOIN cur ON cur.order_id = t.order_id
+    WHERE o.order_id = t.order_id AND cur.status = t.expected_status
+    RETURNING o.order_id, o.status
+),
+status_event AS (
+    INSERT INTO order_status_events (order_id, from_status, to_status)
+    SELECT t.order_id, t.expected_status, t.new_status FROM t JOIN upd ON upd.order_id = t.order_id
+)
+SELECT t.order_id, t.expected_status, t.new_status,
+       upd.order_id IS NOT NULL AS applied,
+       COALESCE(upd.status, cur.status) AS current_status
+FROM t
+LEFT JOIN upd ON upd.order_id = t.order_id
+LEFT JOIN cur ON cur.order_id = t.order_id
+"""
+
+
+@router.post("/status/batch")
+async def update_order_statuses_batch(payload: BatchStatusRequest):
+    """
+    Пакетная смена статусов с оптимистичной блокировкой.
+    Каждый переход применяется, только если заказ все еще в expected_status
+    и переход разрешен машиной состояний. Возвращает примененные переходы
+    и конфликты по каждому заказу; на доску уходит одно WS-сообщение.
+    """
+    conflicts, valid, seen = [], [], set()
+    for transition in payload.transitions:
+        if transition.order_id in seen:
+            reason = "duplicate"
+        elif not is_valid_status_transition(transition.expected_status, transition.new_status):
+            reason = "invalid_transition"
+        else:
+            reason = None
+        seen.add(transition.order_id)
+        if reason:
+            conflicts.append({**transition.model_dump(), "current_status": None, "reason": reason})
+        else:
+            valid.append(transition)
+
+    applied = []
+    if valid:
+        try:
+            records: list[Record] = await postgres_client.fetch(
+                BATCH_STATUS_QUERY,
+                [t.order_id for t in valid], [t.expected_status for t in valid], [t.new_status for t in valid]
+            )
+        except Exception as e:
+            logger.error(f"Failed to apply batch status update: {e}")
+            raise HTTPException(status_code=500, detail="Database update failed")
+
+        for record in records:
+            if record['applied']:
+                applied.append({"order_id": record['order_id'], "new_status": record['new_status']})
+            else:
+                conflicts.append({
+                    "order_id": record['order_id'], "expected_status": record['expected_status'],
+                    "new_status": record['new_status'], "current_status": record['current_status'],
+                    "reason": "not_found" if record['current_status'] is None else "status_changed"
+                })
+
+    if applied:
+        logger.info(f"Batch status update applied to {len(applied)} orders, {len(conflicts)} conflicts")
+        await manager.broadcast({"type": "status_batch", "payload": {"updates": applied}})
+
+    return {"applied": applied, "conflicts": conflicts}
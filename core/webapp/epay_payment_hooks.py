@@ -1,14 +1,16 @@
-from fastapi import APIRouter, Request, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Request, HTTPException
 from pydantic import BaseModel
 from loguru import logger
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.context import FSMContext
+from aiogram.types import User
 import json
 from aiogram.fsm.storage.base import StorageKey
 from typing import Optional
 
 from core.utils.database import postgres_client
-from config import config
+from core.utils.helpers import detach_payment
+from core.services.payment_jobs import enqueue_payment_job, payment_job_workers, JOB_SUCCESS, JOB_FAILURE
 
 router = APIRouter()
 
@@ -50,6 +52,13 @@ def get_bot(request: Request) -> Bot:
     return request.app.state.bot_instance
 
 
+def get_bot_info(request: Request) -> User:
+    """FastAPI зависимость для получения данных бота, загруженных при старте."""
+    if not getattr(request.app.state, 'bot_info', None):
+        raise HTTPException(status_code=500, detail="Bot info not available.")
+    return request.app.state.bot_info
+
+
 def get_dispatcher(request: Request) -> Dispatcher:
     """FastAPI зависимость для получения экземпляра Dispatcher из состояния приложения."""
     if not hasattr(request.app.state, 'dp') or not request.app.state.dp:
@@ -57,148 +66,203 @@ def get_dispatcher(request: Request) -> Dispatcher:
     return request.app.state.dp
 
 
+async def fail_payment(payment_id: str) -> None:
+    """
+    Помечает платеж ошибочным и сообщает пользователю (заказ по оплате создать не удалось).
+    Сообщение ставится в outbox той же транзакцией, что и статус: сбой Telegram его не потеряет.
+    """
+    # Импортируем здесь, чтобы избежать циклических зависимостей
+    from core.services.notification_outbox import enqueue_notification, outbox_dispatcher
+
+    async with postgres_client.acquire() as conn:
+        async with conn.transaction():
+            user_id = await conn.fetchval(
+                """
+                UPDATE payments SET status = 'error'
+                WHERE payment_id = $1 AND status IN ('pending', 'processing')
+                RETURNING user_id
+                """,
+                payment_id
+            )
+            if not user_id:
+                return
+            await enqueue_notification(
+                conn, user_id,
+                text="❌ Оплата прошла, но произошла ошибка при оформлении заказа. Свяжитесь с поддержкой."
+            )
+    outbox_dispatcher.wake()
+
+
 async def process_successful_payment(payment_id: str, bot: Bot, dp: Dispatcher):
     """
-    Фоновая задача, обрабатывающая успешный платеж.
+    Задание очереди payment_jobs: создает заказ по успешному платежу.
+
+    Платеж захватывается атомарно (UPDATE ... SET status = 'processing' WHERE status = 'pending'),
+    и в той же транзакции создаются заказ, статус paid и уведомления. Одновременные
+    повторы ждут блокировку строки платежа и после коммита первого уже не находят
+    его в pending, поэтому заказ создается ровно один раз. Счет, снятый с ожидания
+    очисткой (expired), тоже принимается: деньги списаны — заказ должен быть создан.
+    Если заказ создать не удалось, транзакция откатывается (платеж снова pending)
+    и бросается исключение — задание будет повторено, а после исчерпания попыток
+    платеж помечается ошибочным (fail_payment).
     """
     # Импортируем здесь, чтобы избежать циклических зависимостей
-    from core.handlers.basic import process_and_save_order, format_barista_notification
+    from core.handlers.basic import process_and_save_order, publish_new_order
+    from core.services.notification_outbox import enqueue_notification, outbox_dispatcher
     from core.keyboards.inline.inline_menu import ready_cofe_ikb
     from core.utils.states import Order
 
-    logger.info(f"Начинаем фоновую обработку успешного платежа #{payment_id}")
-
-    payment = await postgres_client.fetchrow(
-        "SELECT * FROM payments WHERE payment_id = $1 AND status = 'pending'", payment_id
-    )
-    if not payment:
-        logger.warning(f"Фоновая задача: Платеж #{payment_id} не найден или уже обработан.")
-        return
-
-    user_id = payment['user_id']
-    order_data = json.loads(payment['order_data'])
-    amount = payment['amount']
+    logger.info(f"Начинаем обработку успешного платежа #{payment_id}")
 
-    user_info = await postgres_client.fetchrow("SELECT username, first_name FROM users WHERE telegram_id = $1", user_id)
-    if not user_info:
-        logger.error(f"Не удалось найти пользователя {user_id} для обработки платежа #{payment_id}")
-        await postgres_client.update("payments", {"status": "error"}, "payment_id = $1", [payment_id])
+    user_id = await postgres_client.fetchval("SELECT user_id FROM payments WHERE payment_id = $1", payment_id)
+    if not user_id:
+        logger.warning(f"Платеж #{payment_id} не найден.")
         return
 
-    # <--- ИЗМЕНЕНИЕ: Убираем 'bot=bot' и сохраняем результат ---
-    result = await process_and_save_order(
-        order_data=order_data,
-        user_id=user_id,
-        username=user_info['username'],
-        first_name=user_info['first_name'],
-        payment_id=payment_id,
-        status='new'
-    )
-
+    # Данные FSM читаем до транзакции, чтобы не держать блокировку платежа во время запросов к Redis
     storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
     state = FSMContext(storage=dp.storage, key=storage_key)
     state_data = await state.get_data()
 
-    if result:
-        order_record = result['order_record']
-        notification_info = result['notification_info']
-        order_id = order_record['order_id']
-
-        await postgres_client.update(
-            "payments", {"status": "paid", "order_id": order_id}, "payment_id = $1", [payment_id]
-        )
-
-        # <--- ИЗМЕНЕНИЕ: Отправляем уведомления отсюда ---
-        try:
-            barista_text = format_barista_notification(order_record, user_info['username'], user_info['first_name'])
-            await bot.send_message(chat_id=config.BARISTA_ID, text=barista_text, parse_mode="HTML")
-
-            if 'referrer_id' in notification_info:
-                referrer_id = notification_info['referrer_id']
-                await bot.send_message(
-                    chat_id=referrer_id,
-                    text="🎉 Вам начислен бонус! За то, что ваш друг сделал первый заказ, вы получили один бесплатный кофе."
-                )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомления для оплаченного заказа #{order_id}: {e}")
-
-        # Обновляем сообщение у пользователя
-        try:
-            last_callback_query = state_data.get('last_callback')
-            if last_callback_query:
+    # Захват платежа, заказ, статус paid и все уведомления (бариста, реферер, пользователь)
+    # фиксируются одной транзакцией; уведомления отправляет outbox_dispatcher
+    async with postgres_client.acquire() as conn:
+        async with conn.transaction():
+            payment = await conn.fetchrow(
+                """
+                UPDATE payments SET status = 'processing'
+                WHERE payment_id = $1 AND status IN ('pending', 'expired')
+                RETURNING *
+                """,
+                payment_id
+            )
+            if not payment:
+                logger.warning(f"Платеж #{payment_id} уже обработан или обрабатывается.")
+                return
+
+            order_data = json.loads(payment['order_data'])
+            amount = payment['amount']
+
+            user_info = await conn.fetchrow(
+                "SELECT username, first_name FROM users WHERE telegram_id = $1", user_id
+            )
+            if not user_info:
+                logger.error(f"Не удалось найти пользователя {user_id} для обработки платежа #{payment_id}")
+                await conn.execute("UPDATE payments SET status = 'error' WHERE payment_id = $1", payment_id)
+                return
+
+            result = await process_and_save_order(
+                order_data=order_data,
+                user_id=user_id,
+                username=user_info['username'],
+                first_name=user_info['first_name'],
+                payment_id=payment_id,
+                status='new',
+                conn=conn
+            )
+            if not result:
+                # Откатываем захват платежа: задание будет повторено
+                raise RuntimeError(f"Не удалось создать заказ по платежу #{payment_id}")
+
+            order_id = result['order_record']['order_id']
+            await conn.execute(
+                "UPDATE payments SET status = 'paid', order_id = $2 WHERE payment_id = $1", payment_id, order_id
+            )
+
+            # Обновляем сообщение у пользователя; если его нельзя отредактировать — шлем новое
+            fallback = {"method": "send_message",
+                        "text": f"✅ Ваша покупка прошла успешно! Заказ №{order_id} оформлен."}
+            confirm_message_id = state_data.get('confirm_message_id')
+            if confirm_message_id:
                 caption_text = (f"✅ Ваш заказ №{order_id} на сумму {amount} Т успешно оплачен!\n"
                                 f"Когда будешь у входа — нажми кнопку ниже, и мы вынесем напиток 👇")
-                await bot.edit_message_caption(
-                    chat_id=user_id, message_id=last_callback_query['message']['message_id'],
+                await enqueue_notification(
+                    conn, state_data.get('confirm_chat_id', user_id), "edit_message_caption",
+                    fallback=fallback, message_id=confirm_message_id,
                     caption=caption_text, reply_markup=ready_cofe_ikb
                 )
-                logger.info(f"Сообщение для заказа #{order_id} успешно отредактировано.")
             else:
-                raise ValueError("Не найден last_callback в состоянии FSM")
-        except Exception as e:
-            logger.error(f"Не удалось отредактировать сообщение после оплаты: {e}. Отправляем новое.")
-            text = f"✅ Ваша покупка прошла успешно! Заказ №{order_id} оформлен."
-            await bot.send_message(chat_id=user_id, text=text)
-
-        # Удаляем сообщение со ссылкой на оплату
-        try:
+                logger.warning(f"Не найден confirm_message_id в состоянии FSM пользователя {user_id}")
+                await enqueue_notification(conn, user_id, **fallback)
+
+            # Удаляем сообщение со ссылкой на оплату
             payment_message_id = state_data.get('payment_message_id')
             if payment_message_id:
-                await bot.delete_message(chat_id=user_id, message_id=payment_message_id)
-                logger.info(f"Сообщение со ссылкой на оплату ({payment_message_id}) удалено.")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение со ссылкой на оплату: {e}")
-
-        await state.set_state(Order.ready)
-        await state.update_data(last_order_id=order_id)
-        logger.info(f"Пользователь {user_id} переведен в состояние Order.ready для заказа #{order_id}.")
-    else:
-        await postgres_client.update("payments", {"status": "error"}, "payment_id = $1", [payment_id])
-        text = f"❌ Оплата прошла, но произошла ошибка при оформлении заказа. Свяжитесь с поддержкой."
-        await bot.send_message(chat_id=user_id, text=text)
+                await enqueue_notification(conn, user_id, "delete_message", message_id=payment_message_id)
+
+    if not result.get('duplicate'):
+        await publish_new_order(result['order_record'])
+    outbox_dispatcher.wake()
+
+    await state.set_state(Order.ready)
+    await state.update_data(last_order_id=order_id)
+    logger.info(f"Пользователь {user_id} переведен в состояние Order.ready для заказа #{order_id}.")
+
+
+async def process_failed_payment(payment_id: str, reason: Optional[str], bot: Bot, dp: Dispatcher):
+    """
+    Задание очереди payment_jobs: неуспешная оплата — отмечаем платеж и сообщаем пользователю.
+    Статус failed, удаление ссылки на оплату и сообщение о неудаче фиксируются одной
+    транзакцией; отправляет их outbox_dispatcher.
+    """
+    # Импортируем здесь, чтобы избежать циклических зависимостей
+    from core.services.notification_outbox import enqueue_notification, outbox_dispatcher
+
+    user_id = await postgres_client.fetchval("SELECT user_id FROM payments WHERE payment_id = $1", payment_id)
+    if not user_id:
+        logger.warning(f"Получен failed-вебхук для неизвестного платежа #{payment_id}.")
+        return
+
+    # Данные FSM читаем до транзакции, как и при успешной оплате
+    storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+    state = FSMContext(storage=dp.storage, key=storage_key)
+    state_data = await state.get_data()
+    # Как и при очистке зависших платежей: новый ключ попытки, иначе повторное
+    # "Оплатить" до истечения IDEMPOTENCY_RESULT_TTL упрется в результат неудавшегося счета
+    detached, payment_message_id = detach_payment(state_data, payment_id)
+
+    async with postgres_client.acquire() as conn:
+        async with conn.transaction():
+            # Только ожидающий платеж: опоздавший failed-вебхук не должен перезаписать paid
+            failed = await conn.fetchval(
+                "UPDATE payments SET status = 'failed' WHERE payment_id = $1 AND status = 'pending' RETURNING 1",
+                payment_id
+            )
+            if not failed:
+                logger.warning(f"Получен failed-вебхук для платежа #{payment_id}, но ожидающий платеж не найден.")
+                return
+            if payment_message_id:
+                await enqueue_notification(conn, user_id, "delete_message", message_id=payment_message_id)
+            await enqueue_notification(
+                conn, user_id, text=f"❌ Ваша оплата не удалась. Причина: {reason or 'Неизвестная ошибка'}."
+            )
+    outbox_dispatcher.wake()
+
+    if detached:
+        await state.set_data(state_data)
 
 
 @router.post("/epay", include_in_schema=False)
-async def process_epay_webhook(
-        payload: EpayWebhook,
-        background_tasks: BackgroundTasks,
-        bot: Bot = Depends(get_bot),
-        dp: Dispatcher = Depends(get_dispatcher)
-):
+async def process_epay_webhook(payload: EpayWebhook):
     """
     Основной эндпоинт для приема вебхуков от Epay.
-    Работает с реальной структурой данных.
+    Только ставит задание в очередь payment_jobs и сразу отвечает: обработку
+    выполняют payment_job_workers, и она переживет перезапуск процесса.
     """
     logger.info(f"Получен вебхук от Epay: {payload.model_dump_json(indent=2)}")
     payment_id = payload.invoiceId
 
     if payload.code.lower() == "ok":
-        background_tasks.add_task(process_successful_payment, payment_id, bot, dp)
-        logger.info(f"Задача для обработки успешного платежа #{payment_id} добавлена в фон.")
-
+        kind = JOB_SUCCESS
     else:
+        kind = JOB_FAILURE
         logger.warning(f"Получен вебхук о НЕУСПЕШНОЙ оплате #{payment_id}. "
                        f"Статус: '{payload.code}'. Причина: {payload.reason} (Код: {payload.reasonCode})")
 
-        await postgres_client.update("payments", {"status": "failed"}, "payment_id = $1", [payment_id])
-        payment = await postgres_client.fetchrow("SELECT user_id FROM payments WHERE payment_id = $1", payment_id)
-        if not payment:
-            logger.warning(f"Получен failed-вебхук для платежа #{payment_id}, но сам платеж не найден.")
-            return {"status": "ok"}
-
-        user_id = payment['user_id']
-        storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
-        state = FSMContext(storage=dp.storage, key=storage_key)
-        state_data = await state.get_data()
-
-        try:
-            payment_message_id = state_data.get('payment_message_id')
-            if payment_message_id:
-                await bot.delete_message(chat_id=user_id, message_id=payment_message_id)
-                logger.info(f"Сообщение со ссылкой на неудавшийся платеж ({payment_message_id}) удалено.")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение со ссылкой на оплату при failed-статусе: {e}")
-
-        await bot.send_message(user_id, f"❌ Ваша оплата не удалась. Причина: {payload.reason or 'Неизвестная ошибка'}.")
+    if await enqueue_payment_job(payment_id, kind, payload.model_dump(exclude_none=True)):
+        payment_job_workers.wake()
+        logger.info(f"Задание ({kind}) по платежу #{payment_id} поставлено в очередь.")
+    else:
+        logger.info(f"Повторный вебхук ({kind}) по платежу #{payment_id}: задание уже в очереди.")
 
     return {"status": "ok"}
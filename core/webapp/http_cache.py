@@ -0,0 +1,86 @@
+# core/webapp/http_cache.py
+
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.types import Scope
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+
+# Статика с отпечатком в URL не меняется никогда — новая версия файла получит новый URL
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# API доски: браузер может хранить ответ, но обязан каждый раз перепроверять его по ETag
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+# ===== ETag / условные GET =====
+def _opaque_tag(etag: str) -> str:
+    return etag.strip().removeprefix("W/")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Проверяет заголовок If-None-Match против текущего ETag.
+    Сравнение слабое (RFC 9110): префикс W/ не учитывается.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [_opaque_tag(tag) for tag in header.split(",")]
+    return "*" in candidates or _opaque_tag(etag) in candidates
+
+
+def json_response_with_etag(request: Request, body: bytes, etag: str,
+                            extra_headers: Optional[dict[str, str]] = None) -> Response:
+    """
+    Возвращает 304 без тела, если клиент уже имеет эту версию,
+    иначе — готовый JSON с ETag. extra_headers добавляются в оба ответа.
+    """
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL, **(extra_headers or {})}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# ===== Отпечатки статических файлов =====
+_fingerprints: dict[str, str] = {}
+
+
+def static_fingerprint(path: str) -> Optional[str]:
+    """Короткий хэш содержимого файла из /static (считается один раз на процесс)."""
+    if path not in _fingerprints:
+        file_path = STATIC_DIR / path
+        if not file_path.is_file():
+            return None
+        _fingerprints[path] = hashlib.sha256(file_path.read_bytes()).hexdigest()[:12]
+    return _fingerprints[path]
+
+
+def static_url(path: str) -> str:
+    """URL статического файла с отпечатком содержимого: /static/main.js?v=<hash>."""
+    fingerprint = static_fingerprint(path)
+    return f"/static/{path}?v={fingerprint}" if fingerprint else f"/static/{path}"
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """
+    StaticFiles, который отдает долгоживущий Cache-Control для запросов
+    с актуальным отпечатком (?v=<hash>). Остальные запросы перепроверяются.
+    """
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code not in (200, 304):
+            return response
+
+        query = scope.get("query_string", b"").decode("latin-1")
+        params = dict(part.split("=", 1) for part in query.split("&") if "=" in part)
+        fingerprint = static_fingerprint(path)
+        if fingerprint and params.get("v") == fingerprint:
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+        return response
@@ -0,0 +1,196 @@
+# core/webapp/orders_cache.py
+
+import asyncio
+import datetime
+import json
+import time
+from typing import Optional
+
+from loguru import logger
+
+from config import config
+from core.webapp.api.orders import fetch_active_orders
+from core.webapp.ws.orders_ws import order_topics
+
+# Статусы, при которых заказ уходит с активной доски
+FINAL_STATUSES = ("completed", "cancelled")
+
+# Поля карточки заказа, которые нужны доске. Записи из БД и payload'ы
+# WS-событий приводятся к одному виду, чтобы сверка не видела ложных расхождений.
+BOARD_FIELDS = (
+    "order_id", "type", "cup", "time", "status", "syrup", "croissant", "is_free",
+    "timestamp", "total_price", "created_at", "payment_status",
+)
+
+
+def to_board_order(order: dict) -> dict:
+    return {field: order.get(field) for field in BOARD_FIELDS}
+
+
+def _json_default(value):
+    """Сериализует datetime так же, как это делает FastAPI (ISO 8601)."""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def serialize_orders(orders: list) -> bytes:
+    """Сериализует список заказов в JSON-тело ответа."""
+    return json.dumps(orders, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+
+class ActiveOrdersCache:
+    """
+    In-memory снимок активной доски заказов.
+
+    Загружается один раз при старте, дальше меняется теми же событиями,
+    что уходят в WebSocket (new_order / status_update), и периодически
+    сверяется с БД. Отдается уже сериализованным, поэтому чтение доски
+    не обращается к Postgres, сколько бы планшетов ни было открыто.
+    """
+
+    def __init__(self):
+        self.orders: dict[int, dict] = {}
+        self.version: int = 0
+        self.loaded: bool = False
+        self._body: Optional[bytes] = None
+        self._reconcile_task: Optional[asyncio.Task] = None
+        self._boot_id: str = f"{time.time_ns():x}"
+
+    # ===== Загрузка и сверка с БД =====
+    async def load(self) -> None:
+        """
+        Перечитывает активные заказы из БД.
+        Если за время запроса пришли события, снимок из БД уже устарел —
+        в этом случае подмена откладывается до следующей сверки.
+        """
+        version_before = self.version
+        records = await fetch_active_orders()
+        if self.loaded and self.version != version_before:
+            logger.debug("Orders cache: events arrived during reconcile, skipping swap")
+            return
+        orders = {record['order_id']: to_board_order(record) for record in records}
+        body = self._serialize(orders)
+        if self.loaded and body == self.body:
+            # Ничего не изменилось — версию не трогаем, чтобы не сбивать ETag у клиентов
+            return
+        self.orders = orders
+        self.loaded = True
+        self._touch()
+        self._body = body
+        logger.info(f"Orders cache loaded: {len(self.orders)} active orders (version {self.version})")
+
+    async def _reconcile_loop(self) -> None:
+        interval = config.ORDERS_CACHE_RECONCILE_SECONDS
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Orders cache reconcile failed: {e}")
+
+    async def start(self) -> None:
+        """Первичная загрузка и запуск фоновой сверки."""
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"❌ Failed to load orders cache, board will read from DB until reconcile: {e}")
+        self._reconcile_task = asyncio.create_task(self._reconcile_loop())
+        logger.info("✅ Orders cache reconcile task started")
+
+    async def stop(self) -> None:
+        if self._reconcile_task and not self._reconcile_task.done():
+            self._reconcile_task.cancel()
+            try:
+                await self._reconcile_task
+            except asyncio.CancelledError:
+                pass
+        self._reconcile_task = None
+
+    # ===== Применение событий доски =====
+    def _apply_status(self, order_id: int, new_status: str) -> None:
+        if new_status in FINAL_STATUSES:
+            self.orders.pop(order_id, None)
+        elif order_id in self.orders:
+            self.orders[order_id]['status'] = new_status
+        # Если заказа нет в снимке, его подтянет ближайшая сверка
+
+    def apply_event(self, message: dict) -> None:
+        """
+        Подписчик ConnectionManager: применяет WS-событие к снимку и дописывает
+        в него версию доски ("board"), по которой клиент замечает пропущенные события.
+        """
+        event_type = message.get("type")
+        payload = message.get("payload") or {}
+
+        if event_type == "status_batch":
+            for update in payload.get("updates", []):
+                self._apply_status(update["order_id"], update["new_status"])
+        else:
+            order_id = payload.get("order_id")
+            if order_id is None:
+                return
+            if event_type == "new_order":
+                self.orders[order_id] = to_board_order(payload)
+            elif event_type == "status_update":
+                self._apply_status(order_id, payload.get("new_status"))
+            else:
+                return
+        self._touch()
+        message["board"] = {"boot": self._boot_id, "version": self.version}
+
+    def topics_for(self, message: dict) -> Optional[set[str]]:
+        """
+        topic_resolver для ConnectionManager. Вызывается до apply_event, поэтому
+        для status_update в снимке еще лежит старый статус: событие получат и
+        полоса, из которой заказ уходит, и полоса, в которую он приходит.
+        """
+        payload = message.get("payload") or {}
+        if message.get("type") == "new_order":
+            return order_topics(payload)
+        updates = []
+        if message.get("type") == "status_update":
+            updates = [payload]
+        elif message.get("type") == "status_batch":
+            updates = payload.get("updates", [])
+
+        topics: set[str] = set()
+        for update in updates:
+            order = self.orders.get(update.get("order_id"))
+            if order is None:
+                return None
+            topics |= order_topics(order) | {f"status:{update.get('new_status')}"}
+        return topics or None
+
+    # ===== Чтение =====
+    def _touch(self) -> None:
+        self.version += 1
+        self._body = None
+
+    @staticmethod
+    def _serialize(orders: dict[int, dict]) -> bytes:
+        return serialize_orders(list(orders.values()))
+
+    @property
+    def body(self) -> bytes:
+        """Сериализованный JSON активной доски (кэшируется до следующего изменения)."""
+        if self._body is None:
+            self._body = self._serialize(self.orders)
+        return self._body
+
+    @property
+    def version_headers(self) -> dict[str, str]:
+        """Версия снимка для клиента: с нее он продолжает применять события WS."""
+        return {"X-Board-Boot": self._boot_id, "X-Board-Version": str(self.version)}
+
+    @property
+    def etag(self) -> str:
+        """
+        Слабый ETag текущей версии доски: одна и та же версия отдается и в brotli,
+        и в gzip, и без сжатия, а байты у этих ответов разные. Метка запуска процесса
+        гарантирует, что после рестарта старые ETag не совпадут.
+        """
+        return f'W/"{self._boot_id}-{self.version}"'
+
+
+active_orders_cache = ActiveOrdersCache()
@@ -13,6 +13,22 @@ document.addEventListener('DOMContentLoaded', () => {
     let allActiveOrders = [];
     let activeStatus = 'new';
 
+    // Версия снимка доски: события WS несут номер версии после своего применения.
+    // Пока номера идут подряд, событие применяется к allActiveOrders на месте;
+    // разрыв (пропущенное событие, рестарт сервера) — повод перечитать доску целиком.
+    let boardBoot = null;
+    let boardVersion = null;
+    let refreshing = null;
+    let pendingEvents = [];
+
+    // Доска может подписаться на свои топики: /?topics=station:pastry,location:main
+    const topics = new URLSearchParams(window.location.search).get('topics');
+
+    // Завершенные заказы подгружаются страницами через /api/orders/history
+    const COMPLETED_PAGE_SIZE = 20;
+    let completedOrders = [];
+    let completedCursor = null;
+
     tabs.forEach(tab => {
         tab.addEventListener('click', () => {
             const newStatus = tab.dataset.status;
@@ -57,6 +73,17 @@ document.addEventListener('DOMContentLoaded', () => {
         completedOrders
             .sort((a, b) => b.order_id - a.order_id)
             .forEach(renderOrderCard);
+
+        if (completedCursor) {
+            const loadMore = document.createElement('div');
+            loadMore.className = 'actions load-more';
+            const button = document.createElement('button');
+            button.innerText = 'Показать еще';
+            button.className = 'cancel';
+            button.onclick = () => fetchCompletedOrders(false);
+            loadMore.appendChild(button);
+            ordersContainer.appendChild(loadMore);
+        }
     }
 
     function renderOrderCard(order) {
@@ -107,13 +134,13 @@ document.addEventListener('DOMContentLoaded', () => {
             const button = document.createElement('button');
             button.innerText = 'Принять в работу';
             button.className = 'new';
-            button.onclick = () => updateOrderStatus(order.order_id, 'in_progress');
+            button.onclick = () => updateOrderStatus(order, 'in_progress');
             actions.appendChild(button);
         } else if (order.status === 'in_progress') {
             const button = document.createElement('button');
             button.innerText = 'Готов к выдаче';
             button.className = 'in_progress';
-            button.onclick = () => updateOrderStatus(order.order_id, 'ready');
+            button.onclick = () => updateOrderStatus(order, 'ready');
             actions.appendChild(button);
         } else if (order.status === 'ready') {
             const infoText = document.createElement('p');
@@ -125,13 +152,13 @@ document.addEventListener('DOMContentLoaded', () => {
             button.innerText = 'Завершить (клиент не пришел)';
             button.className = 'cancel';
             button.style.marginTop = '10px';
-            button.onclick = () => updateOrderStatus(order.order_id, 'completed');
+            button.onclick = () => updateOrderStatus(order, 'completed');
             actions.appendChild(button);
         } else if (order.status === 'arrived') {
             const button = document.createElement('button');
             button.innerText = 'Завершить';
             button.className = 'ready';
-            button.onclick = () => updateOrderStatus(order.order_id, 'completed');
+            button.onclick = () => updateOrderStatus(order, 'completed');
             actions.appendChild(button);
         } else if (order.status === 'completed') {
             const infoText = document.createElement('p');
@@ -148,9 +175,17 @@ document.addEventListener('DOMContentLoaded', () => {
 
     async function fetchActiveOrders() {
         try {
-            const response = await fetch('/api/orders/');
+            // cache: 'no-cache' — браузер перепроверяет ответ по ETag и при 304 берет тело из кэша
+            const response = await fetch('/api/orders/', { cache: 'no-cache' });
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
             allActiveOrders = await response.json();
+            const version = response.headers.get('X-Board-Version');
+            boardBoot = response.headers.get('X-Board-Boot');
+            boardVersion = version === null ? null : Number(version);
+            // События, пришедшие во время запроса: уже учтенные в снимке отбрасываются по версии
+            const queued = pendingEvents;
+            pendingEvents = [];
+            queued.forEach(applyBoardEvent);
             if (activeStatus !== 'completed') {
                 renderVisibleOrders();
             }
@@ -162,11 +197,91 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function fetchCompletedOrders() {
+    function refreshActiveOrders() {
+        if (!refreshing) {
+            refreshing = fetchActiveOrders().finally(() => { refreshing = null; });
+        }
+        return refreshing;
+    }
+
+    // --- Применение событий доски ---
+
+    function applyStatus(orderId, newStatus) {
+        const index = allActiveOrders.findIndex(order => order.order_id === orderId);
+        if (index === -1) {
+            // Заказа нет в снимке: для финального статуса менять нечего, иначе снимок неполон
+            return newStatus === 'completed' || newStatus === 'cancelled';
+        }
+        const order = allActiveOrders[index];
+        if (newStatus === 'completed' || newStatus === 'cancelled') {
+            allActiveOrders.splice(index, 1);
+            if (newStatus === 'completed' && !completedOrders.some(o => o.order_id === orderId)) {
+                completedOrders.unshift({ ...order, status: 'completed', updated_at: new Date().toISOString() });
+            }
+        } else {
+            order.status = newStatus;
+        }
+        return true;
+    }
+
+    function applyDelta(data) {
+        const payload = data.payload || {};
+        if (data.type === 'new_order') {
+            allActiveOrders = allActiveOrders.filter(order => order.order_id !== payload.order_id);
+            allActiveOrders.push(payload);
+            return true;
+        }
+        if (data.type === 'status_update') {
+            return applyStatus(payload.order_id, payload.new_status);
+        }
+        if (data.type === 'status_batch') {
+            return (payload.updates || []).every(update => applyStatus(update.order_id, update.new_status));
+        }
+        return false;
+    }
+
+    function applyBoardEvent(data) {
+        const board = data.board;
+        if (!board || boardVersion === null || board.boot !== boardBoot) {
+            refreshActiveOrders();
+            return;
+        }
+        // Уже учтено в снимке
+        if (board.version <= boardVersion) return;
+        // С подпиской на топики чужие события не приходят, и номера законно идут с пропусками
+        if (board.version !== boardVersion + 1 && !topics) {
+            refreshActiveOrders();
+            return;
+        }
+        boardVersion = board.version;
+        if (!applyDelta(data)) {
+            refreshActiveOrders();
+            return;
+        }
+        if (activeStatus === 'completed') {
+            renderCompletedOrders(completedOrders);
+        } else {
+            renderVisibleOrders();
+        }
+    }
+
+    function todayISO() {
+        const now = new Date();
+        const pad = (n) => String(n).padStart(2, '0');
+        return `${now.getFullYear()}-${pad(now.getMonth() + 1)}-${pad(now.getDate())}`;
+    }
+
+    async function fetchCompletedOrders(reset = true) {
         try {
-            const response = await fetch('/api/orders/completed');
+            const params = new URLSearchParams({
+                status: 'completed', date_from: todayISO(), limit: COMPLETED_PAGE_SIZE
+            });
+            if (!reset && completedCursor) params.set('cursor', completedCursor);
+            const response = await fetch(`/api/orders/history?${params}`, { cache: 'no-cache' });
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-            const completedOrders = await response.json();
+            const page = await response.json();
+            completedOrders = reset ? page.items : completedOrders.concat(page.items);
+            completedCursor = page.next_cursor;
             renderCompletedOrders(completedOrders);
         } catch (error) {
             console.error("Failed to fetch completed orders:", error);
@@ -176,10 +291,23 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function updateOrderStatus(orderId, newStatus) {
+    async function updateOrderStatus(order, newStatus) {
         try {
-            const response = await fetch(`/api/orders/${orderId}/status?status=${newStatus}`, { method: 'PUT' });
+            // Передаем статус, который видим на карточке: если другой бариста
+            // уже успел изменить заказ, сервер вернет конфликт вместо перезаписи
+            const response = await fetch('/api/orders/status/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    transitions: [{ order_id: order.order_id, expected_status: order.status, new_status: newStatus }]
+                })
+            });
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const result = await response.json();
+            if (result.conflicts.length > 0) {
+                if (tg) tg.showAlert(`Заказ №${order.order_id} уже изменен другим бариста.`);
+                refreshActiveOrders();
+            }
         } catch (error) {
             console.error("Failed to update status:", error);
             if (tg) tg.showAlert("Не удалось обновить статус заказа.");
@@ -188,18 +316,29 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function connectWebSocket() {
         const proto = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const ws = new WebSocket(`${proto}//${window.location.host}/ws/orders`);
+        const query = topics ? `?topics=${encodeURIComponent(topics)}` : '';
+        const ws = new WebSocket(`${proto}//${window.location.host}/ws/orders${query}`);
 
-        ws.onopen = () => { if (statusIndicator) statusIndicator.className = 'connected'; };
+        ws.onopen = () => {
+            if (statusIndicator) statusIndicator.className = 'connected';
+            // Пока соединения не было, события могли потеряться — сверяем доску
+            if (boardVersion !== null) refreshActiveOrders();
+        };
 
         ws.onmessage = (event) => {
-            console.log('Update from server...');
-            fetchActiveOrders();
-            if (activeStatus === 'completed') {
-                fetchCompletedOrders();
+            const data = JSON.parse(event.data);
+            // Серверный heartbeat: отвечаем, чтобы соединение не сочли "мертвым"
+            if (data.type === 'ping') {
+                ws.send('pong');
+                return;
+            }
+
+            if (refreshing) {
+                pendingEvents.push(data);
+            } else {
+                applyBoardEvent(data);
             }
 
-            const data = JSON.parse(event.data);
             if (data.type === 'new_order' && tg) {
                 tg.HapticFeedback.notificationOccurred('success');
             }
@@ -218,6 +357,6 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Запуск приложения ---
-    fetchActiveOrders();
+    refreshActiveOrders();
     connectWebSocket();
 });
\ No newline at end of file
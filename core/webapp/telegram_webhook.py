@@ -0,0 +1,58 @@
+import asyncio
+import hmac
+
+from fastapi import APIRouter, Request, Depends, HTTPException
+from loguru import logger
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import config
+from .epay_payment_hooks import get_bot, get_dispatcher
+
+router = APIRouter()
+
+# Ссылки на задачи обработки апдейтов: без них asyncio может собрать задачу сборщиком мусора,
+# а при остановке приложения по ним дожидаемся обработки уже принятых апдейтов
+_pending_updates: set[asyncio.Task] = set()
+_semaphore = asyncio.Semaphore(config.TELEGRAM_WEBHOOK_MAX_CONCURRENCY)
+
+
+async def _process_update(bot: Bot, dp: Dispatcher, update: Update) -> None:
+    async with _semaphore:
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта #{update.update_id}: {e}")
+
+
+@router.post(config.TELEGRAM_WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(
+        request: Request,
+        bot: Bot = Depends(get_bot),
+        dp: Dispatcher = Depends(get_dispatcher)
+):
+    """
+    Прием апдейтов Telegram в webhook-режиме.
+    Проверяет секретный токен и сразу отвечает 200 — апдейт обрабатывается
+    в отдельной задаче, поэтому медленный хэндлер не задерживает остальные.
+    """
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not config.TELEGRAM_WEBHOOK_SECRET or not hmac.compare_digest(secret, config.TELEGRAM_WEBHOOK_SECRET):
+        logger.warning(f"Telegram webhook: неверный секретный токен от {request.client}")
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    task = asyncio.create_task(_process_update(bot, dp, update))
+    _pending_updates.add(task)
+    task.add_done_callback(_pending_updates.discard)
+    return {"ok": True}
+
+
+async def wait_pending_updates(timeout: float = 10) -> None:
+    """Дожидается обработки уже принятых апдейтов (вызывается при остановке)."""
+    if not _pending_updates:
+        return
+    logger.info(f"Ожидаем завершения {len(_pending_updates)} апдейтов...")
+    done, pending = await asyncio.wait(set(_pending_updates), timeout=timeout)
+    for task in pending:
+        task.cancel()
@@ -1,39 +1,212 @@
-from typing import List
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional, Set
 from fastapi import WebSocket
 from loguru import logger
 import json
 
+from config import config
+
+
+# Подписка — это набор топиков вида "<измерение>:<значение>", например
+# "location:main", "station:pastry", "status:new". Внутри одного измерения
+# значения объединяются по ИЛИ, разные измерения — по И. Пустая подписка — все события.
+Subscription = Dict[str, Set[str]]
+
+NO_ADDON = "Без добавок"
+
+
+def parse_topics(raw: Optional[str]) -> Subscription:
+    """Разбирает query-параметр topics=station:bar,status:new в подписку."""
+    subscription: Subscription = {}
+    for item in (raw or "").split(","):
+        dimension, sep, value = item.strip().partition(":")
+        if sep and dimension and value:
+            subscription.setdefault(dimension, set()).add(value)
+    return subscription
+
+
+def order_topics(order: dict) -> Set[str]:
+    """Топики заказа: точка продаж, станции приготовления и текущая полоса статуса."""
+    topics = {f"location:{order.get('location') or config.CAFE_LOCATION}"}
+    if order.get("type"):
+        topics.add("station:bar")
+    if order.get("croissant") and order.get("croissant") != NO_ADDON:
+        topics.add("station:pastry")
+    if order.get("status"):
+        topics.add(f"status:{order['status']}")
+    return topics
+
+
+def subscription_matches(subscription: Subscription, topics: Optional[Set[str]]) -> bool:
+    """
+    Проверяет, нужно ли событие подписчику. Если у события нет топиков
+    или нет топиков нужного измерения, событие доставляется (безопасный вариант).
+    """
+    if not subscription or topics is None:
+        return True
+    by_dimension: Dict[str, Set[str]] = {}
+    for topic in topics:
+        dimension, _, value = topic.partition(":")
+        by_dimension.setdefault(dimension, set()).add(value)
+    for dimension, values in subscription.items():
+        if dimension in by_dimension and not (by_dimension[dimension] & values):
+            return False
+    return True
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Множество вместо списка: O(1) на добавление/удаление и безопасное повторное удаление
+        self.active_connections: Set[WebSocket] = set()
+        # Время последнего сообщения от клиента (pong или любой текст)
+        self.last_seen: Dict[WebSocket, float] = {}
+        self.subscriptions: Dict[WebSocket, Subscription] = {}
+        # Вычисляет топики события (например, по данным кэша доски); None — событие для всех
+        self.topic_resolver: Optional[Callable[[dict], Optional[Set[str]]]] = None
+        # Синхронные подписчики на события доски (например, кэш активных заказов).
+        # Вызываются до рассылки, поэтому HTTP-запросы после получения
+        # WS-события уже видят обновленное состояние.
+        self.listeners: List[Callable[[dict], None]] = []
+        self.metrics: Dict[str, int] = {
+            "connected_total": 0,
+            "disconnected_total": 0,
+            "rejected_total": 0,
+            "reaped_total": 0,
+            "send_failures_total": 0,
+            "broadcasts_total": 0,
+        }
+        self._heartbeat_task: Optional[asyncio.Task] = None
 
-    async def connect(self, websocket: WebSocket):
+    def add_listener(self, listener: Callable[[dict], None]):
+        self.listeners.append(listener)
+
+    async def connect(self, websocket: WebSocket, subscription: Optional[Subscription] = None) -> bool:
+        """Принимает соединение, если не превышен лимит. Возвращает False при отказе."""
+        if len(self.active_connections) >= config.WS_MAX_CONNECTIONS:
+            self.metrics["rejected_total"] += 1
+            logger.warning(f"WebSocket connection rejected: limit {config.WS_MAX_CONNECTIONS} reached")
+            # 1013 Try Again Later — клиент сам переподключится позже. Закрытие до accept()
+            # ASGI-сервер превращает в HTTP 403, поэтому сначала принимаем соединение
+            await websocket.accept()
+            await websocket.close(code=1013)
+            return False
         await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"New WebSocket connection: {websocket.client}. Total: {len(self.active_connections)}")
+        self.active_connections.add(websocket)
+        self.last_seen[websocket] = time.monotonic()
+        self.subscriptions[websocket] = subscription or {}
+        self.metrics["connected_total"] += 1
+        logger.info(f"New WebSocket connection: {websocket.client} (topics: {subscription or 'all'}). "
+                    f"Total: {len(self.active_connections)}")
+        return True
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        """Идемпотентно убирает сокет из реестра."""
+        if websocket not in self.active_connections:
+            return
+        self.active_connections.discard(websocket)
+        self.last_seen.pop(websocket, None)
+        self.subscriptions.pop(websocket, None)
+        self.metrics["disconnected_total"] += 1
         logger.info(f"WebSocket disconnected: {websocket.client}. Total: {len(self.active_connections)}")
 
-    async def broadcast(self, message: dict):
-        """Отправить сообщение всем подключенным клиентам."""
-        disconnected_sockets = []
-        for connection in self.active_connections:
+    def touch(self, websocket: WebSocket):
+        """Отмечает, что клиент жив (получили от него сообщение)."""
+        if websocket in self.active_connections:
+            self.last_seen[websocket] = time.monotonic()
+
+    async def _close(self, websocket: WebSocket, code: int = 1001):
+        self.disconnect(websocket)
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=config.WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    async def _send(self, websocket: WebSocket, text: str) -> bool:
+        try:
+            await asyncio.wait_for(websocket.send_text(text), timeout=config.WS_SEND_TIMEOUT)
+            return True
+        except Exception:
+            return False
+
+    async def _send_to_all(self, text: str, topics: Optional[Set[str]] = None) -> int:
+        """
+        Параллельная отправка подписанным клиентам с таймаутом на каждый сокет:
+        один "полуоткрытый" планшет не задерживает остальных.
+        Возвращает количество успешных отправок.
+        """
+        connections = [
+            ws for ws in self.active_connections
+            if subscription_matches(self.subscriptions.get(ws, {}), topics)
+        ]
+        if not connections:
+            return 0
+        results = await asyncio.gather(*(self._send(ws, text) for ws in connections))
+        dead = [ws for ws, ok in zip(connections, results) if not ok]
+        if dead:
+            self.metrics["send_failures_total"] += len(dead)
+            for websocket in dead:
+                await self._close(websocket)
+        return len(connections) - len(dead)
+
+    async def broadcast(self, message: dict, topics: Optional[Set[str]] = None):
+        """
+        Отправить сообщение клиентам, чья подписка совпадает с топиками события.
+        Если топики не переданы, их вычисляет topic_resolver (до применения события слушателями).
+        """
+        if topics is None and self.topic_resolver:
+            try:
+                topics = self.topic_resolver(message)
+            except Exception as e:
+                logger.error(f"WebSocket topic resolver failed: {e}")
+
+        for listener in self.listeners:
+            try:
+                listener(message)
+            except Exception as e:
+                logger.error(f"WebSocket event listener failed: {e}")
+
+        self.metrics["broadcasts_total"] += 1
+        delivered = await self._send_to_all(json.dumps(message), topics)
+        if delivered:
+            logger.info(f"Broadcasted message to {delivered} clients.")
+
+    # ===== Heartbeat =====
+    async def _reap_idle(self):
+        """Закрывает соединения, от которых давно не было ни одного сообщения."""
+        deadline = time.monotonic() - config.WS_IDLE_TIMEOUT
+        idle = [ws for ws, seen in self.last_seen.items() if seen < deadline]
+        for websocket in idle:
+            self.metrics["reaped_total"] += 1
+            logger.info(f"Reaping idle WebSocket: {websocket.client}")
+            await self._close(websocket)
+
+    async def _heartbeat_loop(self):
+        ping = json.dumps({"type": "ping"})
+        while True:
+            await asyncio.sleep(config.WS_PING_INTERVAL)
+            try:
+                await self._reap_idle()
+                await self._send_to_all(ping)
+            except Exception as e:
+                logger.error(f"WebSocket heartbeat failed: {e}")
+
+    def start_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+            logger.info("✅ WebSocket heartbeat started")
+
+    async def stop_heartbeat(self):
+        if self._heartbeat_task and not self._heartbeat_task.done():
+            self._heartbeat_task.cancel()
             try:
-                await connection.send_text(json.dumps(message))
-            except Exception:
-                # Если сокет закрыт, запоминаем его для удаления
-                disconnected_sockets.append(connection)
-
-        # Удаляем "мертвые" сокеты
-        if disconnected_sockets:
-            for socket in disconnected_sockets:
-                self.disconnect(socket)
-
-        if self.active_connections:
-            logger.info(f"Broadcasted message to {len(self.active_connections)} clients.")
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+        self._heartbeat_task = None
+
+    def stats(self) -> dict:
+        return {"active_connections": len(self.active_connections), **self.metrics}
 
 
 manager = ConnectionManager()
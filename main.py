@@ -12,9 +12,7 @@ from fastapi import FastAPI
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.redis import RedisStorage
-from redis.asyncio.client import Redis
-from aiogram.types import BotCommand, BotCommandScopeDefault
+from aiogram.types import BotCommand, BotCommandScopeDefault, User
 
 # =================================================================
 #               НАСТРОЙКА ЛОГИРОВАНИЯ
@@ -51,9 +49,23 @@ from core.handlers.barista_handlers import router as barista_router
 from core.utils.database import postgres_client
 from config import config
 from core.utils.error_handler import setup_error_handlers  # <-- ИМПОРТ НАШЕГО ОБРАБОТЧИКА
+from core.services.send_scheduler import setup_send_scheduler, send_priority, Priority
+from core.middlewares.middlewares import setup_metrics, setup_fsm_cache, setup_throttling
+from core.utils.metrics import InstrumentedRedis
+from core.utils.fsm_storage import MsgpackRedisStorage
+from core.services.idempotency import idempotency_guard
+from core.services.notification_outbox import outbox_dispatcher
+from core.services.payment_jobs import payment_job_workers
+from core.services.epay_service import epay_service
+from core.services.payment_sweeper import payment_sweeper
 
 # Импортируем наше созданное FastAPI приложение
 from core.webapp import app as fastapi_app
+from core.webapp.orders_cache import active_orders_cache
+from core.webapp.ws.orders_ws import manager as ws_manager
+from core.webapp.telegram_webhook import wait_pending_updates
+
+ALLOWED_UPDATES = ["message", "callback_query"]
 
 
 class BotApplication:
@@ -64,6 +76,7 @@ class BotApplication:
     def __init__(self):
         self.bot: Optional[Bot] = None
         self.dp: Optional[Dispatcher] = None
+        self.bot_info: Optional[User] = None
         logger.info("BotApplication instance created")
 
     async def set_bot_commands(self, bot: Bot):
@@ -80,13 +93,14 @@ class BotApplication:
         """Асинхронная инициализация всех компонентов бота."""
         try:
             logger.info("Initializing bot components...")
-            redis_client = Redis(
+            redis_client = InstrumentedRedis(
                 host=config.REDIS_HOST,
                 port=config.REDIS_PORT,
                 db=0
             )
 
-            storage = RedisStorage(
+            # Данные FSM хранятся в msgpack (см. core/utils/fsm_storage.py)
+            storage = MsgpackRedisStorage(
                 redis=redis_client,
                 state_ttl=172800,
                 data_ttl=172800
@@ -96,9 +110,16 @@ class BotApplication:
                 token=config.TELEGRAM_BOT_TOKEN,
                 default=DefaultBotProperties(parse_mode="HTML")
             )
+            setup_send_scheduler(self.bot)
             logger.info("✅ Telegram bot initialized successfully")
 
+            # Данные бота (username и т.п.) запрашиваем один раз; хэндлеры получают их
+            # через workflow_data диспетчера как аргумент bot_info
+            self.bot_info = await self.bot.get_me()
+            logger.info(f"✅ Bot identity loaded: @{self.bot_info.username}")
+
             self.dp = Dispatcher(storage=storage)
+            self.dp["bot_info"] = self.bot_info
             self.dp.include_router(basic_router)
             self.dp.include_router(admin_router)
             self.dp.include_router(barista_router)
@@ -109,6 +130,16 @@ class BotApplication:
             setup_error_handlers(self.dp)
             logger.info("✅ Global error handler registered")
 
+            setup_metrics(self.dp, self.bot)
+            logger.info("✅ Metrics middleware registered")
+
+            # После метрик: запись изменений FSM в конце апдейта тоже попадает в его время
+            setup_fsm_cache(self.dp)
+            logger.info("✅ FSM data cache middleware registered")
+
+            setup_throttling(self.dp, redis_client)
+            logger.info("✅ Throttling middleware registered")
+
             self.dp.startup.register(self._on_startup)
             self.dp.shutdown.register(self._on_shutdown)
             logger.info("✅ Lifecycle handlers registered")
@@ -116,6 +147,8 @@ class BotApplication:
             await postgres_client.initialize()
             logger.info("✅ PostgreSQL client initialized successfully")
 
+            idempotency_guard.initialize(redis_client)
+
             logger.info("🚀 All bot components initialized successfully")
 
         except Exception as e:
@@ -128,7 +161,37 @@ class BotApplication:
         if not self.bot or not self.dp:
             raise RuntimeError("Bot or Dispatcher not initialized")
         logger.info("🚀 Starting bot polling...")
-        await self.dp.start_polling(self.bot, allowed_updates=["message", "callback_query"])
+        # getUpdates не работает, пока у бота установлен вебхук (например, после запуска в webhook-режиме)
+        await self.bot.delete_webhook(drop_pending_updates=False)
+        await self.dp.start_polling(self.bot, allowed_updates=ALLOWED_UPDATES)
+
+    async def start_webhook(self) -> None:
+        """Регистрирует вебхук в Telegram и запускает startup-обработчики диспетчера."""
+        if not self.bot or not self.dp:
+            raise RuntimeError("Bot or Dispatcher not initialized")
+        if not config.TELEGRAM_WEBHOOK_SECRET:
+            raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required in webhook mode")
+        webhook_url = f"{config.BASE_WEBHOOK_URL}{config.TELEGRAM_WEBHOOK_PATH}"
+        await self.bot.set_webhook(
+            url=webhook_url,
+            secret_token=config.TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=config.TELEGRAM_WEBHOOK_MAX_CONCURRENCY,
+        )
+        logger.info(f"✅ Telegram webhook set: {webhook_url}")
+        # В polling-режиме это делает start_polling, здесь — вручную
+        await self.dp.emit_startup(bot=self.bot)
+
+    async def stop_webhook(self) -> None:
+        """
+        Дожидается обработки принятых апдейтов и запускает shutdown-обработчики.
+        Вебхук в Telegram не удаляется: пока приложение перезапускается, апдейты копятся в очереди Telegram.
+        """
+        if not self.dp: return
+        await wait_pending_updates()
+        await self.dp.emit_shutdown(bot=self.bot)
+        await self.dp.storage.close()
+        logger.info("✅ Webhook processing stopped")
 
     async def stop_polling(self) -> None:
         """Останавливает поллинг и закрывает хранилище."""
@@ -159,7 +222,8 @@ class BotApplication:
         await self.set_bot_commands(bot)
         startup_message = "🚀 Бот запущен и готов к работе!"
         try:
-            await bot.send_message(config.ADMIN_CHAT_ID, startup_message)
+            with send_priority(Priority.NOTIFICATION):
+                await bot.send_message(config.ADMIN_CHAT_ID, startup_message)
             logger.info("✅ Startup notification sent to admin")
         except Exception as e:
             logger.error(f"❌ Failed to send startup notification: {e}")
@@ -169,7 +233,8 @@ class BotApplication:
         """Выполняется при остановке бота."""
         shutdown_message = "🛑 Бот остановлен."
         try:
-            await bot.send_message(config.ADMIN_CHAT_ID, shutdown_message)
+            with send_priority(Priority.NOTIFICATION):
+                await bot.send_message(config.ADMIN_CHAT_ID, shutdown_message)
             logger.info("✅ Shutdown notification sent to admin")
         except Exception as e:
             logger.error(f"❌ Failed to send shutdown notification: {e}")
@@ -187,19 +252,43 @@ async def lifespan(app: FastAPI):
 
     app.state.bot_instance = bot_app.bot
     app.state.dp = bot_app.dp
-
-    polling_task = asyncio.create_task(bot_app.start_polling())
-    logger.info("Bot polling has been scheduled to run in the background.")
+    app.state.bot_info = bot_app.bot_info
+
+    await active_orders_cache.start()
+    ws_manager.start_heartbeat()
+    await epay_service.start()
+    outbox_dispatcher.start(bot_app.bot)
+    payment_job_workers.start(bot_app.bot, bot_app.dp)
+    payment_sweeper.start(bot_app.bot, bot_app.dp)
+
+    polling_task = None
+    if config.TELEGRAM_MODE == "webhook":
+        await bot_app.start_webhook()
+        logger.info("Bot is receiving updates via webhook.")
+    else:
+        polling_task = asyncio.create_task(bot_app.start_polling())
+        logger.info("Bot polling has been scheduled to run in the background.")
     yield
     logger.info("🧹 Shutting down application lifespan...")
-    if not polling_task.done():
+    if polling_task and not polling_task.done():
         logger.info("Cancelling polling task...")
         polling_task.cancel()
         try:
             await polling_task
         except asyncio.CancelledError:
             logger.info("✅ Polling task cancelled successfully")
-    await bot_app.stop_polling()
+    await ws_manager.stop_heartbeat()
+    await active_orders_cache.stop()
+    if polling_task:
+        await bot_app.stop_polling()
+    else:
+        await bot_app.stop_webhook()
+    # Неотправленные уведомления и незавершенные задания платежей остаются в БД
+    # и будут обработаны после перезапуска
+    await payment_sweeper.stop()
+    await payment_job_workers.stop()
+    await outbox_dispatcher.stop()
+    await epay_service.close()
     await bot_app.cleanup()
     logger.info("👋 Application shutdown complete")
 
@@ -0,0 +1,136 @@
+# scripts/benchmark_segments.py
+"""
+Замер времени запросов сегментов рассылки на синтетических данных.
+
+Создает отдельную схему bench_segments (рабочие таблицы не трогает), заполняет ее
+пользователями и заказами через generate_series, замеряет EXPLAIN ANALYZE подсчета
+аудитории каждого сегмента без индексов сегментов и с ними (медиана из --repeat
+запусков), затем удаляет схему.
+
+Запуск из корня проекта:
+    python -m scripts.benchmark_segments --users 100000 --orders 1000000 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import statistics
+
+import asyncpg
+
+from config import config
+from core.services.broadcast import (
+    SEGMENT_ALL, SEGMENT_RECENT, SEGMENT_NEVER_ORDERED, SEGMENT_FREE_COFFEES, SEGMENT_DRINK, segment_filter
+)
+from core.utils.helpers import PRICES
+
+SCHEMA = "bench_segments"
+
+SEGMENTS = [
+    (SEGMENT_ALL, None),
+    (SEGMENT_RECENT, "7"),
+    (SEGMENT_RECENT, "90"),
+    (SEGMENT_NEVER_ORDERED, None),
+    (SEGMENT_FREE_COFFEES, None),
+    (SEGMENT_DRINK, "Капучино"),
+]
+
+# Те же индексы, что и в scripts/tables.sql
+SEGMENT_INDEXES = [
+    "CREATE INDEX ON orders (user_id, created_at DESC)",
+    'CREATE INDEX ON orders ("type", user_id)',
+    "CREATE INDEX ON referral_program (user_id) WHERE free_coffees > 0",
+]
+
+
+async def prepare(conn: asyncpg.Connection, users: int, orders: int) -> None:
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+    # Структура как в рабочей схеме, но только с ключами (без вторичных индексов)
+    await conn.execute("""
+        CREATE TABLE users (LIKE public.users INCLUDING DEFAULTS);
+        ALTER TABLE users ADD PRIMARY KEY (id), ADD UNIQUE (telegram_id);
+        CREATE TABLE referral_program (LIKE public.referral_program INCLUDING DEFAULTS);
+        ALTER TABLE referral_program ADD PRIMARY KEY (id), ADD UNIQUE (user_id);
+        CREATE TABLE orders (LIKE public.orders INCLUDING DEFAULTS);
+        ALTER TABLE orders ADD PRIMARY KEY (order_id);
+        CREATE INDEX ON orders (user_id);
+        CREATE INDEX ON orders (created_at);
+    """)
+    await conn.execute(
+        """
+        INSERT INTO users (id, telegram_id, first_name, is_active)
+        SELECT g, 100000000 + g, 'user' || g, random() > 0.05
+        FROM generate_series(1, $1) g
+        """,
+        users
+    )
+    await conn.execute(
+        """
+        INSERT INTO referral_program (id, user_id, free_coffees, referred_count)
+        SELECT g, 100000000 + g, (random() < 0.1)::int * (1 + floor(random() * 3))::int, 0
+        FROM generate_series(1, $1) g
+        """,
+        users
+    )
+    # Около 30% пользователей без заказов; остальные заказы распределены неравномерно
+    await conn.execute(
+        """
+        INSERT INTO orders (order_id, user_id, first_name, "type", cup, "time", total_price,
+                            status, payment_status, "timestamp", created_at)
+        SELECT g,
+               100000000 + 1 + floor(power(random(), 2) * $2::int * 0.7)::bigint,
+               'user', ($3::text[])[1 + floor(random() * array_length($3::text[], 1))::int],
+               '330', 'Сейчас', 1000, 'completed', 'paid', ts, ts
+        FROM (
+            SELECT g, NOW() - random() * INTERVAL '365 days' AS ts FROM generate_series(1, $1) g
+        ) s
+        """,
+        orders, users, list(PRICES["coffee"])
+    )
+    # VACUUM, как его сделал бы autovacuum: без карты видимости index-only scan ходит в таблицу
+    await conn.execute("VACUUM ANALYZE")
+
+
+async def measure(conn: asyncpg.Connection, repeat: int) -> dict:
+    results = {}
+    for segment, param in SEGMENTS:
+        condition, args = segment_filter(segment, param, 1)
+        query = f"SELECT COUNT(*) FROM users u WHERE u.is_active = TRUE AND {condition}"
+        count = await conn.fetchval(query, *args)  # прогрев кэша
+        timings = []
+        for _ in range(repeat):
+            plan = await conn.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", *args)
+            timings.append(json.loads(plan)[0]["Execution Time"])
+        results[(segment, param)] = (count, statistics.median(timings))
+    return results
+
+
+async def main(users: int, orders: int, repeat: int) -> None:
+    conn = await asyncpg.connect(dsn=config.POSTGRES_DSN)
+    try:
+        print(f"Генерация данных: {users} пользователей, {orders} заказов...")
+        await prepare(conn, users, orders)
+        before = await measure(conn, repeat)
+        for ddl in SEGMENT_INDEXES:
+            await conn.execute(ddl)
+        await conn.execute("VACUUM ANALYZE")
+        after = await measure(conn, repeat)
+
+        print(f"{'Сегмент':<24}{'Аудитория':>12}{'Без индексов, мс':>20}{'С индексами, мс':>20}")
+        for key, (count, time_before) in before.items():
+            segment, param = key
+            title = f"{segment}:{param}" if param else segment
+            print(f"{title:<24}{count:>12}{time_before:>20.1f}{after[key][1]:>20.1f}")
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер запросов сегментов рассылки")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5, help="запусков на сегмент (берется медиана)")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.orders, args.repeat))
@@ -0,0 +1,197 @@
+# scripts/broadcast_crash_check.py
+"""
+Проверка восстановления шарда рассылки после падения воркера.
+
+1. Воркер забирает шард и "падает" посреди порции: задача прерывается, шард
+   остается "running" со свежим heartbeat (как при kill -9 с acks_late).
+2. Повторно доставленная задача застает шард занятым (busy) и, как
+   broadcast_shard_task, перезапускается через BROADCAST_SHARD_STALE_SECONDS,
+   пока шард не станет брошенным и не будет забран.
+3. Пока новый воркер отправляет порцию дольше BROADCAST_SHARD_STALE_SECONDS,
+   еще одна задача не может перехватить живой шард (heartbeat обновляется между порциями).
+4. Рассылка должна дойти до completed, шард — до done, у каждого получателя —
+   строка в broadcast_deliveries, и никто не получает сообщение дважды. Порция,
+   прерванная падением, остается "sending" и не повторяется: теряются только отправки,
+   шедшие в момент падения (не больше BROADCAST_CONCURRENCY), — бот-заглушка считает
+   их доставленными. Счетчики шарда совпадают с результатами доставок.
+
+Telegram не используется: бот-заглушка только запоминает отправки. Получатели —
+тестовые пользователи в отдельном диапазоне telegram_id, удаляются после проверки.
+Нужна только PostgreSQL со схемой из tables.sql, запускать на локальной/тестовой базе.
+
+Запуск из корня проекта:
+    python -m scripts.broadcast_crash_check
+    python -m scripts.broadcast_crash_check --users 1000 --stale 3
+"""
+import argparse
+import asyncio
+import json
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+from config import config
+from core.utils.database import postgres_client
+from core.services.broadcast import BroadcastEngine, SHARD_BUSY, SHARD_CLAIMED
+
+FIRST_TEST_ID = 999_100_000_000
+ADMIN_ID = 999_100_999_999
+
+
+class RecordingBot:
+    """
+    Бот-заглушка: отправка запоминается сразу, а ответ приходит через delay секунд —
+    как если бы Telegram уже доставил сообщение, а воркер упал, не дождавшись ответа.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.sent = Counter()
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        if chat_id != ADMIN_ID:
+            self.sent[chat_id] += 1
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(message_id=1)
+
+    async def send_photo(self, chat_id: int, photo: str, **kwargs):
+        return await self.send_message(chat_id, kwargs.get("caption") or "")
+
+    async def edit_message_text(self, text: str, **kwargs):
+        return True
+
+
+async def prepare(users: int) -> int:
+    await postgres_client.execute(
+        """
+        INSERT INTO users (telegram_id, first_name)
+        SELECT g, 'crash_check' FROM generate_series($1::bigint, $2::bigint) g
+        ON CONFLICT (telegram_id) DO NOTHING
+        """,
+        FIRST_TEST_ID, FIRST_TEST_ID + users - 1
+    )
+    run_id = await postgres_client.fetchval(
+        "INSERT INTO broadcast_runs (admin_id, message_text) VALUES ($1, 'crash check') RETURNING id", ADMIN_ID
+    )
+    # Один шард ровно на диапазон тестовых пользователей
+    await postgres_client.execute(
+        "INSERT INTO broadcast_shards (run_id, shard_no, cursor, range_end) VALUES ($1, 1, $2, $3)",
+        run_id, FIRST_TEST_ID - 1, FIRST_TEST_ID + users - 1
+    )
+    return run_id
+
+
+async def cleanup(run_id: int, users: int) -> None:
+    await postgres_client.execute("DELETE FROM broadcast_runs WHERE id = $1", run_id)
+    await postgres_client.execute(
+        "DELETE FROM users WHERE telegram_id BETWEEN $1 AND $2", FIRST_TEST_ID, FIRST_TEST_ID + users - 1
+    )
+
+
+async def main(users: int, crash_after: int, stale: int) -> int:
+    # Порция (batch / concurrency * delay) отправляется дольше stale — проверяем heartbeat
+    config.BROADCAST_SHARD_STALE_SECONDS = stale
+    config.BROADCAST_PROGRESS_INTERVAL = 1
+    config.BROADCAST_BATCH_SIZE = 200
+    config.BROADCAST_CONCURRENCY = 5
+    delay = 2 * stale * config.BROADCAST_CONCURRENCY / config.BROADCAST_BATCH_SIZE
+
+    await postgres_client.initialize()
+    run_id = await prepare(users)
+    bot = RecordingBot(delay)
+    try:
+        # 1. Падение воркера посреди порции
+        crashed = asyncio.create_task(BroadcastEngine(bot, postgres_client, run_id, 1).run())
+        while sum(bot.sent.values()) < crash_after:
+            await asyncio.sleep(0.05)
+        crashed.cancel()
+        await asyncio.gather(crashed, return_exceptions=True)
+        shard_after_crash = await postgres_client.fetchval(
+            "SELECT status FROM broadcast_shards WHERE run_id = $1", run_id)
+
+        # 2. Повторная доставка: busy -> повтор через stale секунд (как self.retry
+        #    в broadcast_shard_task) -> брошенный шард забран и дослан
+        attempts = []
+        taken_over = asyncio.Event()
+
+        async def redeliver() -> None:
+            while True:
+                engine = BroadcastEngine(bot, postgres_client, run_id, 1)
+                claim = engine.claim
+
+                async def tracked_claim() -> str:
+                    result = await claim()
+                    if result == SHARD_CLAIMED:
+                        taken_over.set()
+                    return result
+
+                engine.claim = tracked_claim
+                result = await engine.run()
+                attempts.append(result)
+                if result != SHARD_BUSY:
+                    return
+                await asyncio.sleep(stale)
+
+        redelivered = asyncio.create_task(redeliver())
+
+        # 3. Живой шард не перехватывается, даже если порция идет дольше stale
+        takeovers = []
+        await asyncio.wait([redelivered, asyncio.create_task(taken_over.wait())],
+                           return_when=asyncio.FIRST_COMPLETED)
+        while not redelivered.done():
+            await asyncio.sleep(stale * 0.75)
+            takeovers.append(await BroadcastEngine(bot, postgres_client, run_id, 1).claim())
+        await redelivered
+
+        summary = await postgres_client.fetchrow(
+            """
+            SELECT r.status AS run_status, s.status AS shard_status, s.sent_count,
+                   (SELECT COUNT(*) FROM broadcast_deliveries d WHERE d.run_id = r.id) AS deliveries,
+                   (SELECT COUNT(*) FROM broadcast_deliveries d
+                    WHERE d.run_id = r.id AND d.status = 'sent') AS delivered_sent,
+                   (SELECT COUNT(*) FROM broadcast_deliveries d
+                    WHERE d.run_id = r.id AND d.status = 'sending') AS interrupted
+            FROM broadcast_runs r JOIN broadcast_shards s ON s.run_id = r.id
+            WHERE r.id = $1
+            """,
+            run_id
+        )
+        duplicates = sum(1 for count in bot.sent.values() if count > 1)
+        report = {
+            "users": users,
+            "crash_after_sends": crash_after,
+            "shard_after_crash": shard_after_crash,
+            "redelivery_attempts": attempts,
+            "takeover_attempts_while_alive": takeovers,
+            "run_status": summary['run_status'],
+            "shard_status": summary['shard_status'],
+            "deliveries": summary['deliveries'],
+            "shard_sent_count": summary['sent_count'],
+            "deliveries_sent": summary['delivered_sent'],
+            "interrupted_sends": summary['interrupted'],
+            "recipients_reached": len(bot.sent),
+            "duplicate_sends": duplicates,
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        ok = (shard_after_crash == "running"
+              and attempts[0] == SHARD_BUSY and attempts[-1] == SHARD_CLAIMED
+              and SHARD_BUSY in takeovers and SHARD_CLAIMED not in takeovers
+              and summary['run_status'] == "completed" and summary['shard_status'] == "done"
+              and summary['deliveries'] == users and duplicates == 0
+              and summary['interrupted'] <= config.BROADCAST_BATCH_SIZE
+              and len(bot.sent) == users
+              and summary['sent_count'] == summary['delivered_sent'])
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        await cleanup(run_id, users)
+        await postgres_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка восстановления шарда рассылки после падения воркера")
+    parser.add_argument("--users", type=int, default=600, help="сколько тестовых получателей создать")
+    parser.add_argument("--crash-after", type=int, default=100, help="после скольких отправок 'уронить' воркер")
+    parser.add_argument("--stale", type=int, default=2, help="BROADCAST_SHARD_STALE_SECONDS для проверки")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.users, args.crash_after, args.stale)))
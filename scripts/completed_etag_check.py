@@ -0,0 +1,91 @@
+# scripts/completed_etag_check.py
+"""
+Проверка условного GET для /api/orders/completed.
+
+1. Первый запрос — 200 со слабым ETag.
+2. Повтор с If-None-Match — 304 без тела (для brotli, gzip и без сжатия).
+3. Завершение еще одного заказа меняет ETag: повтор со старым ETag — снова 200.
+4. Правка уже завершенного заказа (updated_at) тоже меняет ETag.
+
+Запросы идут в приложение FastAPI через ASGI-транспорт httpx. Тестовый
+пользователь и его заказы удаляются после проверки. Нужна только PostgreSQL
+со схемой из tables.sql, запускать на локальной/тестовой базе.
+
+Запуск из корня проекта:
+    python -m scripts.completed_etag_check
+"""
+import asyncio
+import json
+import sys
+
+import httpx
+
+from core.utils.database import postgres_client
+from core.webapp import app
+
+TEST_USER_ID = 999_000_000_003
+URL = "/api/orders/completed"
+
+
+async def add_order(status: str) -> int:
+    return await postgres_client.fetchval(
+        """
+        INSERT INTO orders (user_id, first_name, "type", cup, "time", total_price, status, "timestamp")
+        VALUES ($1, 'ETag', 'Капучино', '330', '10', 1400, $2, NOW())
+        RETURNING order_id
+        """,
+        TEST_USER_ID, status
+    )
+
+
+async def cleanup() -> None:
+    await postgres_client.execute("DELETE FROM orders WHERE user_id = $1", TEST_USER_ID)
+
+
+async def main() -> int:
+    await postgres_client.initialize()
+    await postgres_client.execute(
+        "INSERT INTO users (telegram_id, first_name) VALUES ($1, 'ETag') ON CONFLICT (telegram_id) DO NOTHING",
+        TEST_USER_ID
+    )
+    await cleanup()
+    try:
+        await add_order("completed")
+        pending_id = await add_order("arrived")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://cafe-bot") as client:
+            first = await client.get(URL)
+            etag = first.headers.get("etag")
+            revalidated = {}
+            for encoding in ("br", "gzip", "identity"):
+                response = await client.get(URL, headers={"If-None-Match": etag, "Accept-Encoding": encoding})
+                revalidated[encoding] = (response.status_code, len(response.content))
+
+            await postgres_client.execute("UPDATE orders SET status = 'completed' WHERE order_id = $1", pending_id)
+            after_complete = await client.get(URL, headers={"If-None-Match": etag})
+            etag_after_complete = after_complete.headers.get("etag")
+
+            await postgres_client.execute("UPDATE orders SET \"time\" = '15' WHERE order_id = $1", pending_id)
+            after_edit = await client.get(URL, headers={"If-None-Match": etag_after_complete})
+
+        ours = [o for o in after_complete.json() if o['user_id'] == TEST_USER_ID]
+        report = {
+            "first": (first.status_code, etag),
+            "revalidated": revalidated,
+            "after_complete": (after_complete.status_code, etag_after_complete, len(ours)),
+            "after_edit": (after_edit.status_code, after_edit.headers.get("etag")),
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        ok = (first.status_code == 200 and etag and etag.startswith('W/"')
+              and all(status == 304 and size == 0 for status, size in revalidated.values())
+              and after_complete.status_code == 200 and etag_after_complete != etag and len(ours) == 2
+              and after_edit.status_code == 200 and after_edit.headers.get("etag") != etag_after_complete)
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        await cleanup()
+        await postgres_client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,137 @@
+# scripts/epay_mock_server.py
+"""
+Локальный мок платежного шлюза Epay для проверки оплаты, сверки и предохранителя.
+
+Эндпоинты (повторяют используемые ботом):
+    POST /oauth2/token                                  — токен с expires_in
+    POST /invoice                                       — создание счета, ссылка на /pay/<id>
+    GET  /check-status/payment/transaction/<invoice_id> — статус счета (AUTH, CHARGE, REJECT, NEW ...)
+    GET  /pay/<invoice_id>?result=ok|fail&webhook=1|0   — "оплата": меняет статус и шлет
+                                                          вебхук на post_link (webhook=0 — потерянный вебхук)
+
+Деградация шлюза для проверки таймаутов и предохранителя: --latency и --error-rate.
+
+Запуск из корня проекта:
+    python -m scripts.epay_mock_server --port 8090
+    python -m scripts.epay_mock_server --port 8090 --latency 10 --error-rate 0.5
+
+Настройки бота (.env) для работы с моком:
+    EPAY_OAUTH_URL=http://localhost:8090/oauth2/token
+    EPAY_CREATE_INVOICE_URL=http://localhost:8090/invoice
+    EPAY_STATUS_URL=http://localhost:8090/check-status/payment/transaction/{invoice_id}
+"""
+import argparse
+import asyncio
+import random
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+# Статусы Epay: успешная оплата и отказ
+PAID_STATUS = "CHARGE"
+FAILED_STATUS = "REJECT"
+
+
+class EpayMock:
+    def __init__(self, base_url: str, latency: float, error_rate: float, token_ttl: int):
+        self.base_url = base_url
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.tokens: set[str] = set()
+        self.invoices: dict[str, dict] = {}
+
+    @web.middleware
+    async def degrade(self, request: web.Request, handler):
+        """Имитирует медленный или сбоящий шлюз (кроме страницы оплаты)."""
+        if request.path.startswith("/pay/"):
+            return await handler(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.Response(status=503, text="Service Unavailable")
+        return await handler(request)
+
+    def _authorized(self, request: web.Request) -> bool:
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        return token in self.tokens
+
+    async def token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if not form.get("client_id") or not form.get("client_secret"):
+            return web.json_response({"error": "invalid_client"}, status=401)
+        token = uuid.uuid4().hex
+        self.tokens.add(token)
+        return web.json_response({
+            "access_token": token, "expires_in": str(self.token_ttl),
+            "scope": form.get("scope", "payment"), "token_type": "Bearer",
+        })
+
+    async def create_invoice(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.Response(status=401, text='{"message": "Token is not valid"}')
+        data = await request.json()
+        invoice_id = str(data["invoice_id"])
+        self.invoices[invoice_id] = {
+            "amount": data.get("amount"), "currency": data.get("currency", "KZT"),
+            "post_link": data.get("post_link"), "failure_post_link": data.get("failure_post_link"),
+            "status": "NEW",
+        }
+        invoice_url = f"{self.base_url}/pay/{invoice_id}"
+        return web.json_response({"id": uuid.uuid4().hex, "invoice_id": invoice_id, "invoice_url": invoice_url})
+
+    async def check_status(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.Response(status=401, text='{"message": "Token is not valid"}')
+        invoice_id = request.match_info["invoice_id"]
+        invoice = self.invoices.get(invoice_id)
+        if not invoice:
+            return web.json_response({"resultCode": "102", "resultMessage": "Transaction not found"}, status=404)
+        return web.json_response({
+            "resultCode": "100", "resultMessage": "Success",
+            "transaction": {"invoiceID": invoice_id, "amount": invoice["amount"],
+                            "currency": invoice["currency"], "statusName": invoice["status"]},
+        })
+
+    async def pay(self, request: web.Request) -> web.Response:
+        invoice_id = request.match_info["invoice_id"]
+        invoice = self.invoices.get(invoice_id)
+        if not invoice:
+            return web.Response(status=404, text="Счет не найден")
+        success = request.query.get("result", "ok") == "ok"
+        invoice["status"] = PAID_STATUS if success else FAILED_STATUS
+
+        webhook_sent = False
+        post_link = invoice["post_link"] if success else invoice["failure_post_link"]
+        if request.query.get("webhook", "1") == "1" and post_link:
+            payload = {"invoiceId": invoice_id, "code": "ok" if success else "fail",
+                       "amount": invoice["amount"], "currency": invoice["currency"]}
+            if not success:
+                payload.update({"reason": "Отказ банка-эмитента (мок)", "reasonCode": 454})
+            async with aiohttp.ClientSession() as session:
+                async with session.post(post_link, json=payload) as resp:
+                    webhook_sent = resp.status == 200
+        return web.Response(text=f"Счет {invoice_id}: {invoice['status']}, вебхук отправлен: {webhook_sent}")
+
+    def build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.degrade])
+        app.add_routes([
+            web.post("/oauth2/token", self.token),
+            web.post("/invoice", self.create_invoice),
+            web.get("/check-status/payment/transaction/{invoice_id}", self.check_status),
+            web.get("/pay/{invoice_id}", self.pay),
+        ])
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Мок платежного шлюза Epay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 (0..1)")
+    parser.add_argument("--token-ttl", type=int, default=1200, help="expires_in выдаваемых токенов")
+    args = parser.parse_args()
+    mock = EpayMock(f"http://{args.host}:{args.port}", args.latency, args.error_rate, args.token_ttl)
+    web.run_app(mock.build_app(), host=args.host, port=args.port)
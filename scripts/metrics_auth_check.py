@@ -0,0 +1,54 @@
+# scripts/metrics_auth_check.py
+"""
+Проверка доступа к служебным эндпоинтам /metrics и /ws/stats.
+
+Без заголовка Authorization, с неверным токеном и при незаданном METRICS_TOKEN
+оба эндпоинта должны отвечать 401 (с WWW-Authenticate: Bearer), с верным токеном — 200.
+Запросы идут в приложение FastAPI через ASGI-транспорт httpx, база и Telegram не нужны.
+
+Запуск из корня проекта:
+    python -m scripts.metrics_auth_check
+"""
+import asyncio
+import json
+import sys
+
+import httpx
+
+from config import config
+from core.webapp import app
+
+ENDPOINTS = ("/metrics", "/ws/stats")
+TOKEN = "metrics-check-token"
+
+
+async def statuses(client: httpx.AsyncClient, headers: dict) -> dict:
+    result = {}
+    for path in ENDPOINTS:
+        response = await client.get(path, headers=headers)
+        result[path] = (response.status_code, response.headers.get("www-authenticate"))
+    return result
+
+
+async def main() -> int:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://cafe-bot") as client:
+        config.METRICS_TOKEN = ""
+        token_unset = await statuses(client, {"Authorization": "Bearer "})
+        config.METRICS_TOKEN = TOKEN
+        report = {
+            "token_unset": token_unset,
+            "no_header": await statuses(client, {}),
+            "wrong_token": await statuses(client, {"Authorization": "Bearer wrong"}),
+            "valid_token": await statuses(client, {"Authorization": f"Bearer {TOKEN}"}),
+        }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    denied = [report[case][path] for case in ("token_unset", "no_header", "wrong_token") for path in ENDPOINTS]
+    ok = (all(result == (401, "Bearer") for result in denied)
+          and all(status == 200 for status, _ in report["valid_token"].values()))
+    print("OK" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,113 @@
+# scripts/migrate_fsm_storage.py
+"""
+Миграция данных FSM в Redis на компактную схему (OrderData) и msgpack.
+
+- Вместо полного дампа callback (last_callback) оставляет только
+  confirm_chat_id / confirm_message_id.
+- Перекодирует JSON-значения в msgpack, сохраняя оставшийся TTL ключа.
+- Печатает отчет: число сессий и память Redis на одну сессию до и после.
+
+Запуск из корня проекта:
+    python -m scripts.migrate_fsm_storage --dry-run   # только отчет
+    python -m scripts.migrate_fsm_storage
+"""
+import argparse
+import asyncio
+import json
+from typing import Any, Dict
+
+from redis.asyncio.client import Redis
+
+from config import config
+from core.utils.fsm_storage import pack_data, unpack_data
+
+DATA_PATTERN = "fsm:*:data"
+BATCH_SIZE = 500
+
+
+def compact_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Приводит старые данные к OrderData: last_callback -> confirm_chat_id/confirm_message_id."""
+    data = dict(data)
+    last_callback = data.pop("last_callback", None)
+    message = (last_callback or {}).get("message") or {}
+    if message.get("message_id") and "confirm_message_id" not in data:
+        data["confirm_message_id"] = message["message_id"]
+        data["confirm_chat_id"] = (message.get("chat") or {}).get("id")
+    return {key: value for key, value in data.items() if value is not None}
+
+
+async def memory_usage(redis: Redis, keys: list) -> int:
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return sum(size or 0 for size in await pipe.execute())
+
+
+async def migrate_batch(redis: Redis, keys: list, dry_run: bool) -> tuple[int, int, int]:
+    """Переписывает порцию ключей; возвращает число измененных и размер значений до/после."""
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+        pipe.pttl(key)
+    results = await pipe.execute()
+
+    changed = size_before = size_after = 0
+    pipe = redis.pipeline(transaction=False)
+    for key, value, ttl in zip(keys, results[::2], results[1::2]):
+        if value is None:
+            continue
+        packed = pack_data(compact_data(unpack_data(value)))
+        size_before += len(value)
+        size_after += len(packed)
+        if packed == value:
+            continue
+        changed += 1
+        if ttl and ttl > 0:
+            pipe.set(key, packed, px=ttl)
+        else:
+            pipe.set(key, packed)
+    if not dry_run and changed:
+        await pipe.execute()
+    return changed, size_before, size_after
+
+
+async def main(dry_run: bool) -> None:
+    redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+    try:
+        keys = [key async for key in redis.scan_iter(match=DATA_PATTERN, count=BATCH_SIZE)]
+        if not keys:
+            print("Данных FSM в Redis нет.")
+            return
+
+        batches = [keys[i:i + BATCH_SIZE] for i in range(0, len(keys), BATCH_SIZE)]
+        memory_before = sum([await memory_usage(redis, batch) for batch in batches])
+        changed = value_before = value_after = 0
+        for batch in batches:
+            batch_changed, batch_before, batch_after = await migrate_batch(redis, batch, dry_run)
+            changed += batch_changed
+            value_before += batch_before
+            value_after += batch_after
+
+        report = {
+            "sessions": len(keys),
+            "migrated": changed,
+            "dry_run": dry_run,
+            # Размер самих значений (для --dry-run "после" — расчетный)
+            "value_bytes_per_session_before": round(value_before / len(keys)),
+            "value_bytes_per_session_after": round(value_after / len(keys)),
+            # MEMORY USAGE: значение вместе с накладными расходами Redis на ключ
+            "redis_bytes_per_session_before": round(memory_before / len(keys)),
+        }
+        if not dry_run:
+            memory_after = sum([await memory_usage(redis, batch) for batch in batches])
+            report["redis_bytes_per_session_after"] = round(memory_after / len(keys))
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграция данных FSM на msgpack и компактную схему")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не записывать")
+    args = parser.parse_args()
+    asyncio.run(main(args.dry_run))
@@ -0,0 +1,104 @@
+# scripts/order_status_check.py
+"""
+Проверка машины состояний заказа на всех путях смены статуса.
+
+1. PUT /api/orders/{id}/status: разрешенный переход — 200, запрещенный — 409
+   (статус не меняется, журнал order_status_events не пополняется), чужой id — 404.
+2. postgres_client.update_order_status (им пользуются хэндлеры "Я подошел" и отмена):
+   запрещенный переход не применяется и возвращает текущий статус.
+3. POST /api/orders/status/batch: для конфликта current_status — фактический статус заказа.
+
+Запросы идут в приложение FastAPI через ASGI-транспорт httpx. Тестовый
+пользователь и его заказы удаляются после проверки. Нужна только PostgreSQL
+со схемой из tables.sql, запускать на локальной/тестовой базе.
+
+Запуск из корня проекта:
+    python -m scripts.order_status_check
+"""
+import asyncio
+import json
+import sys
+
+import httpx
+
+from core.utils.database import postgres_client
+from core.webapp import app
+
+TEST_USER_ID = 999_000_000_004
+
+
+async def add_order(status: str) -> int:
+    return await postgres_client.fetchval(
+        """
+        INSERT INTO orders (user_id, first_name, "type", cup, "time", total_price, status, "timestamp")
+        VALUES ($1, 'Status', 'Латте', '330', '10', 1400, $2, NOW())
+        RETURNING order_id
+        """,
+        TEST_USER_ID, status
+    )
+
+
+async def status_of(order_id: int) -> tuple[str, int]:
+    row = await postgres_client.fetchrow(
+        "SELECT status, (SELECT COUNT(*) FROM order_status_events e WHERE e.order_id = o.order_id) AS events "
+        "FROM orders o WHERE order_id = $1", order_id)
+    return row['status'], row['events']
+
+
+async def cleanup() -> None:
+    await postgres_client.execute("DELETE FROM orders WHERE user_id = $1", TEST_USER_ID)
+
+
+async def main() -> int:
+    await postgres_client.initialize()
+    await postgres_client.execute(
+        "INSERT INTO users (telegram_id, first_name) VALUES ($1, 'Status') ON CONFLICT (telegram_id) DO NOTHING",
+        TEST_USER_ID
+    )
+    await cleanup()
+    try:
+        new_id = await add_order("new")
+        completed_id = await add_order("completed")
+        ready_id = await add_order("ready")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://cafe-bot") as client:
+            skip = await client.put(f"/api/orders/{new_id}/status", params={"status": "completed"})
+            after_skip = await status_of(new_id)
+            allowed = await client.put(f"/api/orders/{new_id}/status", params={"status": "in_progress"})
+            after_allowed = await status_of(new_id)
+            missing = await client.put("/api/orders/2147483000/status", params={"status": "ready"})
+
+            batch = await client.post("/api/orders/status/batch", json={"transitions": [
+                {"order_id": ready_id, "expected_status": "ready", "new_status": "arrived"},
+                {"order_id": new_id, "expected_status": "new", "new_status": "in_progress"},
+            ]})
+
+        reopen = await postgres_client.update_order_status(completed_id, "cancelled")
+        arrived_twice = await postgres_client.update_order_status(ready_id, "arrived")
+
+        conflicts = batch.json()["conflicts"]
+        report = {
+            "new_to_completed": (skip.status_code, skip.json().get("detail"), after_skip),
+            "new_to_in_progress": (allowed.status_code, after_allowed),
+            "missing_order": missing.status_code,
+            "batch": batch.json(),
+            "cancel_completed": reopen,
+            "arrived_twice": arrived_twice,
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        ok = (skip.status_code == 409 and after_skip == ("new", 0)
+              and allowed.status_code == 200 and after_allowed == ("in_progress", 1)
+              and missing.status_code == 404
+              and [a["order_id"] for a in batch.json()["applied"]] == [ready_id]
+              and len(conflicts) == 1 and conflicts[0]["current_status"] == "in_progress"
+              and reopen == (False, "completed") and await status_of(completed_id) == ("completed", 0)
+              and arrived_twice == (False, "arrived"))
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        await cleanup()
+        await postgres_client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
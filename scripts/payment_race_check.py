@@ -0,0 +1,149 @@
+# scripts/payment_race_check.py
+"""
+Проверка гонки при финализации платежа: 50 одинаковых вебхуков об успешной оплате.
+
+1. 50 одновременных POST /webhooks/epay через приложение FastAPI (ASGI-транспорт
+   httpx) при запущенном пуле payment_job_workers — в очереди должно оказаться
+   одно задание, после его выполнения — ровно один заказ и платеж в статусе paid.
+2. 50 одновременных финализаций другого платежа (как если бы повторы дошли до
+   разных обработчиков или процессов) — снова ровно один заказ.
+
+Заглушки вместо внешних сервисов: FSM в памяти, бот с фиктивным токеном,
+диспетчер outbox не запускается (в Telegram ничего не отправляется — уведомления
+остаются в outbox и удаляются вместе с тестовыми данными). Нужна только
+PostgreSQL со схемой из tables.sql, запускать на локальной/тестовой базе.
+
+Запуск из корня проекта:
+    python -m scripts.payment_race_check
+    python -m scripts.payment_race_check --duplicates 100
+"""
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+
+import httpx
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import config
+from core.utils.database import postgres_client
+from core.services.payment_jobs import payment_job_workers, JOB_PENDING, JOB_DONE
+from core.webapp import app
+from core.webapp.epay_payment_hooks import process_successful_payment
+
+TEST_USER_ID = 999_000_000_001
+JOB_TIMEOUT = 30
+ORDER_DATA = {"type": "Капучино", "cup": "300", "time": "10", "syrup": "Без сиропа", "croissant": "Без добавок"}
+
+
+async def prepare(payment_ids: list[str]) -> int:
+    await postgres_client.execute(
+        """
+        INSERT INTO users (telegram_id, username, first_name) VALUES ($1, 'race_check', 'Race')
+        ON CONFLICT (telegram_id) DO NOTHING
+        """,
+        TEST_USER_ID
+    )
+    for payment_id in payment_ids:
+        await postgres_client.execute(
+            """
+            INSERT INTO payments (payment_id, user_id, amount, description, status, order_data)
+            VALUES ($1, $2, 1000, 'race check', 'pending', $3)
+            """,
+            payment_id, TEST_USER_ID, json.dumps(ORDER_DATA, ensure_ascii=False)
+        )
+    # Граница, после которой появятся уведомления этой проверки
+    return await postgres_client.fetchval("SELECT COALESCE(MAX(id), 0) FROM notification_outbox")
+
+
+async def cleanup(payment_ids: list[str], outbox_from: int) -> None:
+    await postgres_client.execute(
+        "DELETE FROM notification_outbox WHERE id > $1 AND status = 'pending' AND (chat_id = $2 OR chat_id = $3)",
+        outbox_from, TEST_USER_ID, config.BARISTA_ID
+    )
+    await postgres_client.execute("DELETE FROM payment_jobs WHERE payment_id = ANY($1::varchar[])", payment_ids)
+    await postgres_client.execute("DELETE FROM orders WHERE payment_id = ANY($1::varchar[])", payment_ids)
+    await postgres_client.execute("DELETE FROM payments WHERE payment_id = ANY($1::varchar[])", payment_ids)
+
+
+async def outcome(payment_id: str) -> dict:
+    orders = await postgres_client.fetchval("SELECT COUNT(*) FROM orders WHERE payment_id = $1", payment_id)
+    status = await postgres_client.fetchval("SELECT status FROM payments WHERE payment_id = $1", payment_id)
+    return {"orders_created": orders, "payment_status": status}
+
+
+async def wait_for_jobs(payment_id: str) -> list[str]:
+    """Ждет, пока пул обработчиков выполнит задания по платежу."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JOB_TIMEOUT
+    while True:
+        statuses = [row['status'] for row in await postgres_client.fetch(
+            "SELECT status FROM payment_jobs WHERE payment_id = $1", payment_id)]
+        if JOB_PENDING not in statuses or loop.time() > deadline:
+            return statuses
+        await asyncio.sleep(0.1)
+
+
+async def webhooks_via_app(payment_id: str, duplicates: int) -> dict:
+    webhook = {"invoiceId": payment_id, "code": "ok", "amount": 1000, "currency": "KZT"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://cafe-bot") as client:
+        responses = await asyncio.gather(*(client.post("/webhooks/epay", json=webhook)
+                                           for _ in range(duplicates)))
+    job_statuses = await wait_for_jobs(payment_id)
+    return {
+        "http_statuses": sorted({response.status_code for response in responses}),
+        "jobs": job_statuses,
+        **await outcome(payment_id),
+    }
+
+
+async def concurrent_finalizations(payment_id: str, duplicates: int, bot: Bot, dp: Dispatcher) -> dict:
+    results = await asyncio.gather(*(process_successful_payment(payment_id, bot, dp)
+                                     for _ in range(duplicates)), return_exceptions=True)
+    return {
+        "errors": [str(r) for r in results if isinstance(r, Exception)],
+        **await outcome(payment_id),
+    }
+
+
+async def main(duplicates: int) -> int:
+    await postgres_client.initialize()
+    bot = Bot(token="123456:race-check-token")
+    dp = Dispatcher(storage=MemoryStorage())
+    # То, что lifespan кладет в состояние приложения и запускает при старте
+    app.state.bot_instance, app.state.dp = bot, dp
+    payment_job_workers.start(bot, dp)
+
+    webhook_payment = f"race-{uuid.uuid4().hex[:12]}"
+    direct_payment = f"race-{uuid.uuid4().hex[:12]}"
+    outbox_from = await prepare([webhook_payment, direct_payment])
+    try:
+        via_app = await webhooks_via_app(webhook_payment, duplicates)
+        direct = await concurrent_finalizations(direct_payment, duplicates, bot, dp)
+        report = {
+            "duplicates": duplicates,
+            "workers": config.PAYMENT_JOB_WORKERS,
+            "webhooks_via_app": via_app,
+            "concurrent_finalizations": direct,
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        ok = (via_app["http_statuses"] == [200] and via_app["jobs"] == [JOB_DONE]
+              and via_app["orders_created"] == 1 and via_app["payment_status"] == "paid"
+              and not direct["errors"] and direct["orders_created"] == 1 and direct["payment_status"] == "paid")
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        await payment_job_workers.stop()
+        await cleanup([webhook_payment, direct_payment], outbox_from)
+        await bot.session.close()
+        await postgres_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка гонки при финализации платежа")
+    parser.add_argument("--duplicates", type=int, default=50, help="сколько одинаковых вебхуков отправить")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.duplicates)))
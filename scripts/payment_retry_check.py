@@ -0,0 +1,231 @@
+# scripts/payment_retry_check.py
+"""
+Проверка повторной оплаты после неудавшейся.
+
+1. "Оплатить" — создается счет (платеж pending), результат запоминается в защите
+   от повторных нажатий.
+2. Повторное "Оплатить" — второй счет не создается. "Подтвердить" (оплата на месте)
+   по той же попытке тоже отклоняется — и по результату в защите от повторных
+   нажатий, и после его истечения (по живому счету в payments); заказ не создается.
+3. Failed-вебхук через POST /webhooks/epay при запущенном пуле payment_job_workers —
+   платеж становится failed, ключ попытки в FSM должен смениться, а сообщение о
+   неудаче и удаление ссылки на оплату — лежать в notification_outbox (диспетчер
+   outbox не запускается, в Telegram ничего не уходит).
+4. "Оплатить" еще раз — должен появиться новый счет, а не ответ "Счет уже создан".
+
+Заглушки вместо внешних сервисов: мок Epay (scripts/epay_mock_server.py) поднимается
+в этом же процессе, FSM и хранилище защиты от повторных нажатий — в памяти (вместо
+Redis), бот только запоминает отправки. Нужна только PostgreSQL со схемой из
+tables.sql, запускать на локальной/тестовой базе.
+
+Запуск из корня проекта:
+    python -m scripts.payment_retry_check
+"""
+import asyncio
+import json
+import sys
+from types import SimpleNamespace
+
+import httpx
+from aiogram import Dispatcher
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiohttp import web
+
+from config import config
+from core.utils.database import postgres_client
+from core.services.epay_service import epay_service
+from core.services.idempotency import idempotency_guard
+from core.services.payment_jobs import payment_job_workers, JOB_PENDING
+from core.handlers.basic import pay_order_handler, confirm_create_order
+from core.webapp import app
+from scripts.epay_mock_server import EpayMock
+
+TEST_USER_ID = 999_000_000_002
+MOCK_PORT = 8091
+JOB_TIMEOUT = 30
+ORDER_DATA = {"type": "Капучино", "cup": "330", "time": "10", "syrup": "Без сиропа",
+              "croissant": "Без добавок", "checkout_token": "retry-check-token"}
+
+
+class MemoryRedis:
+    """Хранилище в памяти с подмножеством команд Redis, которые использует IdempotencyGuard."""
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def delete(self, key):
+        return int(self.values.pop(key, None) is not None)
+
+
+class RecordingBot:
+    """Бот-заглушка: запоминает отправленные и удаленные сообщения."""
+
+    id = 123456
+
+    def __init__(self):
+        self.sent, self.deleted = [], []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs):
+        self.deleted.append(message_id)
+        return True
+
+
+def make_callback(answers: list[str]) -> SimpleNamespace:
+    """Нажатие кнопки "Оплатить": ответы на callback и сообщения бота складываются в answers."""
+    async def answer(text: str = None, **kwargs):
+        answers.append(text)
+        return SimpleNamespace(message_id=1000 + len(answers))
+
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=TEST_USER_ID, first_name="Retry"),
+        message=SimpleNamespace(message_id=1, answer=answer),
+        answer=answer,
+    )
+
+
+async def press_pay(state: FSMContext) -> list[str]:
+    answers = []
+    await pay_order_handler(make_callback(answers), state, SimpleNamespace(username="cafe_bot"))
+    return answers
+
+
+async def press_confirm(state: FSMContext) -> list[str]:
+    answers = []
+    await confirm_create_order(make_callback(answers), state)
+    return answers
+
+
+async def user_payments() -> list[dict]:
+    rows = await postgres_client.fetch(
+        "SELECT payment_id, status, invoice_url FROM payments WHERE user_id = $1 ORDER BY created_at", TEST_USER_ID)
+    return [dict(row) for row in rows]
+
+
+async def wait_for_jobs(payment_id: str) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JOB_TIMEOUT
+    while loop.time() < deadline:
+        statuses = await postgres_client.fetch("SELECT status FROM payment_jobs WHERE payment_id = $1", payment_id)
+        if statuses and JOB_PENDING not in [row['status'] for row in statuses]:
+            return
+        await asyncio.sleep(0.1)
+
+
+async def prepare() -> None:
+    await postgres_client.execute(
+        """
+        INSERT INTO users (telegram_id, username, first_name) VALUES ($1, 'retry_check', 'Retry')
+        ON CONFLICT (telegram_id) DO NOTHING
+        """,
+        TEST_USER_ID
+    )
+
+
+async def cleanup() -> None:
+    payment_ids = [row['payment_id'] for row in await user_payments()]
+    await postgres_client.execute("DELETE FROM notification_outbox WHERE chat_id = $1 AND status = 'pending'",
+                                  TEST_USER_ID)
+    await postgres_client.execute("DELETE FROM payment_jobs WHERE payment_id = ANY($1::varchar[])", payment_ids)
+    await postgres_client.execute("DELETE FROM orders WHERE user_id = $1", TEST_USER_ID)
+    await postgres_client.execute("DELETE FROM payments WHERE user_id = $1", TEST_USER_ID)
+
+
+async def user_orders() -> int:
+    return await postgres_client.fetchval("SELECT COUNT(*) FROM orders WHERE user_id = $1", TEST_USER_ID)
+
+
+async def main() -> int:
+    mock = EpayMock(f"http://127.0.0.1:{MOCK_PORT}", latency=0, error_rate=0, token_ttl=1200)
+    runner = web.AppRunner(mock.build_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", MOCK_PORT).start()
+    config.EPAY_OAUTH_URL = f"http://127.0.0.1:{MOCK_PORT}/oauth2/token"
+    config.EPAY_CREATE_INVOICE_URL = f"http://127.0.0.1:{MOCK_PORT}/invoice"
+
+    await postgres_client.initialize()
+    guard_store = MemoryRedis()
+    idempotency_guard.initialize(guard_store)
+    bot = RecordingBot()
+    dp = Dispatcher(storage=MemoryStorage())
+    app.state.bot_instance, app.state.dp = bot, dp
+    payment_job_workers.start(bot, dp)
+    state = FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=TEST_USER_ID, user_id=TEST_USER_ID))
+    await state.set_data(dict(ORDER_DATA))
+    await prepare()
+    await cleanup()
+    try:
+        await press_pay(state)
+        first = await user_payments()
+        repeated = await press_pay(state)
+        confirm_answers = await press_confirm(state)
+        # Результат в Redis истек (IDEMPOTENCY_RESULT_TTL) — остается проверка по payments
+        guard_store.values.clear()
+        confirm_after_ttl = await press_confirm(state)
+        orders_while_invoice = await user_orders()
+
+        failed_id = first[0]['payment_id']
+        webhook = {"invoiceId": failed_id, "code": "fail", "amount": 1400, "currency": "KZT",
+                   "reason": "Отказ банка-эмитента"}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://cafe-bot") as client:
+            response = await client.post("/webhooks/epay", json=webhook)
+        await wait_for_jobs(failed_id)
+        after_failure = await state.get_data()
+        outbox = [row['method'] for row in await postgres_client.fetch(
+            "SELECT method FROM notification_outbox WHERE chat_id = $1 AND status = 'pending' ORDER BY id",
+            TEST_USER_ID)]
+
+        retry = await press_pay(state)
+        payments = await user_payments()
+        data = await state.get_data()
+        report = {
+            "first_pay": first,
+            "repeated_pay_answers": repeated,
+            "confirm_answers": confirm_answers,
+            "confirm_after_guard_ttl": confirm_after_ttl,
+            "orders_while_invoice_live": orders_while_invoice,
+            "webhook_status": response.status_code,
+            "failure_outbox": outbox,
+            "bot_calls": bot.sent + bot.deleted,
+            "token_rotated": after_failure.get('checkout_token') != ORDER_DATA['checkout_token'],
+            "payment_cleared_from_fsm": 'payment_id' not in after_failure,
+            "retry_answers": retry,
+            "payments": payments,
+            "fsm_payment_id": data.get('payment_id'),
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=str))
+        ok = (len(first) == 1 and any("Счет уже создан" in (a or "") for a in repeated)
+              and any("Счет уже создан" in (a or "") for a in confirm_answers)
+              and any("Счет уже создан" in (a or "") for a in confirm_after_ttl)
+              and orders_while_invoice == 0
+              and response.status_code == 200 and outbox == ["delete_message", "send_message"]
+              and not report["bot_calls"] and report["token_rotated"] and report["payment_cleared_from_fsm"]
+              and len(payments) == 2 and payments[0]['status'] == "failed"
+              and payments[1]['status'] == "pending" and payments[1]['invoice_url']
+              and data.get('payment_id') == payments[1]['payment_id'])
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        await payment_job_workers.stop()
+        await cleanup()
+        await epay_service.close()
+        await postgres_client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -60,6 +60,9 @@ CREATE TABLE IF NOT EXISTS orders (
     status        VARCHAR(50) NOT NULL DEFAULT 'new',
     payment_status VARCHAR(20) NOT NULL DEFAULT 'unpaid', -- unpaid, paid, bonus
 
+    -- Ключ попытки оформления (защита от повторного нажатия)
+    idempotency_key VARCHAR(64),
+
     -- Временные метки
     "timestamp"   TIMESTAMPTZ NOT NULL,
     created_at    TIMESTAMPTZ DEFAULT NOW(),
@@ -84,10 +87,105 @@ CREATE TABLE IF NOT EXISTS payments (
     description TEXT,
     status VARCHAR(20) NOT NULL DEFAULT 'pending',
     order_data JSONB,
+    idempotency_key VARCHAR(64),
+    invoice_url TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Журнал смен статусов заказа (append-only). Пишется тем же запросом,
+-- что и обновление orders.status, — основа аналитики времени приготовления.
+CREATE TABLE IF NOT EXISTS order_status_events (
+    id BIGSERIAL PRIMARY KEY,
+    order_id INT NOT NULL REFERENCES orders(order_id) ON DELETE CASCADE,
+    from_status VARCHAR(50),
+    to_status VARCHAR(50) NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+-- Кэш file_id статических картинок бота (ключ — бот и SHA-256 содержимого файла)
+CREATE TABLE IF NOT EXISTS media_cache (
+    bot_id BIGINT NOT NULL,
+    file_hash VARCHAR(64) NOT NULL,
+    file_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (bot_id, file_hash)
+);
+
+-- Запуски рассылок (статус: running, paused, cancelled, completed)
+CREATE TABLE IF NOT EXISTS broadcast_runs (
+    id SERIAL PRIMARY KEY,
+    admin_id BIGINT NOT NULL,
+    message_text TEXT,
+    photo_id VARCHAR(255),
+    segment VARCHAR(30) NOT NULL DEFAULT 'all',
+    segment_param VARCHAR(255),
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    progress_message_id BIGINT,
     created_at TIMESTAMPTZ DEFAULT NOW(),
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Части рассылки: диапазон telegram_id (cursor; range_end] и чекпоинт курсора
+CREATE TABLE IF NOT EXISTS broadcast_shards (
+    run_id INT NOT NULL REFERENCES broadcast_runs(id) ON DELETE CASCADE,
+    shard_no INT NOT NULL,
+    cursor BIGINT NOT NULL,
+    range_end BIGINT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    sent_count INT NOT NULL DEFAULT 0,
+    blocked_count INT NOT NULL DEFAULT 0,
+    transient_count INT NOT NULL DEFAULT 0,
+    failed_count INT NOT NULL DEFAULT 0,
+    heartbeat_at TIMESTAMPTZ,
+    PRIMARY KEY (run_id, shard_no)
+);
+
+-- Результат доставки каждому получателю (чтобы после рестарта никому не отправить дважды).
+-- Строка пишется до отправки со статусом sending и получает результат (sent, blocked,
+-- transient, failed) вместе с курсором шарда; sending после падения воркера — исход неизвестен
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    run_id INT NOT NULL REFERENCES broadcast_runs(id) ON DELETE CASCADE,
+    telegram_id BIGINT NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (run_id, telegram_id)
+);
+
+-- Transactional outbox: уведомления пишутся в транзакции заказа и отправляются
+-- диспетчером (status: pending, sent, failed; next_attempt_at — повтор или "аренда" строки)
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    method VARCHAR(50) NOT NULL DEFAULT 'send_message',
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+
+-- Очередь обработки вебхуков Epay (status: pending, done, dead).
+-- Одно задание на платеж и тип вебхука: повторы от Epay не дублируют обработку
+CREATE TABLE IF NOT EXISTS payment_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    payment_id VARCHAR(255) NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    payload JSONB,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (payment_id, kind)
+);
+
+-- Новые колонки для уже существующих баз
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS invoice_url TEXT;
 
 -- =================================================================
 --         ЧАСТЬ 2: ФУНКЦИЯ И ТРИГГЕРЫ ДЛЯ 'updated_at'
@@ -117,6 +215,12 @@ CREATE TRIGGER trigger_broadcast_updated_at BEFORE UPDATE ON broadcast FOR EACH
 DROP TRIGGER IF EXISTS trigger_payments_updated_at ON payments;
 CREATE TRIGGER trigger_payments_updated_at BEFORE UPDATE ON payments FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
+DROP TRIGGER IF EXISTS trigger_broadcast_runs_updated_at ON broadcast_runs;
+CREATE TRIGGER trigger_broadcast_runs_updated_at BEFORE UPDATE ON broadcast_runs FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+DROP TRIGGER IF EXISTS trigger_payment_jobs_updated_at ON payment_jobs;
+CREATE TRIGGER trigger_payment_jobs_updated_at BEFORE UPDATE ON payment_jobs FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
 
 -- =================================================================
 --         ЧАСТЬ 3: ИНДЕКСЫ ДЛЯ УСКОРЕНИЯ РАБОТЫ
@@ -126,7 +230,29 @@ CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users (telegram_id);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
 CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id);
 CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+-- Keyset-пагинация истории заказов: ORDER BY created_at DESC, order_id DESC
+CREATE INDEX IF NOT EXISTS idx_orders_created_at_order_id ON orders (created_at DESC, order_id DESC);
 CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id);
+-- Очистка зависших платежей: частичный индекс только по ожидающим (горячее множество)
+CREATE INDEX IF NOT EXISTS idx_payments_pending_created_at ON payments (created_at, payment_id) WHERE status = 'pending';
+-- Один заказ / один платеж на попытку оформления, даже при гонке процессов
+CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotency_key ON payments (idempotency_key);
+-- Сегменты рассылки: "заказывал за N дней" / "никогда не заказывал" (index-only по пользователю)
+CREATE INDEX IF NOT EXISTS idx_orders_user_id_created_at ON orders (user_id, created_at DESC);
+-- Сегмент "любимый напиток": кандидаты, заказывавшие напиток
+CREATE INDEX IF NOT EXISTS idx_orders_type_user_id ON orders ("type", user_id);
+-- Сегмент "есть бесплатные кофе": частичный индекс только по владельцам бонусов
+CREATE INDEX IF NOT EXISTS idx_referral_program_free_coffees ON referral_program (user_id) WHERE free_coffees > 0;
+-- Выборка диспетчера outbox: только неотправленные уведомления
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending ON notification_outbox (next_attempt_at, id) WHERE status = 'pending';
+-- Очередь уведомлений одного чата: поиск более ранних неотправленных строк
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending_chat ON notification_outbox (chat_id, id) WHERE status = 'pending';
+-- Выборка обработчиков очереди платежей
+CREATE INDEX IF NOT EXISTS idx_payment_jobs_pending ON payment_jobs (next_attempt_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_order_status_events_order_id ON order_status_events (order_id, created_at);
+-- Аналитика: выборка переходов в нужный статус за период
+CREATE INDEX IF NOT EXISTS idx_order_status_events_to_status ON order_status_events (to_status, created_at);
 
 
 -- =================================================================
@@ -10,6 +10,8 @@ from loguru import logger
 from celery_app import celery_app
 from config import config
 from core.utils.database import PostgresClient
+from core.services.send_scheduler import setup_send_scheduler, send_scheduler
+from core.services.broadcast import BroadcastEngine, create_broadcast_run, report_progress, SHARD_BUSY
 
 
 async def get_db_client():
@@ -61,7 +63,8 @@ def generate_csv_string(orders: list) -> str:
 # ======================
 
 @celery_app.task  # <-- ИЗМЕНЕНО: Убран явный 'name'. Celery сгенерирует его автоматически.
-def broadcast_task(admin_id: int):
+def broadcast_task(admin_id: int, segment: str = "all", segment_param: str = None):
+    """Создает запуск рассылки по сегменту, делит получателей на части и ставит их в очередь."""
     async def _broadcast_wrapper():
         bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
         db = await get_db_client()
@@ -72,33 +75,67 @@ def broadcast_task(admin_id: int):
                 await bot.send_message(admin_id, "❌ Сообщение пустое или не найдено в БД.")
                 return
 
-            message_text = record['message_text']
-            photo_id = record['photo_id']
-            await bot.send_message(admin_id, "🚀 Рассылка запущена")
-
-            users = await db.fetch("SELECT telegram_id FROM users WHERE is_active = TRUE")
-            success_count, fail_count = 0, 0
+            run_id = await create_broadcast_run(
+                db, admin_id, record['message_text'], record['photo_id'], segment, segment_param
+            )
+            shard_numbers = [row['shard_no'] for row in await db.fetch(
+                "SELECT shard_no FROM broadcast_shards WHERE run_id = $1 ORDER BY shard_no", run_id
+            )]
+            if not shard_numbers:
+                await db.execute("UPDATE broadcast_runs SET status = 'completed' WHERE id = $1", run_id)
+            await report_progress(bot, db, run_id)
+            return shard_numbers, run_id
 
-            for user in users:
-                try:
-                    if photo_id:
-                        await bot.send_photo(user['telegram_id'], photo_id, caption=message_text)
-                    else:
-                        await bot.send_message(user['telegram_id'], message_text)
-                    success_count += 1
-                except Exception:
-                    fail_count += 1
-                    await db.update("users", {"is_active": False}, "telegram_id = $1", [user['telegram_id']])
-                await asyncio.sleep(0.05)
+        finally:
+            await db.close()
+            await bot.session.close()
 
-            report = f"🏁 Рассылка завершена!\n✅ Успешно: `{success_count}`\n❌ Ошибок: `{fail_count}`"
-            await bot.send_message(admin_id, report)
+    result = run_async(_broadcast_wrapper())
+    if result:
+        shard_numbers, run_id = result
+        for shard_no in shard_numbers:
+            broadcast_shard_task.delay(run_id, shard_no)
+
+
+# acks_late + reject_on_worker_lost: если воркер упал посреди части, брокер
+# отдаст задачу другому воркеру, и она продолжит с сохраненного курсора.
+# Повторно доставленная задача обычно застает шард "running" со свежим heartbeat
+# упавшего воркера — тогда она перезапускается через BROADCAST_SHARD_STALE_SECONDS,
+# пока шард не станет брошенным (и будет забран) или не окажется выполненным.
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=None)
+def broadcast_shard_task(self, run_id: int, shard_no: int):
+    async def _shard_wrapper():
+        bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+        setup_send_scheduler(bot)
+        # Части работают параллельно, поэтому общий темп рассылки делится между ними
+        send_scheduler.set_rate(max(1.0, config.BROADCAST_RATE / config.BROADCAST_SHARDS))
+        db = await get_db_client()
 
+        try:
+            return await BroadcastEngine(bot=bot, db=db, run_id=run_id, shard_no=shard_no).run()
         finally:
             await db.close()
             await bot.session.close()
 
-    run_async(_broadcast_wrapper())
+    if run_async(_shard_wrapper()) == SHARD_BUSY:
+        raise self.retry(countdown=config.BROADCAST_SHARD_STALE_SECONDS)
+
+
+@celery_app.task
+def resume_broadcast_task(run_id: int):
+    """Ставит в очередь все незавершенные части рассылки (после паузы)."""
+    async def _resume_wrapper():
+        db = await get_db_client()
+        try:
+            return [row['shard_no'] for row in await db.fetch(
+                "SELECT shard_no FROM broadcast_shards WHERE run_id = $1 AND status <> 'done' ORDER BY shard_no",
+                run_id
+            )]
+        finally:
+            await db.close()
+
+    for shard_no in run_async(_resume_wrapper()):
+        broadcast_shard_task.delay(run_id, shard_no)
 
 
 # ======================